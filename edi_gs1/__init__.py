@@ -4,6 +4,8 @@ import product
 import sale
 import stock
 import edi_route
+import edi_resolver
+import edi_generator
 import messages
 import stock
 import edifact
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp import models, fields, api, _
+from datetime import timedelta
+import bisect
+import os
+import random
+import tempfile
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# GS1 company prefixes of the generated parties and items, well apart from real Swedish ones.
+CHAIN_PREFIX = '7399990'
+STORE_PREFIX = '7399991'
+SUPPLIER_PREFIX = '7399992'
+ITEM_PREFIX = '7399993'
+
+QUANTITIES = [1, 1, 1, 2, 2, 3, 4, 6, 6, 12, 12, 24, 48]
+
+
+def check_digit(digits):
+    """GS1 check digit (mod 10, weights 3 and 1 from the right) of a string of digits."""
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digits)))
+    return str((10 - total % 10) % 10)
+
+
+def gs1_number(prefix, serial, length):
+    """A GS1 number (GLN, GTIN, SSCC) of length digits, check digit included."""
+    body = prefix + str(serial).zfill(length - 1 - len(prefix))
+    return body + check_digit(body)
+
+
+class edi_gs1_generator(models.AbstractModel):
+    """Writes synthetic ESAP20 interchanges (ORDERS, INVOIC, DESADV) of any size
+    for load testing routes, with the segment builders of edi.message and the
+    interchange format of the esap20 fold.
+
+    seed() creates a chain, its stores and a product catalogue with GLNs and
+    GTINs (found again on the next run, so it can be called every time).
+    Products are picked with a Zipf distribution, a few sell a lot and most
+    sell a little; stores are picked evenly. The same seed gives the same
+    interchanges."""
+    _name = 'edi.gs1.generator'
+    _description = 'GS1 Interchange Generator'
+
+    @api.model
+    def _partner(self, gln, values):
+        partner = self.env['res.partner'].search([('gs1_gln', '=', gln)], limit=1)
+        if not partner:
+            values['gs1_gln'] = gln
+            partner = self.env['res.partner'].create(values)
+        return partner
+
+    @api.model
+    def seed(self, stores=20, products=500):
+        """Return (supplier, chain, stores, products), creating what is missing.
+        The supplier is the main partner (our company), it is given a GLN if it has none."""
+        supplier = self.env.ref('base.main_partner')
+        if not supplier.gs1_gln:
+            supplier.gs1_gln = gs1_number(SUPPLIER_PREFIX, 1, 13)
+            _logger.info('EDI generator: main partner got GLN %s' % supplier.gs1_gln)
+        chain = self._partner(gs1_number(CHAIN_PREFIX, 1, 13), {'name': 'Generated Chain', 'is_company': True, 'customer': True})
+        store_ids = []
+        for i in range(1, stores + 1):
+            store_ids.append(self._partner(gs1_number(STORE_PREFIX, i, 13), {
+                'name': 'Generated Store %s' % i, 'is_company': True, 'customer': True, 'parent_id': chain.id}).id)
+        product_obj = self.env['product.product']
+        gtins = [gs1_number(ITEM_PREFIX, i, 13) for i in range(1, products + 1)]
+        existing = dict((p.gs1_gtin13, p.id) for p in product_obj.search([('gs1_gtin13', 'in', gtins)]))
+        product_ids = []
+        for i, gtin in enumerate(gtins, 1):
+            if gtin not in existing:
+                existing[gtin] = product_obj.create({
+                    'name': 'Generated Item %s' % i,
+                    'default_code': 'GEN%05d' % i,
+                    'gs1_gtin13': gtin,
+                    'list_price': 10.0 + i % 90,
+                }).id
+            product_ids.append(existing[gtin])
+        return supplier, chain, self.env['res.partner'].browse(store_ids), product_obj.browse(product_ids)
+
+    @api.model
+    def generate(self, edi_type='ORDERS', messages=10, lines=20, directory='.', stores=20, products=500, seed=0, name=None):
+        """Write an interchange of messages edi_type messages (ORDERS, INVOIC or DESADV)
+        with about lines LIN each to directory, messages are written as they are built.
+        ORDERS go from the chain to us, INVOIC and DESADV from us to the chain.
+        Returns the path of the file."""
+        builder = {
+            'ORDERS': self._gen_orders,
+            'INVOIC': self._gen_invoic,
+            'DESADV': self._gen_desadv,
+        }[edi_type]
+        rng = random.Random(seed)
+        supplier, chain, store_recs, product_recs = self.seed(stores, products)
+        # Zipf weights, product n is picked in proportion to 1/n
+        cumulative = []
+        total = 0.0
+        for rank in range(1, len(product_recs) + 1):
+            total += 1.0 / rank
+            cumulative.append(total)
+        pick_product = lambda: product_recs[min(bisect.bisect(cumulative, rng.random() * total), len(product_recs) - 1)]
+
+        now = fields.Datetime.from_string(fields.Datetime.now())
+        ref = name or '%s%s%03d' % (edi_type[:3], now.strftime('%y%m%d%H%M%S'), seed % 1000)
+        sender, recipient = (chain, supplier) if edi_type == 'ORDERS' else (supplier, chain)
+        message_obj = self.env['edi.message']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, ref + '.edi')
+        # Written next to the directory and moved in, a polling route never sees half a file.
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s' % ref, dir=os.path.dirname(os.path.abspath(directory)))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(message_obj._gs1_encode_msg(self.env['edi.envelope']._gs1_unb(sender, recipient, now, ref)))
+            for n in range(1, messages + 1):
+                msg = message_obj.new({
+                    'name': str(n),
+                    'consignor_id': supplier.id,
+                    'consignee_id': chain.id,
+                })
+                store = store_recs[rng.randrange(len(store_recs))]
+                items = [(pick_product(), rng.choice(QUANTITIES)) for i in range(max(1, int(rng.gauss(lines, lines / 4.0))))]
+                f.write(builder(msg, rng, '%s%05d' % (ref, n), now, store, items).getvalue())
+            f.write(message_obj._gs1_encode_msg(self.env['edi.envelope']._gs1_unz(messages, ref)))
+        os.rename(tmp_path, path)
+        _logger.info('EDI generator: %s with %s %s messages written' % (path, messages, edi_type))
+        return path
+
+    def _line(self, model, product, qty):
+        """An unsaved line for the LIN and QTY builders."""
+        if model == 'account.invoice.line':
+            return self.env[model].new({'name': product.name, 'product_id': product.id, 'quantity': qty, 'price_unit': product.list_price})
+        return self.env[model].new({'name': product.name, 'product_id': product.id, 'product_uom_qty': qty})
+
+    def _gen_orders(self, msg, rng, doc_no, now, store, items):
+        body = msg._gs1_writer()
+        body += msg.UNH('ORDERS')
+        body += msg.BGM(220, doc_no)
+        body += msg.DTM(137, fields.Datetime.to_string(now))
+        body += msg.DTM(2, fields.Datetime.to_string(now + timedelta(days=rng.randint(1, 3))))
+        body += msg.NAD_BY(store)
+        body += msg.NAD_SU()
+        body += msg._NAD('DP', store)
+        for product, qty in items:
+            body += msg.LIN(body, self._line('stock.move', product, qty))
+            # A sale.order.line gives the ordered quantity qualifier (21).
+            body += msg.QTY(self._line('sale.order.line', product, qty))
+        body += msg.UNS()
+        body += msg.UNT(body)
+        return body
+
+    def _gen_invoic(self, msg, rng, doc_no, now, store, items):
+        body = msg._gs1_writer()
+        body += msg.UNH('INVOIC', ass_code='EAN008')
+        body += msg.BGM(380, doc_no, 9)
+        body += msg.DTM(137, fields.Datetime.to_string(now))
+        body += msg.RFF(doc_no, 'ON')
+        body += msg.NAD_BY(store)
+        body += msg.NAD_SU()
+        body += msg.PAT()
+        body += msg.DTM(13, fields.Datetime.to_string(now + timedelta(days=30)))
+        untaxed = 0.0
+        for line_nr, (product, qty) in enumerate(items, 1):
+            line = self._line('account.invoice.line', product, qty)
+            subtotal = qty * product.list_price
+            untaxed += subtotal
+            body += msg.LIN(body, line)
+            body += msg.PIA(product, 'SA')
+            body += msg.QTY(line)
+            body += msg.MOA(subtotal)
+            body += msg.PRI(product.list_price)
+            body += msg.RFF(doc_no, 'ON', line_nr)
+        tax = round(untaxed * 0.12, 2)
+        body += msg.UNS()
+        body += msg.CNT(1, sum(qty for product, qty in items))
+        body += msg.CNT(2, body.lin_count)
+        body += msg.MOA(untaxed + tax, 9)
+        body += msg.MOA(untaxed, 79)
+        body += msg.MOA(untaxed, 125)
+        body += msg.MOA(tax, 176)
+        body += msg.TAX(12.0)
+        body += msg.MOA(tax, 124)
+        body += msg.UNT(body)
+        return body
+
+    def _gen_desadv(self, msg, rng, doc_no, now, store, items):
+        body = msg._gs1_writer()
+        body += msg.UNH('DESADV')
+        body += msg.BGM(doc_code=351, doc_no=doc_no)
+        body += msg.DTM(137, fields.Datetime.to_string(now))
+        body += msg.DTM(11, fields.Datetime.to_string(now))
+        body += msg.DTM(17, fields.Datetime.to_string(now + timedelta(days=1)))
+        body += msg.RFF(doc_no, qualifier='ON')
+        body += msg.NAD_SU()
+        body += msg.NAD_BY(store)
+        body += msg._NAD('DP', store)
+        # Up to 20 lines on every pallet
+        for level, start in enumerate(range(0, len(items), 20), 1):
+            body += msg.CPS(level)
+            body += msg.PAC()
+            body += msg.PCI()
+            body += msg.GIN(gs1_number('3' + SUPPLIER_PREFIX, rng.randrange(10 ** 9), 18))
+            for line_nr, (product, qty) in enumerate(items[start:start + 20], start + 1):
+                line = self._line('stock.move', product, qty)
+                body += msg.LIN(body, line)
+                body += msg.PIA(product, 'SA')
+                body += msg.QTY(line)
+                body += msg.RFF(doc_no, 'ON', line_nr)
+        body += msg.CNT(1, sum(qty for product, qty in items))
+        body += msg.CNT(2, body.lin_count)
+        body += msg.UNT(body)
+        return body
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
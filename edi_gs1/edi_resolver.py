@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp import models, fields, api, _
+import weakref
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# {cursor: {(kind, uid): {code: [ids]}}}. Lives as long as the cursor, which
+# for the cron job and the Run button is the route run.
+_caches = weakref.WeakKeyDictionary()
+
+
+class edi_gs1_resolver(models.AbstractModel):
+    """Looks up partners by GLN, products by GTIN/default code and contracts by
+    code, remembering every answer (also misses) for the current cursor.
+    warm_*() resolves many codes with one search."""
+    _name = 'edi.gs1.resolver'
+    _description = 'GS1 Code Resolver'
+
+    def _cache(self, kind):
+        return _caches.setdefault(self.env.cr, {}).setdefault((kind, self.env.uid), {})
+
+    @api.model
+    def clear(self, *kinds):
+        """Forget cached lookups of the given kinds ('gln', 'gtin', 'default_code', 'contract'), or all of them."""
+        caches = _caches.get(self.env.cr, {})
+        for key in caches.keys():
+            if not kinds or key[0] in kinds:
+                del caches[key]
+
+    def _warm(self, kind, codes, model, fnames):
+        cache = self._cache(kind)
+        codes = set(c for c in codes if c and c not in cache)
+        if not codes:
+            return
+        for code in codes:
+            cache[code] = []
+        domain = [(fname, 'in', list(codes)) for fname in fnames]
+        domain = ['|'] * (len(domain) - 1) + domain
+        for record in self.env[model].search(domain):
+            for code in set(getattr(record, fname) for fname in fnames):
+                if code in codes:
+                    cache[code].append(record.id)
+
+    @api.model
+    def warm_partners(self, glns):
+        self._warm('gln', glns, 'res.partner', ['gs1_gln'])
+
+    @api.model
+    def warm_products(self, gtins):
+        self._warm('gtin', gtins, 'product.product', ['gs1_gtin13', 'gs1_gtin14'])
+
+    @api.model
+    def warm_default_codes(self, codes):
+        self._warm('default_code', codes, 'product.product', ['default_code'])
+
+    @api.model
+    def partners_by_gln(self, gln):
+        self.warm_partners([gln])
+        return self.env['res.partner'].browse(self._cache('gln').get(gln, []))
+
+    @api.model
+    def products_by_gtin(self, gtin):
+        self.warm_products([gtin])
+        return self.env['product.product'].browse(self._cache('gtin').get(gtin, []))
+
+    @api.model
+    def products_by_default_code(self, code):
+        self.warm_default_codes([code])
+        return self.env['product.product'].browse(self._cache('default_code').get(code, []))
+
+    @api.model
+    def contracts_by_code(self, code):
+        self._warm('contract', [code], 'account.analytic.account', ['code'])
+        return self.env['account.analytic.account'].browse(self._cache('contract').get(code, []))
+
+
+class edi_route(models.Model):
+    _inherit = 'edi.route'
+
+    @api.one
+    def run(self):
+        self.env['edi.gs1.resolver'].clear()
+        return super(edi_route, self).run()
+
+
+class account_analytic_account(models.Model):
+    _inherit = 'account.analytic.account'
+
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        if vals.get('code'):
+            self.env['edi.gs1.resolver'].clear('contract')
+        return super(account_analytic_account, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'code' in vals or 'active' in vals:
+            self.env['edi.gs1.resolver'].clear('contract')
+        return super(account_analytic_account, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['edi.gs1.resolver'].clear('contract')
+        return super(account_analytic_account, self).unlink()
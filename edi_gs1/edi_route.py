@@ -18,21 +18,74 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
-from openerp import models, fields, api, _
-from edifact.helpers import separate_segments, separate_components
+from openerp import models, fields, api, tools, _
+from openerp.addons.edi_route.edi_route import savepoint
+from edifact.helpers import tokenize, iter_segments
+from edifact.writer import SegmentWriter, template
 import base64
 import codecs
+from contextlib import contextmanager
+from itertools import chain
 from datetime import datetime
 import sys
+import weakref
 
 import logging
 _logger = logging.getLogger(__name__)
 
+# {cursor: {message id: (order values, warnings)}}, ORDERS unpacked in an
+# orders_batch() block whose sale orders are not created yet.
+_orders_batches = weakref.WeakKeyDictionary()
+
+
+def deferred_orders(cr):
+    """The orders of the orders_batch() block of the cursor, None outside a block."""
+    return _orders_batches.get(cr)
+
+
+@contextmanager
+def orders_batch(env):
+    """Unpack ORDERS messages in the block without creating their sale orders, and
+    create all of them when the block ends, computing the stored totals once."""
+    if env.cr in _orders_batches:
+        yield
+        return
+    _orders_batches[env.cr] = batch = {}
+    try:
+        yield
+    finally:
+        del _orders_batches[env.cr]
+    if batch:
+        env['edi.message']._gs1_create_orders(batch)
+
+
+# {edi.message class: {edi type xml id: {segment tag: method name}}}, see segment_handler().
+_segment_tables = weakref.WeakKeyDictionary()
+
+
+def segment_handler(edi_type, *tags):
+    """Register an edi.message method as the unpack handler of the segments tags
+    of edi_type messages (xml id of the edi.message.type). It is called as
+    method(segment, state), state being a dict shared by the handlers of one
+    message with the number of segments read so far in 'segment_count'.
+
+    The pseudo tags 'begin' and 'end' are called (with segment None) before the
+    first and after the last segment. A handler that sets state['errors'] to a
+    list makes the following handlers collect their errors (sys.exc_info())
+    there instead of raising them."""
+    def decorate(method):
+        method._gs1_segment_handler = (edi_type, tags)
+        return method
+    return decorate
+
+
 class edi_envelope(models.Model):
     _inherit = 'edi.envelope'
 
     route_type = fields.Selection(selection_add=[('esap20','ESAP 20')])
 
+    _split_batch_size = 100
+
     @api.model
     def _get_edi_type_id(self, edi_type):
         t = self.env['edi.message.type'].search([('name', '=', edi_type)])
@@ -44,99 +97,170 @@ class edi_envelope(models.Model):
     def _fold(self, route): # Folds messages in an envelope
         envelope = super(edi_envelope, self)._fold(route)
         if self.route_type == 'esap20':
-            interchange_control_ref = self.application or ''
-            dt = fields.Datetime.from_string(self.date)
-            date = dt.strftime("%y%m%d")
-            time = dt.strftime("%H%M")
             if not self.ref:
                 self.ref = self.name
-            UNA = "UNA:+.? '"
-            UNB = "UNB+UNOC:3+{sender}:{qualifier}+{receiver}:14+{date}:{time}+{name}++{ref}'".format(
-                sender=envelope.sender.gs1_gln, receiver=envelope.recipient.gs1_gln,
-                date=date, time=time, name=self.ref, ref=interchange_control_ref,
-                qualifier='ZZ' if self.route_id.test_mode else '14')
-            body = ''.join([base64.b64decode(m.body) for m in envelope.edi_message_ids])
-            UNZ = "UNZ+%s+%s'" % (len(envelope.edi_message_ids),self.name)
+            UNB = self._gs1_unb(envelope.sender, envelope.recipient, fields.Datetime.from_string(self.date),
+                self.ref, self.application or '', self.route_id.test_mode)
+            UNZ = self._gs1_unz(len(envelope.edi_message_ids), self.name)
             msg = self.env['edi.message']
-            envelope.body = base64.b64encode(msg._gs1_encode_msg(UNA + UNB) + body + msg._gs1_encode_msg(UNZ))
+            # Message bodies are copied into the interchange one at a time.
+            envelope.write_body_parts(chain(
+                [msg._gs1_encode_msg(UNB)],
+                (m.open_body() for m in envelope.edi_message_ids),
+                [msg._gs1_encode_msg(UNZ)]))
         return envelope
 
-    @api.one
-    def _split(self):
-        if self.route_type == 'esap20':
-            message = ''
-            #~ _logger.warn('body: %s' % base64.b64decode(self.body))
-            msg_count = 0
-            msgs = []
-            segment_check = {}
-            msg_dict = {}
-            for segment_string in separate_segments(base64.b64decode(self.body)):
-                segment = separate_components(segment_string)
-                if segment[0] == 'UNB':
-                    segment_check['UNB'] = True
-                    self.ref = segment[5]
-                    self.sender = self._get_partner(segment[2],'sender')
-                    self.recipient = self._get_partner(segment[3],'recipent')
-                    date = segment[4][0]
-                    time = segment[4][1]
-                    self.date = "20%s-%s-%s %s:%s:00" % (date[:2], date[2:4], date[4:], time[:2], time[2:])
-                    if len(segment) > 7:
-                        self.application = segment[7]
-                elif segment[0] == 'UNH':
-                    edi_type = segment[2][0]
-                    msg_name = segment[1]
-                    message = segment_string
-                    segment_count = 1
-                elif segment[0] == 'UNT':
-                    #skapa message
-                    if segment_count + 1 != int(segment[1]):
-                        raise TypeError('Wrong number of segments! %s %s' % (segment_count, segment), segment)
-                    message += segment_string
-                    msgs.append({
-                        'name': msg_name,
-                        'envelope_id': self.id,
-                        'body': base64.b64encode(message),
-                        'edi_type': self._get_edi_type_id(edi_type),
-                        'sender': self.sender.id,
-                        'recipient': self.recipient.id,
-                        'route_type': self.route_id.route_type,
-                        'route_id': self.route_id.id,
-                    })
-                    message = ''
-                    msg_count += 1
-                elif segment[0] == 'UNZ':
-                    segment_check['UNZ'] = True
-                    if msg_count != int(segment[1]):
-                        raise TypeError('Wrong message count!')
-                elif message:
-                    message += segment_string
-                    segment_count += 1
-
-            if not segment_check.get('UNB'):
-                raise TypeError('UNB segment missing!')
-            elif not segment_check.get('UNZ'):
-                raise TypeError('UNZ segment missing!')
-            #~ _logger.warn('msgs to create: %s' % msgs)
-            for msg_dict in msgs:
-                #Large potential for transaction lock when unpacking messages.
-                #Commit for every message and rollback on error.
-                #Every working message is unpacked.
+    @api.model
+    def _gs1_unb(self, sender, recipient, dt, ref, application='', test_mode=False):
+        """UNA and UNB of an ESAP20 interchange from sender to recipient (partners with GLNs)."""
+        UNA = "UNA:+.? '"
+        UNB = "UNB+UNOC:3+{sender}:{qualifier}+{receiver}:14+{date}:{time}+{name}++{ref}'".format(
+            sender=sender.gs1_gln, receiver=recipient.gs1_gln,
+            date=dt.strftime("%y%m%d"), time=dt.strftime("%H%M"), name=ref, ref=application,
+            qualifier='ZZ' if test_mode else '14')
+        return UNA + UNB
+
+    @api.model
+    def _gs1_unz(self, count, ref):
+        return "UNZ+%s+%s'" % (count, ref)
+
+    @api.multi
+    def _gs1_iter_messages(self, source, refs=None):
+        """Read an ESAP20 interchange from source (file-like or iterable of strings) and
+        yield a values dict for edi.message per UNH..UNT, one message at a time.
+        Interchange errors (missing UNB/UNZ, wrong counts) raise TypeError when reached.
+
+        If refs is given ({'gln': set(), 'gtin': set(), 'default_code': set()}) the GLNs
+        of NAD segments, the GTINs of LIN/PIA segments and the supplier article numbers
+        of PIA segments read so far are added to it."""
+        self.ensure_one()
+        message = None
+        msg_count = 0
+        segment_check = {}
+        edi_types = {}
+        for segment_string, segment in iter_segments(source):
+            if segment[0] == 'UNB':
+                segment_check['UNB'] = True
+                self.ref = segment[5]
+                self.sender = self._get_partner(segment[2],'sender')
+                self.recipient = self._get_partner(segment[3],'recipent')
+                date = segment[4][0]
+                time = segment[4][1]
+                self.date = "20%s-%s-%s %s:%s:00" % (date[:2], date[2:4], date[4:], time[:2], time[2:])
+                if len(segment) > 7:
+                    self.application = segment[7]
+            elif segment[0] == 'UNH':
+                if not segment_check.get('UNB'):
+                    raise TypeError('UNB segment missing!')
+                edi_type = segment[2][0]
+                msg_name = segment[1]
+                message = [segment_string]
+            elif segment[0] == 'UNT':
+                #skapa message
+                if message is None or len(message) + 1 != int(segment[1]):
+                    raise TypeError('Wrong number of segments! %s %s' % (message and len(message), segment), segment)
+                message.append(segment_string)
+                if edi_type not in edi_types:
+                    edi_types[edi_type] = self._get_edi_type_id(edi_type)
+                yield {
+                    'name': msg_name,
+                    'envelope_id': self.id,
+                    'body_raw': ''.join(message),
+                    'edi_type': edi_types[edi_type],
+                    'sender': self.sender.id,
+                    'recipient': self.recipient.id,
+                    'route_type': self.route_id.route_type,
+                    'route_id': self.route_id.id,
+                }
+                message = None
+                msg_count += 1
+            elif segment[0] == 'UNZ':
+                segment_check['UNZ'] = True
+                if msg_count != int(segment[1]):
+                    raise TypeError('Wrong message count!')
+            elif message is not None:
+                message.append(segment_string)
+                if refs is not None:
+                    if segment[0] == 'NAD' and len(segment) > 2 and isinstance(segment[2], list):
+                        refs['gln'].add(segment[2][0])
+                    elif segment[0] == 'LIN' and len(segment) > 3 and isinstance(segment[3], list) and segment[3][1] in ('EN', 'EU'):
+                        refs['gtin'].add(segment[3][0])
+                    elif segment[0] == 'PIA' and len(segment) > 2 and isinstance(segment[2], list) and segment[2][1] in ('EN', 'EU'):
+                        refs['gtin'].add(segment[2][0])
+                    elif segment[0] == 'PIA' and len(segment) > 2 and isinstance(segment[2], list) and segment[2][1] == 'SA' and 'default_code' in refs:
+                        refs['default_code'].add(segment[2][0])
+
+        if not segment_check.get('UNB'):
+            raise TypeError('UNB segment missing!')
+        elif not segment_check.get('UNZ'):
+            raise TypeError('UNZ segment missing!')
+
+    @api.multi
+    def _gs1_create_messages(self, msg_dicts, refs=None):
+        """Create a batch of split messages with chatter and tracking turned off,
+        then unpack them one at a time. A failing message cancels the envelope
+        but does not stop the others. refs (see _gs1_iter_messages) are looked
+        up in bulk before unpacking. The sale orders of ORDERS messages are
+        created together after the last message (see orders_batch)."""
+        self.ensure_one()
+        if refs:
+            resolver = self.env['edi.gs1.resolver']
+            resolver.warm_partners(refs['gln'])
+            resolver.warm_products(refs['gtin'])
+            resolver.warm_default_codes(refs.get('default_code', []))
+        message_obj = self.env['edi.message'].with_context(
+            tracking_disable=True, mail_create_nolog=True, mail_create_nosubscribe=True, mail_notrack=True)
+        msg_ids = []
+        for msg_dict in msg_dicts:
+            try:
+                with savepoint(self.env):
+                    body = msg_dict.pop('body_raw', None)
+                    msg = message_obj.create(msg_dict)
+                    msg.write_body(body)
+                    msg_ids.append(msg.id)
+            except Exception as e:
+                self.route_id.log("Error when creating message '%s' of envelope '%s'" % (msg_dict.get('name'), self.name), sys.exc_info())
+                self.state = 'canceled'
+        with orders_batch(self.env):
+            for msg in self.env['edi.message'].browse(msg_ids):
+                # Every message is unpacked in its own savepoint, a failing
+                # message does not roll back the ones before it.
                 try:
-                    #self._cr.commit()
-                    msg = self.env['edi.message'].create(msg_dict)
-                    #~ _logger.warn('msg created: %s' % msg)
-                    msg.unpack()
+                    with savepoint(self.env):
+                        msg.unpack()
                 except Exception as e:
-                    #self._cr.rollback()
-                    self.route_id.log("Error when reading message '%s' of envelope '%s'" % (msg_dict.get('name'), self.name), sys.exc_info())
+                    self.route_id.log("Error when reading message '%s' of envelope '%s'" % (msg.name, self.name), sys.exc_info())
                     self.state = 'canceled'
+
+    @api.one
+    def _split(self):
+        if self.route_type == 'esap20':
+            # Messages are created in batches as they are read, so memory is
+            # bounded by the batch instead of the interchange. An error in the
+            # interchange trailer (UNZ) rolls back the batches before it, since
+            # split() runs _split in a savepoint.
+            msg_dicts = []
+            refs = {'gln': set(), 'gtin': set(), 'default_code': set()}
+            body = self.open_body()
+            try:
+                for msg_dict in self._gs1_iter_messages(body, refs):
+                    msg_dicts.append(msg_dict)
+                    if len(msg_dicts) >= self._split_batch_size:
+                        self._gs1_create_messages(msg_dicts, refs)
+                        msg_dicts = []
+                        for codes in refs.values():
+                            codes.clear()
+            finally:
+                body.close()
+            if msg_dicts:
+                self._gs1_create_messages(msg_dicts, refs)
         super(edi_envelope, self)._split()
 
     @api.model
     def _get_partner(self, l, part_type):
         _logger.info('get partner %s (%s)' % (l, part_type))
         if l[1] == '14' or (l[1] == 'ZZ' and self.route_id.test_mode):
-            partner = self.env['res.partner'].search([('gs1_gln', '=', l[0])])
+            partner = self.env['edi.gs1.resolver'].partners_by_gln(l[0])
             if len(partner) == 1:
                 return partner
         raise ValueError("Unknown part %s" % (len(l) > 0 and l[0] or "[EMPTY LIST!]"), l, part_type)
@@ -145,28 +269,70 @@ class edi_envelope(models.Model):
         """
             Creates an attachement with the envelope in readable form
         """
-        if self and self.body:
+        if self and self.body_attachment_id:
             self.env['ir.attachment'].create({
                     'name': self.name,
                     'type': 'binary',
-                    'datas': base64.b64encode(base64.b64decode(self.body).replace("'","'\n")),
+                    'datas': base64.b64encode(self.read_body().replace("'","'\n")),
                     'res_model': self._name,
                     'res_id': self.id,
                 })
 
 
-class edi_route(models.Model):
-    _inherit = 'edi.route'
+# Formats of the segments the builders of edi.message return, see edifact.writer.
+_ALI = template("ALI+++%s")
+_UNH = template("UNH+%s+%s:%s:%s:UN:%s")
+_BGM = template("BGM+%s+%s+9")
+_BGM_231 = template("BGM+231+%s+%s")
+_CPS = template("CPS+%s")
+_CNT = template("CNT+%s:%s")
+_DTM = template("DTM+%s:%s:%s")
+_FTX = template("FTX+%s+%s+%s+%s:%s:%s:%s:%s")
+_GIN = template("GIN+BJ+%s")
+_RFF = template("RFF+%s:%s")
+_RFF_LINE = template("RFF+%s:%s:%s")
+_TAX = template("TAX+%s+%s+++:::%.4f+%s")
+_NAD = template("NAD+%s+%s::%s")
+_LIN = template("LIN+%s+%s+%s:%s::9")
+_LIN_NR = template("LIN+%s")
+_MOA = template("MOA+%s:%s")
+_PAC = template("PAC+%s+:52+%s")
+_PAT = template("PAT+%s++%s:%s")
+_PCI = template("PCI+33E")
+_PIA = template("PIA+1+%s:%s")
+_PRI = template("PRI+%s:%s:%s")
+_QTY = template("QTY+%s:%s")
+_QVR = template("QVR+%s:21+CP+%s::9SE")
+_UCI = template("UCI+%s+%s:14+%s:14+%s")
+_UNS = template("UNS+S")
+_UNT = template("UNT+%s+%s")
+
+
+class edi_message_type(models.Model):
+    _inherit = 'edi.message.type'
 
-    route_type = fields.Selection(selection_add=[('esap20','ESAP 20')])
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        self.env['edi.message'].clear_caches()
+        return super(edi_message_type, self).create(vals)
 
+    @api.multi
+    def write(self, vals):
+        self.env['edi.message'].clear_caches()
+        return super(edi_message_type, self).write(vals)
 
-def _escape_string(s):
-    if isinstance(s, basestring):
-        return s.replace('?', '??').replace('+', '?+').replace(':', '?:').replace("'", "?'") #.replace('\n', '') needed?
-    return s
+    @api.multi
+    def unlink(self):
+        self.env['edi.message'].clear_caches()
+        return super(edi_message_type, self).unlink()
 
 
+class edi_route(models.Model):
+    _inherit = 'edi.route'
+
+    route_type = fields.Selection(selection_add=[('esap20','ESAP 20')])
+
 
 class edi_message(models.Model):
     _inherit='edi.message'
@@ -175,17 +341,73 @@ class edi_message(models.Model):
     nad_dp = fields.Many2one(comodel_name='res.partner',help="Delivery party, party to which goods should be delivered, if not identical with consignee.")
     nad_ito = fields.Many2one(comodel_name='res.partner',help="Invoice party, party to which bill should be invoiced, if not identical with consignee.")
 
-    _seg_count = 0
-    _lin_count = 0
+    @api.model
+    def _gs1_segment_handlers(self, edi_type):
+        """{segment tag: handler} registered with segment_handler for the message
+        type edi_type, None if it has none."""
+        table = _segment_tables.get(type(self))
+        if table is None:
+            table = {}
+            # Base classes first, a module loaded later replaces the handler of a tag.
+            for cls in reversed(type(self).__mro__):
+                for name, method in vars(cls).items():
+                    spec = getattr(method, '_gs1_segment_handler', None)
+                    if spec:
+                        for tag in spec[1]:
+                            table.setdefault(spec[0], {})[tag] = name
+            _segment_tables[type(self)] = table
+        xmlid = self._gs1_segment_types(tuple(sorted(table))).get(edi_type.id)
+        if xmlid:
+            return dict((tag, getattr(self, name)) for tag, name in table[xmlid].items())
+
+    @tools.ormcache(skiparg=3)
+    def _gs1_segment_types(self, cr, uid, xmlids):
+        """{edi.message.type id: xml id} of the message types xmlids (a tuple), the
+        types with segment handlers. Cached until a message type changes."""
+        model_data = self.pool['ir.model.data']
+        types = {}
+        for xmlid in xmlids:
+            res_id = model_data.xmlid_to_res_id(cr, uid, xmlid)
+            if res_id:
+                types[res_id] = xmlid
+        return types
+
+    @api.one
+    def _unpack(self):
+        """Unpack messages of types with segment handlers with one dict lookup per
+        segment. Other types go on to the _unpack of other modules."""
+        handlers = self._gs1_segment_handlers(self.edi_type)
+        if handlers is None:
+            return super(edi_message, self)._unpack()
+        state = {'segment_count': 0}
+        if 'begin' in handlers:
+            handlers['begin'](None, state)
+        for segment in self._gs1_get_components():
+            state['segment_count'] += 1
+            handler = handlers.get(segment[0])
+            if handler is None:
+                continue
+            if state.get('errors') is None:
+                handler(segment, state)
+            else:
+                try:
+                    handler(segment, state)
+                except:
+                    state['errors'].append(sys.exc_info())
+        if 'end' in handlers:
+            handlers['end'](None, state)
 
     @api.multi
     def _gs1_get_components(self):
         self.ensure_one()
-        if self.body:
-            segments = []
-            for segment in separate_segments(self._gs1_decode_msg(base64.b64decode(self.body))):
-                segments.append(separate_components(segment))
-            return segments
+        if self.body_attachment_id:
+            return [segment for segment_string, segment in tokenize(self._gs1_decode_msg(self.read_body()))]
+
+    @api.model
+    def _gs1_writer(self):
+        """A SegmentWriter for one outgoing message. The segment builders below
+        return lists of segments for it: msg += self.BGM(...)."""
+        return SegmentWriter()
 
     @api.model
     def _gs1_encode_msg(self, msg):
@@ -198,7 +420,7 @@ class edi_message(models.Model):
         return unicode(msg, 'iso8859-1')
 
     def _get_contract(self, ref):
-        contract = self.env['account.analytic.account'].search([('code', '=', ref)])
+        contract = self.env['edi.gs1.resolver'].contracts_by_code(ref)
         if len(contract) > 1:
             contract = contract[0]
         _logger.info('_get_contract %s %s' % (contract, contract.id))
@@ -209,20 +431,18 @@ class edi_message(models.Model):
         self.env['ir.attachment'].create({
                 'name': self.edi_type,
                 'type': 'binary',
-                'datas': base64.b64encode(base64.b64decode(self.body).replace("'","'\n")),
+                'datas': base64.b64encode(self.read_body().replace("'","'\n")),
                 'res_model': 'edi.message',
                 'res_id': self.id,
             })
     
     def ALI(self, reason):
-        self._seg_count += 1
-        return "ALI+++%s'" % reason
+        return [_ALI % reason]
     
     def UNH(self,edi_type=False, version='D', release='96A', ass_code='EAN005'):
-        self._seg_count += 1
         if not edi_type:
-            edi_type = self.edi_type
-        return "UNH+{ref_no}+{msg_type}:{version}:{release}:UN:{ass_code}'".format(ref_no=self.name,msg_type=edi_type,version=version,release=release, ass_code=ass_code)
+            edi_type = self.edi_type.name
+        return [_UNH % (self.name, edi_type, version, release, ass_code)]
 
     def BGM(self, doc_code=False, doc_no=False, status=''):
         #TODO: look up test mode on route and add to BGM
@@ -234,27 +454,23 @@ class edi_message(models.Model):
         # BGM+231::9+201101311720471+4'
         # doc_code 351 Despatch advice, Document/message by means of which the seller or consignor informs the consignee about the despatch of goods.
         # BGM+351+SO069412+9'
-        self._seg_count += 1
         if not doc_code or not doc_no:
             raise Warning("edi_message.BGM(doc_code=%s, doc_no=%s, status=%s): Missing required arguments." % (doc_code, doc_no, status))
         if doc_code == 231: # Resp agency = EAN/GS1 (9), Message function code = Change (4)
-            return "BGM+231+{doc_no}+{status}'".format(doc_no=_escape_string(doc_no), status = status)
-        return "BGM+{doc_code}+{doc_no}+9'".format(doc_code=doc_code, doc_no=_escape_string(doc_no))
+            return [_BGM_231 % (doc_no, status)]
+        return [_BGM % (doc_code, doc_no)]
 
     def CPS(self, level):
         """To identify the sequence in which physical packing is presented in the consignment,
         and optionally to identify the hierarchical relationship between packing layers."""
-        self._seg_count += 1
-        return "CPS+%s'" % (level)
+        return [_CPS % level]
 
     def CNT(self, qualifier, value):
-        self._seg_count += 1
         if int(value) == value:
             value = int(value)
-        return "CNT+%s:%s'" % (qualifier, value)
+        return [_CNT % (qualifier, value)]
 
     def DTM(self, func_code, dt=False, format=102):
-        self._seg_count += 1
         #2   Delivery date/time, requested
         #11  Despatch date and or time - (2170) Date/time on which the goods are or are expected to be despatched or shipped.
         #13  Terms net due date - Date by which payment must be made.
@@ -272,16 +488,14 @@ class edi_message(models.Model):
             dt = dt.strftime('%Y%m%d')
         elif format == 203:
             dt = dt.strftime('%Y%m%d%H%M')
-        return "DTM+%s:%s:%s'" % (func_code, dt, format)
+        return [_DTM % (func_code, dt, format)]
 
     def FTX(self, msg1, msg2='', msg3='', msg4='', msg5='', subj='ZZZ', func=1, ref='001'):
-        self._seg_count += 1
-        return "FTX+%s+%s+%s+%s:%s:%s:%s:%s'" % (subj, func, ref, _escape_string(msg1), _escape_string(msg2), _escape_string(msg3), _escape_string(msg4), _escape_string(msg5))
+        return [_FTX % (subj, func, ref, msg1, msg2, msg3, msg4, msg5)]
 
     def GIN(self, sscc):
-        self._seg_count += 1
         #BJ         Serial shipping container code
-        return "GIN+BJ+%s'" % sscc
+        return [_GIN % sscc]
 
     #CR = Customer Reference
     def RFF(self, ref, qualifier='CR', line=None):
@@ -290,10 +504,9 @@ class edi_message(models.Model):
         # AAS   Transport document number, Reference assigned by the carrier or his agent to the transport document.
         # CT    Contract Number
         # DQ    Delivery note number
-        self._seg_count += 1
         if line:
-            return "RFF+%s:%s:%s'" % (qualifier, ref, line)
-        return "RFF+%s:%s'" % (qualifier, ref)
+            return [_RFF_LINE % (qualifier, ref, line)]
+        return [_RFF % (qualifier, ref)]
     
     @api.model
     def name_to_number(self, name):
@@ -310,19 +523,17 @@ class edi_message(models.Model):
         raise Warning("Couldn't find tax with name '%s'." % name)
 
     def TAX(self, rate, tax_type = 'VAT', qualifier = 7, category = 'S'):
-        self._seg_count += 1
         #qualifier
         #   7 = tax
-        return "TAX+%s+%s+++:::%.4f+%s'" % (qualifier, tax_type, rate, category)
+        return [_TAX % (qualifier, tax_type, float(rate), category)]
 
     def _NAD(self, role, partner, type='GLN'):
-        self._seg_count += 1
         if type == 'GLN':
             party_id = partner.gs1_gln
             if not party_id:
                 raise Warning('NAD missing GLN role=%s partner=%s' % (role, partner.name))
             code = 9
-        return "NAD+%s+%s::%s'" % (role, party_id, code)
+        return [_NAD % (role, party_id, code)]
 
     def NAD_SU(self, type='GLN'):
         return self._NAD('SU', self.consignor_id, type)
@@ -338,12 +549,12 @@ class edi_message(models.Model):
         return self._NAD('CN', self.consignee_id, type)  # ????
 
     #code = error/status code
-    def LIN(self, line=None, code=''):
-        self._seg_count += 1
-        self._lin_count += 1
+    def LIN(self, msg, line=None, code=''):
+        """Line item of the SegmentWriter msg, numbered with its lin_count."""
         item_nr_type = 'EU'
+        msg.lin_count += 1
         if not line:
-            return "LIN+%s'" % self._lin_count
+            return [_LIN_NR % msg.lin_count]
         elif line._name == 'sale.order.line':
             if line.product_uom_qty <= 0:
                 code = 7 # Not accepted
@@ -351,19 +562,16 @@ class edi_message(models.Model):
                 code = 3 # Quantity changed
             else:
                 code = 5 # Accepted without amendment
-        return "LIN+%s+%s+%s:%s::%s'" %(self._lin_count, code, line.product_id.gs1_gtin14 or line.product_id.gs1_gtin13, item_nr_type, 9)
+        return [_LIN % (msg.lin_count, code, line.product_id.gs1_gtin14 or line.product_id.gs1_gtin13 or '', item_nr_type)]
 
     def MOA(self, amount, qualifier = 203):
-        self._seg_count += 1
-        return "MOA+%s:%s'" % (qualifier, amount)
+        return [_MOA % (qualifier, amount)]
 
     def PAC(self, amount=1, packaging_type='PX'):
-        self._seg_count += 1
         #PX     Pallet
-        return "PAC+%s+:52+%s'" % (amount, packaging_type)
+        return [_PAC % (amount, packaging_type)]
 
     def PAT(self, pttq=3, ptr=66, tr=1):
-        self._seg_count += 1
         #pttq   4279    Payment terms type qualifier
             #3 Fixed date - Payments are due on the fixed date specified.
         #ptr    2475    Payment time reference, coded
@@ -371,12 +579,11 @@ class edi_message(models.Model):
         #tr     2009    Time relation, coded
             #1  Date of order - Payment time reference is date of order.
 
-        return "PAT+%s++%s:%s'" % (pttq, ptr, tr)
+        return [_PAT % (pttq, ptr, tr)]
 
     def PCI(self):
-        self._seg_count += 1
         #33E        Marked with serial shipping container code (EAN Code)
-        return "PCI+33E'"
+        return [_PCI]
 
     def _get_customer_product_code(self, product, customer):
         #TODO: Create module that hooks this up with product_customer_code
@@ -392,9 +599,8 @@ class edi_message(models.Model):
         elif code == 'NB':
             prod_nr = product
         if prod_nr:
-            self._seg_count += 1
-            return "PIA+1+%s:%s'" % (prod_nr, code)
-        return ""
+            return [_PIA % (prod_nr, code)]
+        return []
         #raise Warning("PIA: couldn't find product code (%s) for %s (id: %s)" % (code, product.name, product.id))
 
     def PRI(self, amount, ptype='CT', qualifier='AAA'):
@@ -402,12 +608,9 @@ class edi_message(models.Model):
         #   CT  Contract price
         #qualifier
         #   AAA Calculation net
-        self._seg_count += 1
-        return "PRI+%s:%s:%s'" % (qualifier, amount, ptype)
+        return [_PRI % (qualifier, amount, ptype)]
 
     def QTY(self, line, code = None):
-        self._seg_count += 1
-
         if line._name == 'account.invoice.line':
             code = 47
             qty = line.quantity
@@ -427,7 +630,7 @@ class edi_message(models.Model):
             qty = int(qty)
         if not code:
             code = 21
-        return "QTY+%s:%s'" % (code, qty)
+        return [_QTY % (code, qty)]
 
     def QVR(self, diff, reason = 'AV'):
         #AS     Artikeln har utgått ur sortimentet
@@ -445,27 +648,24 @@ class edi_message(models.Model):
         #Z8     Beställningsvara
         #Z9     Restnoterad från tillverkaren
         #ZZ     Annan orsak
-        self._seg_count += 1
-        return "QVR+%s:21+CP+%s::9SE'" % (diff, reason)
+        return [_QVR % (diff, reason)]
 
     def UCI(self, ref, sender, recipient, state=8):
-        self._seg_count += 1
-        return "UCI+{ref}+{sender}:14+{recipient}:14+{state}'".format(ref=ref, sender=sender.gs1_gln, recipient=recipient.gs1_gln, state=state)
+        return [_UCI % (ref, sender.gs1_gln or '', recipient.gs1_gln or '', state)]
 
     def UNS(self):
-        self._seg_count += 1
-        return "UNS+S'"
+        return [_UNS]
 
-    def UNT(self):
-        self._seg_count += 1
-        return "UNT+{count}+{ref}'".format(count=self._seg_count,ref=self.name)
+    def UNT(self, msg):
+        """Message trailer of the SegmentWriter msg, the segment count includes UNT."""
+        return [_UNT % (msg.seg_count + 1, self.name)]
 
 
     def _get_partner(self, l):
         #~ _logger.warn('get partner %s' % l)
         partner = None
         if l[2] == '9':
-            partner = self.env['res.partner'].search([('gs1_gln', '=', l[0])])
+            partner = self.env['edi.gs1.resolver'].partners_by_gln(l[0])
         #~ _logger.warn(partner)
         if len(partner) == 1:
             return partner[0]
@@ -479,9 +679,9 @@ class edi_message(models.Model):
     def _get_product(self, l):
         product = None
         if l[1] == 'EN' or l[1] == 'EU':  # Axfood ORDERS use EU
-            product = self.env['product.product'].search(['|', ('gs1_gtin13', '=', l[0]), ('gs1_gtin14', '=', l[0])])
+            product = self.env['edi.gs1.resolver'].products_by_gtin(l[0])
         elif l[1] == 'SA':
-            product = self.env['product.product'].search([('default_code', '=', l[0])])
+            product = self.env['edi.gs1.resolver'].products_by_default_code(l[0])
         if product and product.ensure_one():
             return product
         raise ValueError('Product not found! GTIN: %s' % l)
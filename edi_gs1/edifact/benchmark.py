@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the EDIFACT parse and build paths, on the sample interchanges in doc/edi/.
+
+The pure Python parts (tokenizer, streaming reader, the former regex.split
+helpers) run without an Odoo server. From the edi_gs1 directory:
+
+    python -m edifact.benchmark [file ...]
+
+With --database the ORM parts run as well: the esap20 split (reading and
+splitting an interchange into edi.message), the segment builders of the
+INVOIC/DESADV packers and, if the database has suitable records, packing an
+invoice and a picking. Everything is done in one transaction that is rolled
+back, so use a test database:
+
+    python -m edifact.benchmark --database test_edi -c /etc/odoo/openerp-server.conf
+
+Every line reports operations per second and the peak memory (max RSS) of
+the process after the benchmark, with the growth during it in brackets.
+"""
+
+import argparse
+import glob
+import os
+import resource
+import sys
+import timeit
+from cStringIO import StringIO
+
+try:
+    import regex as _re
+except ImportError:
+    import re as _re
+
+from helpers import tokenize, iter_segments, separate_segments, separate_components
+from writer import SegmentWriter, template
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'doc', 'edi')
+
+
+def legacy_separate_segments(src_string, segment_terminator='\'', release_character='?'):
+    """separate_segments as it was before the tokenizer, kept for comparison."""
+    separator_pattern = r'(?<!\{rc}){st}'.format(st=segment_terminator, rc=release_character)
+    raw_segments = _re.split(separator_pattern, src_string)
+    return [raw_segment.strip().replace('\\n', '') + segment_terminator for raw_segment in raw_segments if not raw_segment == '']
+
+
+def legacy_separate_components(src_string, data_element_separator='+', component_data_element_separator=':', segment_terminator='\'', release_character='?'):
+    """separate_components as it was before the tokenizer, kept for comparison."""
+    output = []
+    if src_string[-1] == '\'':
+        src_string = src_string[0:-1]
+    simple_separator_pattern = r'(?<!\{rc})\{des}'.format(des=data_element_separator, rc=release_character)
+    simple_data_elements = _re.split(simple_separator_pattern, src_string)
+    component_separator_pattern = r'(?<!\{rc})\{cdes}'.format(cdes=component_data_element_separator, rc=release_character)
+    for simple_data_element in simple_data_elements:
+        components = _re.split(component_separator_pattern, simple_data_element)
+        if len(components) == 1:
+            output.append(simple_data_element)
+        else:
+            output.append(components)
+    return output
+
+
+def parse_legacy(data):
+    return [legacy_separate_components(s) for s in legacy_separate_segments(data)]
+
+
+def parse_helpers(data):
+    return [separate_components(s) for s in separate_segments(data)]
+
+
+def parse_tokenize(data):
+    return [segment for segment_string, segment in tokenize(data)]
+
+
+def parse_stream(data, chunk_size=65536):
+    """Read the interchange like the esap20 _split does, a chunk at a time."""
+    return [segment for segment_string, segment in iter_segments(StringIO(data), chunk_size)]
+
+
+def sample_files(paths=None):
+    if paths:
+        return paths
+    return sorted(f for f in glob.glob(os.path.join(SAMPLE_DIR, '*')) if not f.endswith('.py'))
+
+
+def max_rss():
+    """Peak resident memory of the process in KB (Linux reports KB, macOS bytes)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(func, number, repeat):
+    """Return (best seconds per call, peak RSS in KB, growth of the peak in KB during the calls)."""
+    before = max_rss()
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    after = max_rss()
+    return best, after, after - before
+
+
+def report(name, ops, unit, seconds, peak, growth):
+    print '%-44s %12.1f %-10s %10.3f ms %9d KB (+%d)' % (name[:44], ops / seconds, unit + '/s', seconds * 1000.0, peak, growth)
+
+
+def header(title):
+    print
+    print title
+    print '%-44s %23s %13s %20s' % ('benchmark', 'ops/sec', 'per call', 'peak memory')
+
+
+def run(paths=None, repeat=5):
+    """The tokenizer against the former regex.split helpers."""
+    print '%-12s %8s %10s %12s %12s %12s %8s' % ('file', 'bytes', 'segments', 'legacy ms', 'helpers ms', 'tokenize ms', 'speedup')
+    for path in sample_files(paths):
+        data = open(path, 'rb').read()
+        segments = parse_tokenize(data)
+        # The legacy helpers mangle UNA, emit an empty segment after a trailing newline and keep release characters.
+        if segments[1:] != [s for s in parse_legacy(data)[1:] if s != ['']]:
+            print '%-12s differs from legacy output' % os.path.basename(path)
+        number = max(1, 20000 / (len(segments) or 1))
+        timings = []
+        for func in (parse_legacy, parse_helpers, parse_tokenize):
+            best = min(timeit.repeat(lambda: func(data), number=number, repeat=repeat))
+            timings.append(best * 1000.0 / number)
+        print '%-12s %8d %10d %12.3f %12.3f %12.3f %7.1fx' % (
+            os.path.basename(path)[:12], len(data), len(segments), timings[0], timings[1], timings[2], timings[0] / timings[2])
+
+
+def run_parse(paths=None, repeat=5):
+    """Segments per second of the parse paths used by the routes."""
+    header('Parse (segments)')
+    for path in sample_files(paths):
+        data = open(path, 'rb').read()
+        name = os.path.basename(path)
+        segments = len(parse_tokenize(data))
+        number = max(1, 20000 / (segments or 1))
+        for label, func in (
+                ('tokenize', lambda: parse_tokenize(data)),
+                ('iter_segments 64k', lambda: parse_stream(data)),
+                ('iter_segments 1k', lambda: parse_stream(data, 1024)),
+                ('separate_segments/components', lambda: parse_helpers(data))):
+            report('%s %s' % (name, label), segments, 'segments', *measure(func, number, repeat))
+
+
+def legacy_escape(s):
+    if isinstance(s, basestring):
+        return s.replace('?', '??').replace('+', '?+').replace(':', '?:').replace("'", "?'")
+    return s
+
+
+def write_legacy(lines):
+    """An INVOIC-shaped body the way the segment builders built it before SegmentWriter."""
+    msg = "UNH+BENCH+INVOIC:D:96A:UN:EAN008'"
+    msg += "BGM+380+%s+9'" % legacy_escape('BENCH/0001')
+    for i in range(1, lines + 1):
+        msg += "LIN+%s++%s:%s::%s'" % (i, '7310000000040', 'EU', 9)
+        msg += "PIA+1+%s:%s'" % ('ART-%s' % i, 'SA')
+        msg += "QTY+%s:%s'" % (47, 3)
+        msg += "MOA+%s:%s'" % (203, 37.5)
+        msg += "PRI+%s:%s:%s'" % ('AAA', 12.5, 'CT')
+        msg += "FTX+ZZZ+1+001+%s::::'" % legacy_escape("Mr O'Neil's order: 3+3")
+    msg += "CNT+2:%s'" % lines
+    msg += "UNT+%s+BENCH'" % (lines * 6 + 4)
+    return msg.decode('utf-8').encode('iso8859-1', 'ignore')
+
+
+_UNH = template('UNH+%s+%s:%s:%s:UN:%s')
+_BGM = template('BGM+%s+%s+9')
+_LIN = template('LIN+%s+%s+%s:%s::9')
+_PIA = template('PIA+1+%s:%s')
+_QTY = template('QTY+%s:%s')
+_MOA = template('MOA+%s:%s')
+_PRI = template('PRI+%s:%s:%s')
+_FTX = template('FTX+%s+%s+%s+%s:%s:%s:%s:%s')
+_CNT = template('CNT+%s:%s')
+_UNT = template('UNT+%s+%s')
+
+
+def write_writer(lines):
+    """The same body the way the segment builders of edi.message build it now."""
+    msg = SegmentWriter()
+    msg += [_UNH % ('BENCH', 'INVOIC', 'D', '96A', 'EAN008')]
+    msg += [_BGM % (380, 'BENCH/0001')]
+    for i in range(1, lines + 1):
+        msg.lin_count += 1
+        msg += [_LIN % (msg.lin_count, '', '7310000000040', 'EU')]
+        msg += [_PIA % ('ART-%s' % i, 'SA')]
+        msg += [_QTY % (47, 3)]
+        msg += [_MOA % (203, 37.5)]
+        msg += [_PRI % ('AAA', 12.5, 'CT')]
+        msg += [_FTX % ('ZZZ', 1, '001', "Mr O'Neil's order: 3+3", '', '', '', '')]
+    msg += [_CNT % (2, msg.lin_count)]
+    msg += [_UNT % (msg.seg_count + 1, 'BENCH')]
+    return msg.getvalue()
+
+
+def run_write(repeat=5, lines=(10, 200, 2000)):
+    """Segments per second of building a message, string concatenation against SegmentWriter."""
+    header('Write (segments)')
+    for n in lines:
+        if write_legacy(n) != write_writer(n):
+            print '%s lines: SegmentWriter output differs from the legacy builders' % n
+        segments = n * 6 + 4
+        number = max(1, 20000 / segments)
+        report('INVOIC %s lines legacy' % n, segments, 'segments', *measure(lambda: write_legacy(n), number, repeat))
+        report('INVOIC %s lines SegmentWriter' % n, segments, 'segments', *measure(lambda: write_writer(n), number, repeat))
+
+
+def _interchanges(paths):
+    """The sample files that are ESAP20 interchanges (UNB..UNZ), as (name, data)."""
+    for path in sample_files(paths):
+        data = open(path, 'rb').read()
+        if 'UNB+' in data[:200]:
+            yield os.path.basename(path), data
+
+
+def _savepoint(env, func):
+    """Run func and roll back what it did, so every repetition starts from the same database."""
+    def wrapped():
+        env.cr.execute('SAVEPOINT edi_benchmark')
+        try:
+            func()
+        finally:
+            env.cr.execute('ROLLBACK TO SAVEPOINT edi_benchmark')
+            env.invalidate_all()
+    return wrapped
+
+
+def _seed(env, interchanges):
+    """An esap20 route in test mode and partners for the GLNs of the interchanges."""
+    route = env['edi.route'].create({'name': 'Benchmark', 'route_type': 'esap20', 'test_mode': True})
+    glns = set()
+    for name, data in interchanges:
+        for segment_string, segment in tokenize(data):
+            if segment[0] == 'UNB':
+                glns.update([segment[2][0], segment[3][0]])
+            elif segment[0] == 'NAD' and isinstance(segment[2], list):
+                glns.add(segment[2][0])
+    partner_obj = env['res.partner']
+    for gln in glns:
+        if not partner_obj.search([('gs1_gln', '=', gln)]):
+            partner_obj.create({'name': 'Benchmark %s' % gln, 'gs1_gln': gln})
+    return route
+
+
+def bench_split(env, route, interchanges, repeat):
+    header('esap20 split (messages)')
+    envelope_obj = env['edi.envelope']
+    for name, data in interchanges:
+        envelope = envelope_obj.create({'name': name, 'route_id': route.id, 'route_type': 'esap20'})
+        try:
+            messages = len(list(envelope._gs1_iter_messages(StringIO(data))))
+        except (TypeError, ValueError) as e:
+            print '%-44s skipped: %s' % (name, e)
+            continue
+
+        def read():
+            for msg_dict in envelope._gs1_iter_messages(StringIO(data)):
+                pass
+
+        def split():
+            e = envelope_obj.create({'name': name, 'route_id': route.id, 'route_type': 'esap20'})
+            e.write_body(data)
+            e.split()
+
+        report('%s _gs1_iter_messages' % name, messages, 'messages', *measure(read, 1, repeat))
+        report('%s split (incl. unpack)' % name, messages, 'messages', *measure(_savepoint(env, split), 1, repeat))
+
+
+def bench_builders(env, repeat, lines=200):
+    """An INVOIC-shaped body of lines LIN groups built with the segment builders, on records that are never saved."""
+    header('Segment builders (segments)')
+    product = env['product.product'].search([], limit=1)
+    partner = env['res.partner'].search([('gs1_gln', '!=', False)], limit=1)
+    if not product or not partner:
+        print 'skipped: needs a product and a partner with a GLN'
+        return
+    message = env['edi.message'].new({'name': 'BENCH', 'consignor_id': partner.id, 'consignee_id': partner.id})
+    inv_line = env['account.invoice.line'].new({'name': product.name, 'product_id': product.id, 'quantity': 3.0, 'price_unit': 12.5})
+    move = env['stock.move'].new({'name': product.name, 'product_id': product.id, 'product_uom_qty': 3.0})
+
+    def build():
+        msg = message._gs1_writer()
+        msg += message.UNH('INVOIC', ass_code='EAN008')
+        msg += message.BGM(380, 'BENCH/0001', 9)
+        msg += message.DTM(137)
+        msg += message.RFF('BENCH', 'ON')
+        msg += message.NAD_BY(partner)
+        msg += message.NAD_SU()
+        msg += message.PAT()
+        for i in range(lines):
+            msg += message.LIN(msg, inv_line)
+            msg += message.PIA(product, 'SA')
+            msg += message.QTY(inv_line)
+            msg += message.QTY(move)
+            msg += message.MOA(37.5)
+            msg += message.PRI(12.5)
+            msg += message.RFF('BENCH', 'ON', i + 1)
+        msg += message.UNS()
+        msg += message.CNT(2, lines)
+        msg += message.MOA(37.5 * lines, 9)
+        msg += message.UNT(msg)
+        return msg.getvalue()
+
+    segments = 10 + 7 * lines
+    report('INVOIC %s lines' % lines, segments, 'segments', *measure(build, 5, repeat))
+
+
+def bench_pack(env, repeat):
+    """Pack the invoice and the picking with the most lines, if there are any with GLNs."""
+    header('Pack (messages)')
+    cases = [
+        ('INVOIC', 'edi_gs1.edi_message_type_invoic', 'account.invoice',
+            [('type', 'in', ('out_invoice', 'out_refund')), ('state', 'in', ('open', 'paid'))], 'invoice_line'),
+        ('DESADV', 'edi_gs1.edi_message_type_desadv', 'stock.picking',
+            [('picking_type_id.code', '=', 'outgoing'), ('state', '=', 'done')], 'move_lines'),
+    ]
+    sender = env.ref('base.main_partner')
+    for label, edi_type, model, domain, lines in cases:
+        record = max(env[model].search(domain, limit=50) or [None], key=lambda r: r and len(r[lines]))
+        if not record:
+            print '%-44s skipped: no %s' % (label, model)
+            continue
+        partner = record.partner_id.commercial_partner_id
+
+        def pack():
+            message = env['edi.message'].create({
+                'name': 'BENCH',
+                'edi_type': env.ref(edi_type).id,
+                'model': model,
+                'res_id': record.id,
+                'route_type': 'esap20',
+                'sender': sender.id,
+                'recipient': partner.id,
+                'consignor_id': sender.id,
+                'consignee_id': partner.id,
+            })
+            message._pack()
+
+        try:
+            _savepoint(env, pack)()
+        except Exception as e:
+            print '%-44s skipped: %s' % ('%s %s' % (label, record.name), e)
+            continue
+        report('%s %s (%s lines)' % (label, record.name, len(record[lines])), 1, 'messages', *measure(_savepoint(env, pack), 1, repeat))
+
+
+def run_orm(database, config=None, paths=None, repeat=3):
+    import openerp
+    from openerp import api, SUPERUSER_ID
+    if config:
+        openerp.tools.config.parse_config(['-c', config])
+    registry = openerp.modules.registry.RegistryManager.get(database)
+    cr = registry.cursor()
+    try:
+        with api.Environment.manage():
+            env = api.Environment(cr, SUPERUSER_ID, {'tracking_disable': True})
+            interchanges = list(_interchanges(paths))
+            route = _seed(env, interchanges)
+            bench_split(env, route, interchanges, repeat)
+            bench_builders(env, repeat)
+            bench_pack(env, repeat)
+    finally:
+        cr.rollback()
+        cr.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the EDIFACT parse and build paths.')
+    parser.add_argument('files', nargs='*', help='interchanges to use instead of doc/edi/*')
+    parser.add_argument('-d', '--database', help='also run the ORM benchmarks in this (test) database, rolled back afterwards')
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    run(args.files, args.repeat)
+    run_parse(args.files, args.repeat)
+    run_write(args.repeat)
+    if args.database:
+        run_orm(args.database, args.config, args.files, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
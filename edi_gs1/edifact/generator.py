@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Write synthetic ESAP20 interchanges for load testing routes (see edi.gs1.generator).
+
+Seeds the partners and products the interchanges refer to and commits them,
+so use a test database. From the edi_gs1 directory:
+
+    python -m edifact.generator -d test_edi -c /etc/odoo/openerp-server.conf \\
+        --type ORDERS --messages 80 --lines 50 --out /srv/sftp/test/in
+
+Point the directory in of an SFTP route at the output directory (or copy the
+files there) and run the route.
+"""
+
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic ESAP20 interchanges.')
+    parser.add_argument('-d', '--database', required=True, help='(test) database to seed partners and products in')
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('-t', '--type', default='ORDERS', choices=['ORDERS', 'INVOIC', 'DESADV'])
+    parser.add_argument('-n', '--messages', type=int, default=10, help='messages per interchange')
+    parser.add_argument('-m', '--lines', type=int, default=20, help='mean LIN per message')
+    parser.add_argument('-i', '--interchanges', type=int, default=1)
+    parser.add_argument('--stores', type=int, default=20)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--out', default='.', help='directory to write the interchanges to')
+    args = parser.parse_args(argv)
+
+    import openerp
+    from openerp import api, SUPERUSER_ID
+    if args.config:
+        openerp.tools.config.parse_config(['-c', args.config])
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    cr = registry.cursor()
+    try:
+        with api.Environment.manage():
+            env = api.Environment(cr, SUPERUSER_ID, {'tracking_disable': True})
+            generator = env['edi.gs1.generator']
+            for i in range(args.interchanges):
+                print generator.generate(args.type, args.messages, args.lines, args.out,
+                    stores=args.stores, products=args.products, seed=args.seed + i)
+                cr.commit()
+    finally:
+        cr.close()
+
+
+if __name__ == '__main__':
+    main()
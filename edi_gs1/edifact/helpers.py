@@ -1,44 +1,161 @@
 # -*- coding: utf-8 -*-
 """Provides helper functions."""
 
+import re
+from collections import namedtuple
+
 import logging
 _logger = logging.getLogger(__name__)
 
+from exceptions import MissingSegmentAtPositionError
 
-try:
-    import regex
-except ImportError as e:
-    _logger.error('regex missing, pip install regex (%s)' % e) 
 
-from exceptions import MissingSegmentAtPositionError
+# Service string advice, in the order the characters appear after 'UNA'.
+ServiceChars = namedtuple('ServiceChars', ['component', 'element', 'decimal', 'release', 'reserved', 'segment'])
 
+DEFAULT_SERVICE_CHARS = ServiceChars(':', '+', '.', '?', ' ', '\'')
 
-def separate_segments(src_string, segment_terminator='\'', release_character='?'):
-    """Separate the segments in an EDIFACT message string."""
-    separator_pattern = r'(?<!\{rc}){st}'.format(st=segment_terminator, rc=release_character)
-    raw_segments = regex.split(separator_pattern, src_string)
-    return [raw_segment.strip().replace('\\n', '') + segment_terminator for raw_segment in raw_segments if not raw_segment == '']
+_scanners = {}
 
 
-def separate_components(src_string, data_element_separator='+', component_data_element_separator=':', segment_terminator='\'', release_character='?'):
-    """Separate the components in an EDIFACT segment string."""
-    output = []
+def parse_una(src_string):
+    """Return the ServiceChars of an interchange, read from its UNA segment if it has one."""
+    head = src_string[:64].lstrip()
+    if head[:3] == 'UNA' and len(head) >= 9:
+        return ServiceChars(*head[3:9])
+    return DEFAULT_SERVICE_CHARS
+
+
+def _get_scanner(service_chars):
+    """Compile (once per set of service characters) the pattern used when release characters are present.
+
+    Every match is one value followed by the separator that ended it ('' at end of input).
+    A release character always consumes the next character, so '??' is a released
+    release character and does not protect the separator after it."""
+    scanner = _scanners.get(service_chars)
+    if not scanner:
+        sc = service_chars
+        delimiters = ''.join(re.escape(c) for c in (sc.element, sc.component, sc.segment))
+        release = re.escape(sc.release)
+        token = re.compile(r'((?:[^%s%s]|%s.)*)([%s]|$)' % (delimiters, release, release, delimiters), re.S)
+        unescape = re.compile(r'%s(.)' % release, re.S)
+        scanner = _scanners[service_chars] = (token, unescape)
+    return scanner
+
+
+def _join_components(element):
+    if len(element) == 1:
+        return element[0]
+    return element
+
 
-    if src_string[-1] == '\'':
-        src_string = src_string[0:-1]
+def tokenize(src_string, service_chars=None):
+    """Separate an EDIFACT string in segments, data elements and components in one scan.
 
-    simple_separator_pattern = r'(?<!\{rc})\{des}'.format(des=data_element_separator, rc=release_character)
-    simple_data_elements = regex.split(simple_separator_pattern, src_string)
+    Yields (segment_string, segment) for every segment. segment_string is the raw
+    segment, stripped and terminated, as returned by separate_segments. segment is
+    a list of data elements as returned by separate_components, with release
+    characters removed. The UNA segment, if present, is yielded as ['UNA', advice].
+    """
+    if service_chars is None:
+        service_chars = parse_una(src_string)
+    sc = service_chars
+    if '\\n' in src_string:
+        src_string = src_string.replace('\\n', '')
+    pos = 0
+    stripped = src_string.lstrip()
+    if stripped[:3] == 'UNA':
+        pos = len(src_string) - len(stripped) + 9
+        yield stripped[:9], ['UNA', stripped[3:8]]
 
-    component_separator_pattern = r'(?<!\{rc})\{cdes}'.format(cdes=component_data_element_separator, rc=release_character)
-    for simple_data_element in simple_data_elements:
-        components = regex.split(component_separator_pattern, simple_data_element)
-        if len(components) == 1:
-            output.append(simple_data_element)
-        else:
-            output.append(components)
+    if src_string.find(sc.release, pos) < 0:
+        # Fast path, nothing is escaped so plain splits are exact.
+        for raw_segment in src_string[pos:].split(sc.segment):
+            raw_segment = raw_segment.strip()
+            if raw_segment:
+                yield raw_segment + sc.segment, [
+                    data_element.split(sc.component) if sc.component in data_element else data_element
+                    for data_element in raw_segment.split(sc.element)]
+        return
 
-    return output
+    token, unescape = _get_scanner(sc)
+    segment_start = pos
+    elements = []
+    components = []
+    for match in token.finditer(src_string, pos):
+        value, delimiter = match.group(1), match.group(2)
+        if sc.release in value:
+            value = unescape.sub(r'\1', value)
+        components.append(value)
+        if delimiter == sc.component:
+            continue
+        elements.append(components)
+        components = []
+        if delimiter == sc.element:
+            continue
+        # End of segment (or of input)
+        raw_segment = src_string[segment_start:match.start(2)].strip()
+        segment_start = match.end()
+        if raw_segment:
+            elements[0][0] = elements[0][0].lstrip()
+            elements[-1][-1] = elements[-1][-1].rstrip()
+            yield raw_segment + sc.segment, [_join_components(e) for e in elements]
+        elements = []
+        if not delimiter:
+            break
+
+
+def _last_terminator(src_string, service_chars):
+    """Return the position of the last segment terminator that is not released, or -1."""
+    end = src_string.rfind(service_chars.segment)
+    while end >= 0:
+        start = end
+        while start > 0 and src_string[start - 1] == service_chars.release:
+            start -= 1
+        if (end - start) % 2 == 0:
+            return end
+        end = src_string.rfind(service_chars.segment, 0, start)
+    return -1
+
+
+def iter_segments(source, chunk_size=65536):
+    """Tokenize an interchange read piecewise, holding no more than one chunk plus one segment in memory.
+
+    source is a file-like object or an iterable of strings. Yields the same
+    (segment_string, segment) pairs as tokenize.
+    """
+    if hasattr(source, 'read'):
+        source = iter(lambda read=source.read: read(chunk_size), '')
+    service_chars = None
+    buf = ''
+    for chunk in source:
+        buf += chunk
+        if service_chars is None:
+            if len(buf.lstrip()) < 9:
+                continue
+            service_chars = parse_una(buf)
+        end = _last_terminator(buf, service_chars)
+        if end >= 0:
+            for token in tokenize(buf[:end + 1], service_chars):
+                yield token
+            buf = buf[end + 1:]
+    if buf.strip():
+        for token in tokenize(buf, service_chars or parse_una(buf)):
+            yield token
+
+
+def separate_segments(src_string, segment_terminator='\'', release_character='?'):
+    """Separate the segments in an EDIFACT message string."""
+    service_chars = parse_una(src_string)._replace(segment=segment_terminator, release=release_character)
+    return [segment_string for segment_string, segment in tokenize(src_string, service_chars)]
+
+
+def separate_components(src_string, data_element_separator='+', component_data_element_separator=':', segment_terminator='\'', release_character='?'):
+    """Separate the components in an EDIFACT segment string."""
+    service_chars = ServiceChars(component_data_element_separator, data_element_separator, '.', release_character, ' ', segment_terminator)
+    for segment_string, segment in tokenize(src_string, service_chars):
+        return segment
+    return ['']
 
 
 def validate_anchor_segments(segments):
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Provides SegmentWriter, which builds outgoing EDIFACT messages."""
+
+import string
+
+from helpers import DEFAULT_SERVICE_CHARS
+
+# Placeholders for the separators in formatted segments. They are C0 control
+# characters, which syntax levels UNOA to UNOC do not allow in data, so every
+# service character left in a message after formatting is data and is escaped.
+ELEMENT = '\x1d'
+COMPONENT = '\x1f'
+TERMINATOR = '\x1c'
+
+
+def template(pattern):
+    """A segment format string for SegmentWriter from one written with + and :
+    as separators, e.g. template('QTY+%s:%s') % (21, 5)."""
+    return pattern.replace('+', ELEMENT).replace(':', COMPONENT)
+
+
+class SegmentWriter(list):
+    """Builds one EDIFACT message.
+
+    The writer is the list of the formatted segments of the message, without
+    segment terminators, and a segment builder returns a list of segments to
+    add, empty if there is nothing to write. Adding them is a list extend;
+    escaping, separators and encoding are done over the whole message in
+    getvalue(). Values are written with %s: numbers as str() gives them, str
+    as it is (UTF-8), unicode encoded to the message encoding.
+
+    seg_count is the number of segments so far (for UNT). lin_count is the
+    number of the last line item, the LIN builder counts it (for CNT).
+
+        QTY = template('QTY+%s:%s')
+        msg = SegmentWriter()
+        msg += [template('UNH+%s+ORDERS:D:96A:UN:EAN008') % 1]
+        msg.lin_count += 1
+        msg += [template('LIN+%s++%s:EN') % (msg.lin_count, '7310000000040')]
+        msg += [QTY % (21, 5)]
+        msg += [template('UNT+%s+%s') % (msg.seg_count + 1, 1)]
+        body = msg.getvalue()
+    """
+
+    def __init__(self, service_chars=DEFAULT_SERVICE_CHARS, encoding='iso8859-1'):
+        super(SegmentWriter, self).__init__()
+        self.service_chars = service_chars
+        self.encoding = encoding
+        self.lin_count = 0
+
+    @property
+    def seg_count(self):
+        return len(self)
+
+    def getvalue(self):
+        """The message encoded, characters the encoding lacks are left out."""
+        sc = self.service_chars
+        try:
+            data = TERMINATOR.join(self)
+        except UnicodeDecodeError:
+            # UTF-8 str segments mixed with unicode ones.
+            data = TERMINATOR.join([s.decode('utf-8', 'replace') if type(s) is str else s for s in self])
+        data += TERMINATOR
+        release = sc.release
+        for c in (release, sc.element, sc.component, sc.segment):
+            if c in data:
+                data = data.replace(c, release + c)
+        if type(data) is str:
+            data = data.translate(_translation(sc)).decode('utf-8', 'replace')
+        else:
+            data = data.replace(ELEMENT, sc.element).replace(COMPONENT, sc.component).replace(TERMINATOR, sc.segment)
+        return data.encode(self.encoding, 'ignore')
+
+
+_translations = {}
+
+
+def _translation(service_chars):
+    """str.translate table from the placeholders to the separators of service_chars."""
+    table = _translations.get(service_chars)
+    if table is None:
+        table = _translations[service_chars] = string.maketrans(
+            ELEMENT + COMPONENT + TERMINATOR, service_chars.element + service_chars.component + service_chars.segment)
+    return table
@@ -19,6 +19,7 @@
 #
 ##############################################################################
 from openerp import models, fields, api, _
+from openerp.addons.edi_gs1.edi_route import segment_handler
 import base64
 from datetime import datetime
 #https://www.stylusstudio.com/edifact/frames.htm
@@ -26,6 +27,7 @@ from datetime import datetime
 import logging
 _logger = logging.getLogger(__name__)
 
+CONTRL = 'edi_gs1.edi_message_type_contrl'
 
 class edi_message(models.Model):
     _inherit='edi.message'
@@ -37,35 +39,29 @@ class edi_message(models.Model):
             if self.model_record._name != 'edi.envelope':
                 raise ValueError("CONTRL: Attached record is not an edi.envelope!")
             envelope = self.model_record
-            msg =  self.UNH(edi_type='CONTRL', ass_code='EAN002')
+            msg = self._gs1_writer()
+            msg += self.UNH(edi_type='CONTRL', ass_code='EAN002')
             msg += self.UCI(envelope.ref, envelope.sender, envelope.recipient)
             msg += self.UNS()
-            msg += self.UNT()
+            msg += self.UNT(msg)
 
             #TODO: What encoding should be used?
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
+            self.write_body(msg.getvalue())
         super(edi_message, self)._pack()
 
-    @api.one
-    def _unpack(self):
-        if self.edi_type.id == self.env.ref('edi_gs1.edi_message_type_contrl').id:
-            segment_count = 0
-            for segment in self._gs1_get_components():
-                segment_count += 1
-                _logger.warn('segment: %s' % segment)
+    @segment_handler(CONTRL, 'UCI')
+    def _gs1_contrl_uci(self, segment, state):
+        envelope = self.env['edi.envelope']
+        sender = envelope._get_partner(segment[2], 'sender')
+        recipient = envelope._get_partner(segment[3], 'recipient')
+        envelope = self._find_envelope(segment[1], sender, recipient)
+        self.model = envelope._name
+        self.res_id = envelope.id
 
-                if segment[0] == 'UCI':
-                    envelope = self.env['edi.envelope']
-                    sender = envelope._get_partner(segment[2], 'sender')
-                    recipient = envelope._get_partner(segment[3], 'recipient')
-                    envelope = self._find_envelope(segment[1], sender, recipient)
-                    self.model = envelope._name
-                    self.res_id = envelope.id
-                elif segment[0] == 'UNT':
-                    if segment_count != int(segment[1]):
-                        raise TypeError('Wrong number of segments! %s %s' % (segment_count, segment),segment)
-        else:
-            super(edi_message, self)._unpack()
+    @segment_handler(CONTRL, 'UNT')
+    def _gs1_contrl_unt(self, segment, state):
+        if state['segment_count'] != int(segment[1]):
+            raise TypeError('Wrong number of segments! %s %s' % (state['segment_count'], segment),segment)
 
 #Example CONTRL message creation.
 #~ if envelope.sender.id == 4002 and envelope.application != 'CONTRL':
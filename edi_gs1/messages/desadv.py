@@ -29,11 +29,13 @@ _logger = logging.getLogger(__name__)
 class edi_message(models.Model):
     _inherit='edi.message'
     
-    @api.multi
-    def _edi_get_move_for_product(self, product, picking):
-        for move in picking.move_lines:
-            if move.product_id == product:
-                return move
+    @api.model
+    def _edi_by_product(self, records):
+        """{product id: first record in records with the product}"""
+        by_product = {}
+        for record in records:
+            by_product.setdefault(record.product_id.id, record)
+        return by_product
         
     @api.one
     def _pack(self):
@@ -42,7 +44,8 @@ class edi_message(models.Model):
             if self.model_record._name != 'stock.picking':
                 raise ValueError("DESADV: Attached record is not a stock.pack! {model}".format(model=self.model_record._name),self.model_record._name)
             picking = self.model_record
-            msg = self.UNH('DESADV')
+            msg = self._gs1_writer()
+            msg += self.UNH('DESADV')
             msg += self.BGM(doc_code=351, doc_no=picking.name) #Possibly should use GDTI, Global Document Type Identifier
             #Document date
             msg += self.DTM(137)
@@ -89,10 +92,15 @@ class edi_message(models.Model):
             level = 0
             qty_total = 0
             moves = picking.move_lines
+            order_ref = picking.sale_id.client_order_ref or picking.sale_id.name
+            order_lines = self._edi_by_product(picking.sale_id.order_line)
+            product_moves = self._edi_by_product(moves)
+            packed_move_ids = set()
             
-            packages = self.env['stock.quant.package'].browse()
-            for operation in picking.pack_operation_ids:
-                packages |= operation.result_package_id
+            packages = picking.pack_operation_ids.mapped('result_package_id')
+            # Read the quants, their products and lots of all packages at once.
+            packages.mapped('quant_ids.product_id.default_code')
+            packages.mapped('quant_ids.lot_id.life_date')
             
             for package in packages:
                 level += 1
@@ -104,7 +112,7 @@ class edi_message(models.Model):
                     msg += self.PCI()
                     msg += self.GIN(package.sscc)
                 for quant in package.quant_ids:
-                    msg += self.LIN(quant)
+                    msg += self.LIN(msg, quant)
                     msg += self.PIA(quant.product_id, 'SA')
                     #Batch number
                     if quant.lot_id and quant.lot_id.name:
@@ -115,36 +123,32 @@ class edi_message(models.Model):
                     if quant.lot_id and quant.lot_id.life_date:
                         msg += self.DTM(361, quant.lot_id.life_date)
                     #Order reference with line nr
-                    order_line = None
-                    for line in picking.sale_id.order_line:
-                        if line.product_id == quant.product_id:
-                            order_line = line
-                            break
+                    order_line = order_lines.get(quant.product_id.id)
                     if order_line:
                         #Order Reference
-                        msg += self.RFF(picking.sale_id.client_order_ref or picking.sale_id.name, 'ON', order_line.sequence)
+                        msg += self.RFF(order_ref, 'ON', order_line.sequence)
                         #Quantity Difference from ORDRSP
-                        move = self._edi_get_move_for_product(quant.product_id, picking)
+                        move = product_moves.get(quant.product_id.id)
                         diff = move.product_uom_qty - order_line.product_uom_qty
                         if diff != 0:
                             msg += self.QVR(diff, move.qty_difference_reason or 'AV')
-                        moves -= move
+                        packed_move_ids.add(move.id)
                 #Undelivered Products are registered in last pallet.
                 if level == len(packages):
                     order_line = None
                     for move in moves:
-                        for line in picking.sale_id.order_line:
-                            if line.product_id == move.product_id:
-                                order_line = line
-                                break
+                        if move.id in packed_move_ids:
+                            continue
+                        # A move without order line keeps the line of the move before, as it always has.
+                        order_line = order_lines.get(move.product_id.id, order_line)
                         diff = move.product_uom_qty - order_line.product_uom_qty
                         if diff != 0:
-                            msg += self.LIN(move)
+                            msg += self.LIN(msg, move)
                             msg += self.PIA(move.product_id, 'SA')
                             msg += self.QTY(move)
-                            msg += self.RFF(picking.sale_id.client_order_ref or picking.sale_id.name, 'ON', order_line.sequence)
+                            msg += self.RFF(order_ref, 'ON', order_line.sequence)
                             msg += self.QVR(diff, move.qty_difference_reason or 'AV')
             msg += self.CNT(1, qty_total)
-            msg += self.CNT(2, self._lin_count)
-            msg += self.UNT()
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
+            msg += self.CNT(2, msg.lin_count)
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
@@ -30,25 +30,36 @@ _logger = logging.getLogger(__name__)
 class edi_message(models.Model):
     _inherit='edi.message'
 
-    _edi_lines_tot_qty = 0
-
-    def _get_line_nr(self, order, inv_line):
-        for line in order.order_line:
-            if inv_line in line.invoice_lines:
-                return line.sequence
-    
-    def _get_inv_line_nr(self, invoice, inv_line):
-        nr = 1
-        for line in invoice.invoice_line:
-            if line.product_id == inv_line.product_id:
-                return nr
-            nr += 1
-        raise ValueError("Invoice line (id: %s) not found in invoice %s." % (inv_line.id, order.name))
-    
-    def _get_order_line_nr_compare_prod(self, order, inv_line):
+    @api.model
+    def _gs1_order_line_nrs(self, order):
+        """Index the lines of order once: ({invoice line id: sequence}, {product id: sequence}).
+        The first order line of an invoice line or product wins."""
+        by_invoice_line, by_product = {}, {}
         for line in order.order_line:
-            if line.product_id == inv_line.product_id:
-                return line.sequence
+            for inv_line_id in line.invoice_lines.ids:
+                by_invoice_line.setdefault(inv_line_id, line.sequence)
+            by_product.setdefault(line.product_id.id, line.sequence)
+        return by_invoice_line, by_product
+
+    @api.model
+    def _gs1_invoice_line_nrs(self, invoice):
+        """{product id: number (from 1) of the first line with the product in invoice}"""
+        nrs = {}
+        for nr, line in enumerate(invoice.invoice_line, 1):
+            nrs.setdefault(line.product_id.id, nr)
+        return nrs
+
+    @api.model
+    def _gs1_account_taxes(self, names):
+        """{name: account.tax} for the tax names, with one search. Like _get_account_tax
+        a name must match exactly one tax."""
+        taxes = {}
+        for tax in self.env['account.tax'].search([('name', 'in', list(set(names)))]) if names else []:
+            taxes.setdefault(tax.name, []).append(tax)
+        for name in names:
+            if len(taxes.get(name, [])) != 1:
+                raise Warning("Couldn't find tax with name '%s'." % name)
+        return dict((name, t[0]) for name, t in taxes.items())
     
     @api.one
     def _pack(self):
@@ -57,7 +68,8 @@ class edi_message(models.Model):
             if self.model_record._name != 'account.invoice':
                 raise ValueError("INVOIC: Attached record is not an account.invoice! {model}".format(model=self.model_record._name),self.model_record._name)
             invoice = self.model_record
-            msg = self.UNH('INVOIC', ass_code='EAN008')
+            msg = self._gs1_writer()
+            msg += self.UNH('INVOIC', ass_code='EAN008')
             #380 =  Commercial invoice - Document/message claiming payment for goods or services supplied under conditions agreed between seller and buyer.
             #381 =  Credit note - Document/message for providing credit information to the relevant party.
             #9 = Original - Initial transmission related to a given transaction.
@@ -142,9 +154,16 @@ class edi_message(models.Model):
             #   MOA Ammount
             #   TAX
 
-            for line in invoice.invoice_line:
-                self._edi_lines_tot_qty += line.quantity
-                msg += self.LIN(line)
+            lines = invoice.invoice_line
+            # Read the products (codes and GTINs) of all lines at once, not line by line in LIN and PIA.
+            lines.mapped('product_id.gs1_gtin13')
+            order_ref = order and (order.client_order_ref or order.name)
+            line_nrs, product_nrs = self._gs1_order_line_nrs(order) if order else ({}, {})
+            refund_nrs = self._gs1_invoice_line_nrs(invoice.invoice_id) if invoice.invoice_id and invoice.type == 'out_refund' else {}
+            tot_qty = 0
+            for line in lines:
+                tot_qty += line.quantity
+                msg += self.LIN(msg, line)
                 msg += self.PIA(line.product_id, 'SA')
                 #Invoice qty
                 msg += self.QTY(line)
@@ -156,25 +175,27 @@ class edi_message(models.Model):
                 #Net unit price, and many more
                 msg += self.PRI(line.price_unit)
                 if order and invoice.type != 'out_refund':
-                    order_line = self._get_line_nr(order, line) or self._get_order_line_nr_compare_prod(order, line)
+                    order_line = line_nrs.get(line.id) or product_nrs.get(line.product_id.id)
                     if order_line:
-                        msg += self.RFF(order.client_order_ref or order.name, 'ON', order_line)
+                        msg += self.RFF(order_ref, 'ON', order_line)
                     else:
-                        msg += self.RFF(order.client_order_ref or order.name, 'ON', '00')
+                        msg += self.RFF(order_ref, 'ON', '00')
                 if order and invoice.type == 'out_refund':
-                    order_line = self._get_order_line_nr_compare_prod(order, line)
+                    order_line = product_nrs.get(line.product_id.id)
                     if order_line:
-                        msg += self.RFF(order.client_order_ref or order.name, 'ON', order_line)
+                        msg += self.RFF(order_ref, 'ON', order_line)
                     else:
-                        msg += self.RFF(order.client_order_ref or order.name, 'ON', '00')
+                        msg += self.RFF(order_ref, 'ON', '00')
                 #Reference to invoice. Only if this is a refund invoice.
                 if invoice.invoice_id and invoice.type == 'out_refund':
-                    msg += self.RFF(invoice.invoice_id.number, 'IV', self._get_inv_line_nr(invoice.invoice_id, line))
+                    if line.product_id.id not in refund_nrs:
+                        raise ValueError("Invoice line (id: %s) not found in invoice %s." % (line.id, invoice.invoice_id.number))
+                    msg += self.RFF(invoice.invoice_id.number, 'IV', refund_nrs[line.product_id.id])
                 #Justification for tax exemption
                 #TAX
             msg += self.UNS()
-            msg += self.CNT(1, self._edi_lines_tot_qty)
-            msg += self.CNT(2, self._lin_count)
+            msg += self.CNT(1, tot_qty)
+            msg += self.CNT(2, msg.lin_count)
             #Amount due
             msg += self.MOA(invoice.amount_total, 9)
             msg += self.MOA(0.0, 165)  # Adjustment amount. Amount being the balance of the amount to be adjusted and the adjusted amount.
@@ -196,11 +217,12 @@ class edi_message(models.Model):
             #self.msg += self.MOA()
             #self.msg += self.MOA()
             #TAX-MOA-MOAs
+            taxes = self._gs1_account_taxes(invoice.tax_line.mapped('name'))
             for tax_line in invoice.tax_line:
-                tax = self._get_account_tax(tax_line.name)
+                tax = taxes[tax_line.name]
                 msg += self.TAX(tax.amount * 100, tax_type = tax.gs1_tax_type, category = tax.gs1_tax_category) #Tax category and rate
                 msg += self.MOA(tax_line.base_amount, 125)   # Taxable amount
                 msg += self.MOA(tax_line.tax_amount, 124)  # Tax amount . Tax imposed by government or other official authority related to the weight/volume charge or valuation charge.
-            msg += self.UNT()
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
 
@@ -19,13 +19,18 @@
 #
 ##############################################################################
 from openerp import models, fields, api, _
+from openerp.addons.edi_route.edi_route import savepoint
+from openerp.addons.edi_gs1.edi_route import deferred_orders, segment_handler
 import base64
 from datetime import datetime
+import sys
 #https://www.stylusstudio.com/edifact/frames.htm
 
 import logging
 _logger = logging.getLogger(__name__)
 
+ORDERS = 'edi_gs1.edi_message_type_orders'
+
 class edi_message(models.Model):
     _inherit='edi.message'
 
@@ -66,135 +71,219 @@ UNS     Avslutar orderrad.
 UNT     Avslutar ordermeddelandet.
 """
 
-    @api.one
-    def _unpack(self):
+    @segment_handler(ORDERS, 'begin')
+    def _gs1_orders_begin(self, segment, state):
         _logger.info('unpack (orders.py) %s %s' % (self.edi_type, self))
-        super(edi_message, self)._unpack()
-        if self.edi_type.id == self.env.ref('edi_gs1.edi_message_type_orders').id:
-            segment_count = 0
-            warnings = ''
-            #Delivered by?
-            delivery_prom_dt = None
-            doc_dt = None
-            order_values = {
-                #'edi_type': 'esap20',
-                'order_line': [],
-                'unb_sender': self.sender.id,
-                'unb_recipient': self.recipient.id,
-                'route_id': self.route_id.id,
-            }
-            line = {}
-            for segment in self._gs1_get_components():
-                segment_count += 1
-                #~ _logger.warn('segment: %s' % segment)
-                #Begin Message
-                if segment[0] == 'BGM':
-                    order_values['client_order_ref'] = segment[2]
-                #Datetime
-                elif segment[0] == 'DTM':
-                    function = segment[1][0]
-                    if function == '2':
-                        order_values['dtm_delivery'] = self._parse_date(segment[1])
-                        order_values['date_order'] = self._parse_date(segment[1])
-                        #~ _logger.warn(order_values['date_order'])
-                        if segment[1][2] == '102':
-                            order_values['date_order'] = order_values['date_order'][:11] + '15' + order_values['date_order'][13:]
-                            order_values['dtm_delivery'] = order_values['dtm_delivery'][:11] + '15' + order_values['dtm_delivery'][13:]
-                        #~ _logger.warn(order_values['date_order'])
-                    elif function == '137':
-                        order_values['dtm_issue'] = self._parse_date(segment[1])
-                        if segment[1][2] == '102':
-                            order_values['dtm_issue'] = order_values['dtm_issue'][:11] + '15' + order_values['dtm_issue'][13:]
-                elif segment[0] == 'NAD':
-                    if segment[1] == 'BY':
-                        order_values['nad_by'] = order_values['partner_id'] = self._get_partner(segment[2]).id
-                        self.consignee_id = self._get_partner(segment[2]).id
-                    elif segment[1] == 'SU':
-                        order_values['nad_su'] =self._get_partner(segment[2]).id
-                        supplier = self._get_partner(segment[2])
-                        if self.env.ref('base.main_partner').id != self._get_partner(segment[2]).id:
-                            raise ValueError('Supplier %s is not us (%s)' % (segment[2],self.env.ref('base.main_partner').gs1_gln))
-                        #~ _logger.warn('supplier: %s' % segment[2])
-                        self.consignor_id = self._get_partner(segment[2]).id
-                    elif segment[1] == 'SN':
-                        order_values['nad_sn'] =self._get_partner(segment[2]).id
-                        store_keeper = self._get_partner(segment[2])
-                        #ICA Sverige AB
-                        #~ _logger.warn('store keeper: %s' % segment[2])
-                    elif segment[1] == 'CN':
-                        order_values['nad_cn'] =self._get_partner(segment[2]).id
-                        self.consignee_id = self._get_partner(segment[2]).id
-                        #~ _logger.warn('consignee: %s' % segment[2])
-                    #Delivery Party
-                    elif segment[1] == 'DP':
-                        recipient = self._get_partner(segment[2]).id
-                        order_values['nad_dp'] =self._get_partner(segment[2]).id
-                        #~ _logger.warn('recipient: %s' % segment[2])
-                    #Invoice Party
-                    elif segment[1] == 'ITO':
-                        recipient = self._get_partner(segment[2]).id
-                        order_values['nad_ito'] =self._get_partner(segment[2]).id
-                        #~ _logger.warn('invoice: %s' % segment[2])
-                elif segment[0] == 'LIN':
-                    if line:
-                        order_values['order_line'].append((0, 0, line))
-                    line = {'sequence': int(segment[1])}
-                    try:
-                        line['product_id'] = self._get_product(segment[3]).id
-                    except:
-                        warnings += 'Product not found: %s' % l
-                elif segment[0] == 'QTY':
-                    line['product_uom_qty'] = line['order_qty'] = self._parse_quantity(segment[1])
-                #Alternative Product Identification
-                elif segment[0] == 'PIA':
-                    try:
-                        product = self._get_product(segment[2])
-                        if product and line:
-                            if line.get('product_id', product.id) != product.id:
-                                warnings += "Found two products for one line: %s and %s. %s" % (line['product_id'], product.id, line)
-                            else:
-                                line['product_id'] = product.id
-                    except:
-                        warnings += 'Product not found: %s' % l
-                #Free text
-                #~ #elif segment[0] == 'FTX':
-                #~ #    pass
-                elif segment[0] == 'RFF':
-                    #CR customer reference number
-                    #GN Government Reference Number
-                    #VA VAT registration number
-                    # CT Contract number
-                    if len(segment[1]) > 1 and segment[1][0] == 'CT':
-                        contract = self._get_contract(segment[1][1])
-                        if contract:
-                            order_values['project_id'] = contract
-                #End of message
-                elif segment[0] == 'UNT':
-                    if segment_count != int(segment[1]):
-                        raise TypeError('Wrong number of segments! %s %s' % (segment_count, segment),segment)
-                    #Add last line
-                    if line:
-                        order_values['order_line'].append((0, 0, line))
-                    _logger.warn(order_values)
-                    for a, b, line in order_values['order_line']:
-                        if not line.get('product_id'):
-                            raise Warning(warnings)
-                    #create order
-                    order = self.env['sale.order'].create(order_values)
-                    if order.nad_ito:
-                        self.nad_ito = order.nad_ito.id
-                        order.partner_invoice_id = order.nad_ito.id
-                    elif not order.partner_invoice_id.id == order.partner_id.id:
-                        self.nad_ito = order.partner_invoice_id.id
-                        order.nad_ito = order.partner_invoice_id.id
-                    if order.nad_dp:
-                        self.nad_dp = order.nad_dp.id
-                        order.partner_shipping_id = order.nad_dp.id
-                    elif not order.partner_shipping_id.id == order.partner_id.id:
-                        self.nad_dp = order.partner_shipping_id.id
-                        order.nad_dp = order.partner_shipping_id.id
-                    if warnings:
-                        self.log(warnings)
-                    _logger.info('Order ready %r' % order)
-                    self.model = order._name
-                    self.res_id = order.id
+        state['warnings'] = ''
+        state['line'] = {}
+        state['order_values'] = {
+            #'edi_type': 'esap20',
+            'order_line': [],
+            'unb_sender': self.sender.id,
+            'unb_recipient': self.recipient.id,
+            'route_id': self.route_id.id,
+        }
+
+    #Begin Message
+    @segment_handler(ORDERS, 'BGM')
+    def _gs1_orders_bgm(self, segment, state):
+        state['order_values']['client_order_ref'] = segment[2]
+
+    #Datetime
+    @segment_handler(ORDERS, 'DTM')
+    def _gs1_orders_dtm(self, segment, state):
+        order_values = state['order_values']
+        function = segment[1][0]
+        if function == '2':
+            order_values['dtm_delivery'] = self._parse_date(segment[1])
+            order_values['date_order'] = self._parse_date(segment[1])
+            if segment[1][2] == '102':
+                order_values['date_order'] = order_values['date_order'][:11] + '15' + order_values['date_order'][13:]
+                order_values['dtm_delivery'] = order_values['dtm_delivery'][:11] + '15' + order_values['dtm_delivery'][13:]
+        elif function == '137':
+            order_values['dtm_issue'] = self._parse_date(segment[1])
+            if segment[1][2] == '102':
+                order_values['dtm_issue'] = order_values['dtm_issue'][:11] + '15' + order_values['dtm_issue'][13:]
+
+    @segment_handler(ORDERS, 'NAD')
+    def _gs1_orders_nad(self, segment, state):
+        if segment[1] not in ('BY', 'SU', 'SN', 'CN', 'DP', 'ITO'):
+            return
+        order_values = state['order_values']
+        partner = self._get_partner(segment[2])
+        if segment[1] == 'BY':
+            order_values['nad_by'] = order_values['partner_id'] = partner.id
+            self.consignee_id = partner.id
+        elif segment[1] == 'SU':
+            order_values['nad_su'] = partner.id
+            if self.env.ref('base.main_partner').id != partner.id:
+                raise ValueError('Supplier %s is not us (%s)' % (segment[2],self.env.ref('base.main_partner').gs1_gln))
+            self.consignor_id = partner.id
+        elif segment[1] == 'SN':
+            order_values['nad_sn'] = partner.id
+            #ICA Sverige AB
+        elif segment[1] == 'CN':
+            order_values['nad_cn'] = partner.id
+            self.consignee_id = partner.id
+        #Delivery Party
+        elif segment[1] == 'DP':
+            order_values['nad_dp'] = partner.id
+        #Invoice Party
+        elif segment[1] == 'ITO':
+            order_values['nad_ito'] = partner.id
+
+    @segment_handler(ORDERS, 'LIN')
+    def _gs1_orders_lin(self, segment, state):
+        if state['line']:
+            state['order_values']['order_line'].append((0, 0, state['line']))
+        line = state['line'] = {'sequence': int(segment[1])}
+        try:
+            line['product_id'] = self._get_product(segment[3]).id
+        except:
+            state['warnings'] += 'Product not found: %s' % segment[3:]
+
+    @segment_handler(ORDERS, 'QTY')
+    def _gs1_orders_qty(self, segment, state):
+        state['line']['product_uom_qty'] = state['line']['order_qty'] = self._parse_quantity(segment[1])
+
+    #Alternative Product Identification
+    @segment_handler(ORDERS, 'PIA')
+    def _gs1_orders_pia(self, segment, state):
+        line = state['line']
+        try:
+            product = self._get_product(segment[2])
+            if product and line:
+                if line.get('product_id', product.id) != product.id:
+                    state['warnings'] += "Found two products for one line: %s and %s. %s" % (line['product_id'], product.id, line)
+                else:
+                    line['product_id'] = product.id
+        except:
+            state['warnings'] += 'Product not found: %s' % segment[2:]
+
+    @segment_handler(ORDERS, 'RFF')
+    def _gs1_orders_rff(self, segment, state):
+        #CR customer reference number
+        #GN Government Reference Number
+        #VA VAT registration number
+        # CT Contract number
+        if len(segment[1]) > 1 and segment[1][0] == 'CT':
+            contract = self._get_contract(segment[1][1])
+            if contract:
+                state['order_values']['project_id'] = contract
+
+    #End of message
+    @segment_handler(ORDERS, 'UNT')
+    def _gs1_orders_unt(self, segment, state):
+        order_values = state['order_values']
+        warnings = state['warnings']
+        if state['segment_count'] != int(segment[1]):
+            raise TypeError('Wrong number of segments! %s %s' % (state['segment_count'], segment),segment)
+        #Add last line
+        if state['line']:
+            order_values['order_line'].append((0, 0, state['line']))
+        _logger.warn(order_values)
+        for a, b, line in order_values['order_line']:
+            if not line.get('product_id'):
+                raise Warning(warnings)
+        batch = deferred_orders(self.env.cr)
+        if batch is not None:
+            batch[self.id] = (order_values, warnings)
+        else:
+            self._gs1_recompute_orders(self._gs1_create_order(order_values, warnings))
+
+    @api.multi
+    def _gs1_create_order(self, order_values, warnings):
+        """Create the sale order of this ORDERS message. Stored function fields
+        (the order totals) are not computed, see _gs1_recompute_orders."""
+        self.ensure_one()
+        order = self.env['sale.order'].with_context(no_store_function=True).create(order_values)
+        if order.nad_ito:
+            self.nad_ito = order.nad_ito.id
+            order.partner_invoice_id = order.nad_ito.id
+        elif not order.partner_invoice_id.id == order.partner_id.id:
+            self.nad_ito = order.partner_invoice_id.id
+            order.nad_ito = order.partner_invoice_id.id
+        if order.nad_dp:
+            self.nad_dp = order.nad_dp.id
+            order.partner_shipping_id = order.nad_dp.id
+        elif not order.partner_shipping_id.id == order.partner_id.id:
+            self.nad_dp = order.partner_shipping_id.id
+            order.nad_dp = order.partner_shipping_id.id
+        if warnings:
+            self.log(warnings)
+        _logger.info('Order ready %r' % order)
+        self.model = order._name
+        self.res_id = order.id
+        return order
+
+    @api.model
+    def _gs1_create_orders(self, batch):
+        """Create the sale orders of the ORDERS messages unpacked in an orders_batch()
+        ({message id: (order values, warnings)}), then compute their totals in one go.
+        A failing order cancels its message and envelope, not the others. If the
+        totals fail, they are computed order by order and only the orders that
+        fail are removed again."""
+        orders = {}
+        for msg in self.browse(sorted(batch)):
+            start = self.env['edi.run.log'].start()
+            try:
+                with savepoint(self.env):
+                    orders[msg.id] = msg._gs1_create_order(*batch[msg.id])
+            except Exception as e:
+                msg._gs1_order_failed(e, start)
+        try:
+            with savepoint(self.env):
+                self._gs1_recompute_orders(self.env['sale.order'].browse([o.id for o in orders.values()]))
+        except Exception:
+            _logger.exception('Computing the totals of %s orders failed, computing them one at a time' % len(orders))
+            for msg in self.browse(sorted(orders)):
+                start = self.env['edi.run.log'].start()
+                try:
+                    with savepoint(self.env):
+                        self._gs1_recompute_orders(orders[msg.id])
+                except Exception as e:
+                    del orders[msg.id]
+                    msg._gs1_order_failed(e, start)
+        _logger.info('Created %s orders from %s ORDERS messages' % (len(orders), len(batch)))
+
+    @api.one
+    def _gs1_order_failed(self, error, start):
+        """Cancel this message and its envelope when its sale order could not be
+        created, and remove what was created of the order."""
+        self.env['edi.run.log'].add('unpack', error, start, route=self.route_id, envelope=self.envelope_id, message=self)
+        self.route_id.log("Error when creating the order of message '%s' of envelope '%s'" % (self.name, self.envelope_id.name), sys.exc_info())
+        if self.model == 'sale.order' and self.res_id:
+            try:
+                with savepoint(self.env):
+                    self.env['sale.order'].browse(self.res_id).unlink()
+            except Exception:
+                _logger.exception('Could not remove sale order %s of message %s' % (self.res_id, self.name))
+        self.write({'state': 'canceled', 'model': False, 'res_id': False})
+        self.envelope_id.state = 'canceled'
+
+    @api.model
+    def _gs1_recompute_orders(self, orders):
+        """Compute the stored function fields of orders and their lines, that _gs1_create_order left out."""
+        self._gs1_store_recompute('sale.order.line', orders.mapped('order_line').ids)
+        self._gs1_store_recompute('sale.order', orders.ids)
+
+    @api.model
+    def _gs1_store_recompute(self, model, ids):
+        """Compute the stored function fields that depend on the records ids of model,
+        what create() leaves out when no_store_function is set in the context.
+
+        The order totals are old API function fields with store triggers. The
+        recompute=False context and recompute() only defer the new API computed
+        fields, so this does what create() does for the store triggers, with
+        _store_get_values and _store_set_values, once for all the records."""
+        if not ids:
+            return
+        cr, uid, context = self.env.args
+        todo = self.pool[model]._store_get_values(cr, uid, ids, None, context)
+        todo.sort()
+        done = []
+        for order, model_name, record_ids, fnames in todo:
+            if (model_name, record_ids, fnames) not in done:
+                self.pool[model_name]._store_set_values(cr, uid, record_ids, fnames, context)
+                done.append((model_name, record_ids, fnames))
+        self.env.invalidate_all()
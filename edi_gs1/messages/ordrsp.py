@@ -49,7 +49,8 @@ class edi_message(models.Model):
                 raise ValueError("ORDRSP: Attached record is not a sale.order! {model}".format(model=self.model_record._name),self.model_record._name)
             order = self.model_record
             status = _check_order_status(order)
-            msg = self.UNH('ORDRSP')
+            msg = self._gs1_writer()
+            msg += self.UNH('ORDRSP')
             msg += self.BGM(231, order.name, status=status)
             msg += self.DTM(137, format=203)  # Order Response Date
             msg += self.DTM(76, dt=order.date_order, format=203) # Planned Delivery Date
@@ -64,18 +65,18 @@ class edi_message(models.Model):
                 if line.product_uom_qty != line.order_qty:
                     cnt_lines += 1
                     cnt_amount += line.product_uom_qty
-                    msg += self.LIN(line)
+                    msg += self.LIN(msg, line)
                     msg += self.PIA(line.product_id, 'SA')
                     msg += self.QTY(line)
                     msg += self.QVR(line.product_uom_qty - line.order_qty)
                     msg += self.RFF(order.client_order_ref or order.name, 'ON', line.sequence)
                 else:
-                    self._lin_count += 1
+                    msg.lin_count += 1
             msg += self.UNS()
             if cnt_lines > 0:
                 msg += self.CNT(1, cnt_amount)
                 msg += self.CNT(2, cnt_lines)
-            msg += self.UNT()
+            msg += self.UNT(msg)
 
         #Ordererkännande
         elif self.edi_type.id == self.env.ref('edi_gs1.edi_message_type_orderk').id:
@@ -83,7 +84,8 @@ class edi_message(models.Model):
             if self.model_record._name != 'sale.order':
                 raise ValueError("ORDRSP: Attached record is not a sale.order!")
             order = self.model_record
-            msg =  self.UNH(edi_type='ORDRSP')
+            msg = self._gs1_writer()
+            msg += self.UNH(edi_type='ORDRSP')
             msg += self.BGM(231, order.name, 12)
             msg += self.DTM(137,format=203)
             if order.note:
@@ -92,14 +94,6 @@ class edi_message(models.Model):
             msg += self.NAD_BY(order.partner_id)
             msg += self.NAD_SU()
             msg += self.UNS()
-            msg += self.UNT()
+            msg += self.UNT(msg)
         if msg:
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
-
-    @api.one
-    def _unpack(self):
-        _logger.debug('unpack ORDRSP')
-        #~ if self.edi_type.id == self.env.ref('edi_gs1.edi_message_type_ordrsp').id:
-            #~ #Do stuff
-        #~ 
-        super(edi_message, self)._unpack()
+            self.write_body(msg.getvalue())
@@ -87,7 +87,8 @@ UNT		Avslutar ordermeddelandet.
             if self.model_record._name != 'rep.order':
                 raise ValueError("REPORD: Attached record is not a rep.order! {model}".format(model=self.model_record._name),self.model_record._name)
             order = self.model_record
-            msg = self.UNH('ORDERS', ass_code='EDIT30')
+            msg = self._gs1_writer()
+            msg += self.UNH('ORDERS', ass_code='EDIT30')
             msg += self.BGM('22E', order.name)
             msg += self.DTM(137)
             msg += self.DTM(2, order.date_order)
@@ -99,7 +100,7 @@ UNT		Avslutar ordermeddelandet.
             for line in order.order_line:
                 cnt_lines += 1
                 cnt_amount += line.product_uom_qty
-                msg += self.LIN(line)
+                msg += self.LIN(msg, line)
                 msg += self.PIA(line.product_id, 'SA')
                 msg += self.PIA(line.product_id, 'BP', self.model_record.partner_id)
                 msg += self.QTY(line)
@@ -107,5 +108,5 @@ UNT		Avslutar ordermeddelandet.
             if cnt_lines > 0:
                 msg += self.CNT(1, cnt_amount)
                 msg += self.CNT(2, cnt_lines)
-            msg += self.UNT()
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
@@ -30,6 +30,23 @@ class product_product(models.Model):
     gs1_gtin14 = fields.Char(string="GTIN-14",help="GS1 Global Trade Item Number (GTIN) for outer packages or pallets")
     gs1_gtin13 = fields.Char(string="GTIN-13",help="GS1 Global Trade Item Number (GTIN) for consumer products")
 
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        self.env['edi.gs1.resolver'].clear('gtin', 'default_code')
+        return super(product_product, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if set(vals) & set(['gs1_gtin13', 'gs1_gtin14', 'default_code', 'active']):
+            self.env['edi.gs1.resolver'].clear('gtin', 'default_code')
+        return super(product_product, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['edi.gs1.resolver'].clear('gtin', 'default_code')
+        return super(product_product, self).unlink()
+
 
 class product_template(models.Model):
     _inherit='product.template'
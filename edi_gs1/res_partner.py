@@ -35,6 +35,24 @@ class res_partner(models.Model):
     gs1_gln = fields.Char(string="Global Location Number",help="GS1 Global Location Number (GLN)", select=True)
     customer_no = fields.Char(string="Customer No",help="The Customer No of the chain", select=True)
 
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        if vals.get('gs1_gln'):
+            self.env['edi.gs1.resolver'].clear('gln')
+        return super(res_partner, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'gs1_gln' in vals or 'active' in vals:
+            self.env['edi.gs1.resolver'].clear('gln')
+        return super(res_partner, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['edi.gs1.resolver'].clear('gln')
+        return super(res_partner, self).unlink()
+
     @api.model
     def ica_update_store_registry(self):
         request = urllib2.Request("https://levnet.ica.se/Levnet/ButRegLev.nsf/wwwviwButiksfil/frmButiksfil/$FILE/butreg.xls")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+"""The EDIFACT tokenizer: tokenize, iter_segments and parse_una."""
+from cStringIO import StringIO
+
+import unittest2
+
+from openerp.addons.edi_gs1.edifact.helpers import (
+    DEFAULT_SERVICE_CHARS, ServiceChars, iter_segments, parse_una, tokenize)
+
+INTERCHANGE = (
+    "UNA:+.? 'UNB+UNOC:3+7300000000011:14+7300000000028:14+160301:1000+1'\r\n"
+    "UNH+1+ORDERS:D:96A:UN:EAN008'\r\n"
+    "FTX+ZZZ+1+001+Mr O?'Neil?'s order?: 3?+3??'\r\n"
+    "RFF+ON:A??:B?+C'\r\n"
+    "UNT+4+1'\r\n"
+    "UNZ+1+1'\r\n")
+
+SEGMENTS = [
+    ("UNA:+.? '", ['UNA', ':+.? ']),
+    ("UNB+UNOC:3+7300000000011:14+7300000000028:14+160301:1000+1'",
+        ['UNB', ['UNOC', '3'], ['7300000000011', '14'], ['7300000000028', '14'], ['160301', '1000'], '1']),
+    ("UNH+1+ORDERS:D:96A:UN:EAN008'", ['UNH', '1', ['ORDERS', 'D', '96A', 'UN', 'EAN008']]),
+    ("FTX+ZZZ+1+001+Mr O?'Neil?'s order?: 3?+3??'", ['FTX', 'ZZZ', '1', '001', "Mr O'Neil's order: 3+3?"]),
+    ("RFF+ON:A??:B?+C'", ['RFF', ['ON', 'A?', 'B+C']]),
+    ("UNT+4+1'", ['UNT', '4', '1']),
+    ("UNZ+1+1'", ['UNZ', '1', '1']),
+]
+
+# UNA*~.# | : component *, element ~, release # and segment terminator |.
+OTHER_INTERCHANGE = (
+    "UNA*~.# |UNB~UNOC*3~7300000000011*14~7300000000028*14~160301*1000~1|\r\n"
+    "FTX~ZZZ~1~001~a#|b#~c#*d##|\r\n"
+    "RFF~ON*A+B:C'|\r\n"
+    "UNZ~1~1|\r\n")
+
+OTHER_SEGMENTS = [
+    ("UNA*~.# |", ['UNA', '*~.# ']),
+    ("UNB~UNOC*3~7300000000011*14~7300000000028*14~160301*1000~1|",
+        ['UNB', ['UNOC', '3'], ['7300000000011', '14'], ['7300000000028', '14'], ['160301', '1000'], '1']),
+    ("FTX~ZZZ~1~001~a#|b#~c#*d##|", ['FTX', 'ZZZ', '1', '001', 'a|b~c*d#']),
+    ("RFF~ON*A+B:C'|", ['RFF', ['ON', "A+B:C'"]]),
+    ("UNZ~1~1|", ['UNZ', '1', '1']),
+]
+
+
+class TestTokenizer(unittest2.TestCase):
+
+    def test_parse_una(self):
+        self.assertEqual(parse_una(INTERCHANGE), DEFAULT_SERVICE_CHARS)
+        self.assertEqual(parse_una(OTHER_INTERCHANGE), ServiceChars('*', '~', '.', '#', ' ', '|'))
+        self.assertEqual(parse_una('\r\n' + OTHER_INTERCHANGE), ServiceChars('*', '~', '.', '#', ' ', '|'))
+        self.assertEqual(parse_una("UNB+UNOC:3+7300000000011:14'"), DEFAULT_SERVICE_CHARS)
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize(INTERCHANGE)), SEGMENTS)
+
+    def test_tokenize_una(self):
+        self.assertEqual(list(tokenize(OTHER_INTERCHANGE)), OTHER_SEGMENTS)
+
+    def test_tokenize_without_release(self):
+        data = "UNH+1+ORDERS:D:96A:UN:EAN008'\r\nUNT+2+1'\r\n"
+        self.assertEqual(list(tokenize(data)), SEGMENTS[2:3] + [("UNT+2+1'", ['UNT', '2', '1'])])
+
+    def test_release_before_terminator(self):
+        # ?? is a released release character, so the terminator after it ends the segment.
+        self.assertEqual(list(tokenize("FTX+A??'FTX+B?''")), [
+            ("FTX+A??'", ['FTX', 'A?']),
+            ("FTX+B?''", ['FTX', "B'"]),
+        ])
+
+    def test_iter_segments(self):
+        for data, segments in ((INTERCHANGE, SEGMENTS), (OTHER_INTERCHANGE, OTHER_SEGMENTS)):
+            for chunk_size in range(1, 20):
+                self.assertEqual(list(iter_segments(StringIO(data), chunk_size)), segments,
+                    'chunk size %s' % chunk_size)
+            self.assertEqual(list(iter_segments(StringIO(data))), segments)
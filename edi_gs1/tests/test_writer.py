@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+"""SegmentWriter on its own, and the segment builders of edi.message against
+the string concatenation they replaced."""
+import unittest2
+
+from openerp.tests import common
+from openerp.addons.edi_gs1.edifact.helpers import ServiceChars
+from openerp.addons.edi_gs1.edifact.writer import SegmentWriter, template
+
+_UNH = template('UNH+%s+ORDERS:D:96A:UN:EAN008')
+_LIN = template('LIN+%s')
+_QTY = template('QTY+%s:%s')
+_FTX = template('FTX+ZZZ+1+001+%s')
+_UNT = template('UNT+%s+%s')
+
+
+def legacy_escape(s):
+    """_escape_string of the string builders."""
+    return s.replace('?', '??').replace('+', '?+').replace(':', '?:').replace("'", "?'")
+
+
+def legacy_invoic(name, doc_no, buyer_gln, supplier_gln, lines):
+    """An INVOIC body the way the segment builders wrote it before SegmentWriter,
+    lines are (gtin, default_code, quantity, amount, note)."""
+    segments = [
+        "UNH+%s+INVOIC:D:96A:UN:EAN008'" % name,
+        "BGM+380+%s+9'" % legacy_escape(doc_no),
+        "DTM+137:20160301:102'",
+        "RFF+ON:SO001'",
+        "NAD+BY+%s::9'" % buyer_gln,
+        "NAD+SU+%s::9'" % supplier_gln,
+    ]
+    tot_qty = 0
+    for lin_count, (gtin, default_code, qty, amount, note) in enumerate(lines, 1):
+        tot_qty += qty
+        segments += [
+            "LIN+%s++%s:EU::9'" % (lin_count, gtin),
+            "PIA+1+%s:SA'" % default_code,
+            "QTY+47:%s'" % qty,
+            "MOA+203:%s'" % amount,
+            "FTX+ZZZ+1+001+%s::::'" % legacy_escape(note),
+        ]
+    segments += ["UNS+S'", "CNT+1:%s'" % tot_qty, "CNT+2:%s'" % len(lines)]
+    segments.append("UNT+%s+%s'" % (len(segments) + 1, name))
+    return ''.join(segments).decode('utf-8').encode('iso8859-1', 'ignore')
+
+
+class TestSegmentWriter(unittest2.TestCase):
+
+    def test_release_character(self):
+        msg = SegmentWriter()
+        msg += [_FTX % "Mr O'Neil's order: 3+3?"]
+        self.assertEqual(msg.getvalue(), "FTX+ZZZ+1+001+Mr O?'Neil?'s order?: 3?+3??'")
+        msg = SegmentWriter()
+        msg += [_FTX % "?'"]
+        self.assertEqual(msg.getvalue(), "FTX+ZZZ+1+001+???''")
+
+    def test_service_chars(self):
+        msg = SegmentWriter(ServiceChars('*', '~', '.', '#', ' ', '|'))
+        msg += [_QTY % ('21', "a*b~c#d|e+f:g'")]
+        self.assertEqual(msg.getvalue(), "QTY~21*a#*b#~c##d#|e+f:g'|")
+
+    def test_encoding(self):
+        msg = SegmentWriter()
+        msg += [_FTX % u'Åsa €']
+        msg += [_FTX % 'Åsa']
+        self.assertEqual(msg.getvalue(), u"FTX+ZZZ+1+001+Åsa 'FTX+ZZZ+1+001+Åsa'".encode('iso8859-1'))
+
+    def test_counts(self):
+        msg = SegmentWriter()
+        msg += [_UNH % 1]
+        for qty in (5, 10, 15):
+            msg.lin_count += 1
+            msg += [_LIN % msg.lin_count]
+            msg += [_QTY % (21, qty)]
+            msg += []
+        self.assertEqual(msg.lin_count, 3)
+        self.assertEqual(msg.seg_count, 7)
+        msg += [_UNT % (msg.seg_count + 1, 1)]
+        self.assertEqual(msg.getvalue(), "UNH+1+ORDERS:D:96A:UN:EAN008'"
+            "LIN+1'QTY+21:5'LIN+2'QTY+21:10'LIN+3'QTY+21:15'UNT+8+1'")
+
+
+class TestSegmentBuilders(common.TransactionCase):
+
+    def setUp(self):
+        super(TestSegmentBuilders, self).setUp()
+        partner_obj = self.env['res.partner']
+        self.buyer = partner_obj.create({'name': 'Buyer', 'gs1_gln': '7300000000011'})
+        self.supplier = partner_obj.create({'name': 'Supplier', 'gs1_gln': '7300000000028'})
+        self.products = [self.env['product.product'].create({
+            'name': 'Product %s' % i,
+            'default_code': 'ART-%s' % i,
+            'gs1_gtin13': gtin,
+        }) for i, gtin in enumerate(('7310000000040', '7310000000057'), 1)]
+        self.message = self.env['edi.message'].new({'name': 'TEST1', 'consignor_id': self.supplier.id})
+
+    def test_invoic(self):
+        notes = ["Mr O'Neil's order: 3+3?", 'Åsa']
+        lines = [self.env['account.invoice.line'].new({
+            'name': product.name,
+            'product_id': product.id,
+            'quantity': 3.0,
+            'price_unit': 12.5,
+        }) for product in self.products]
+        message = self.message
+        msg = message._gs1_writer()
+        msg += message.UNH('INVOIC', ass_code='EAN008')
+        msg += message.BGM(380, 'INV/2016:0001', 9)
+        msg += message.DTM(137, '2016-03-01 10:00:00')
+        msg += message.RFF('SO001', 'ON')
+        msg += message.NAD_BY(self.buyer)
+        msg += message.NAD_SU()
+        for line, note in zip(lines, notes):
+            msg += message.LIN(msg, line)
+            msg += message.PIA(line.product_id, 'SA')
+            msg += message.PIA(line.product_id, 'BP')
+            msg += message.QTY(line)
+            msg += message.MOA(37.5)
+            msg += message.FTX(note)
+        msg += message.UNS()
+        msg += message.CNT(1, 6.0)
+        msg += message.CNT(2, msg.lin_count)
+        msg += message.UNT(msg)
+        self.assertEqual(msg.lin_count, 2)
+        self.assertEqual(msg.seg_count, 20)
+        self.assertEqual(msg.getvalue(), legacy_invoic('TEST1', 'INV/2016:0001', '7300000000011', '7300000000028', [
+            (product.gs1_gtin13, product.default_code, 3, 37.5, note) for product, note in zip(self.products, notes)]))
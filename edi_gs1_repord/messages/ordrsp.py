@@ -19,6 +19,7 @@
 #
 ##############################################################################
 from openerp import models, fields, api, _
+from openerp.addons.edi_gs1.edi_route import segment_handler
 import base64
 from datetime import datetime
 import sys
@@ -27,6 +28,8 @@ import sys
 import logging
 _logger = logging.getLogger(__name__)
 
+ORDRSP = 'edi_gs1.edi_message_type_ordrsp'
+
 def _check_order_status(order):
     for line in order.order_line:
         if line.product_uom_qty != line.order_qty:
@@ -39,87 +42,97 @@ def html_line_breaks(msg):
 class edi_message(models.Model):
     _inherit='edi.message'
     
-    @api.one
-    def _unpack(self):
+    #Read ORDRSP corresponding to REPORD sent to ICA.
+    @segment_handler(ORDRSP, 'begin')
+    def _repord_ordrsp_begin(self, segment, state):
         _logger.debug('unpack ORDRSP')
-        if self.edi_type.id == self.env.ref('edi_gs1.edi_message_type_ordrsp').id:
-            #Read ORDRSP corresponding to REPORD sent to ICA.
-            segment_count = 0
-            order_state = ''
-            delivery_date = ''
-            text = ''
-            order = None
-            lines = []
-            line = None
-            errors = []
-            for segment in self._gs1_get_components():
-                segment_count += 1
-                _logger.warn(segment)
-                try:
-                    if segment[0] == 'BGM':
-                        if len(segment) > 3:
-                            order_state = segment[3]
-                    elif segment[0] == 'DTM':
-                        if segment[1] == '2':
-                            delivery_date = segment[2]
-                    elif segment[0] == 'FTX':
-                        ftx = segment[4]
-                        #qualifier = ZZZ, function = 1, ref = 001
-                        #Build human readable message from FTX field
-                        header = ['Felmeddelande: ', 'Order skapad: ',
-                            'Framflyttad leveransdag: ', 'Felkod: ', 'Kundens butiksnummer: ']
-                        for i in range(len(ftx)):
-                            if i < len(header):
-                                text += header[i]
-                            text += ftx[i] + '\n'
-                    elif segment[0] == 'RFF' and segment[1][0] == 'CR':
-                        ref = segment[1][1]
-                        if len(ref) < 3:
-                            ref = '0' + ref
-                        order = self.env['rep.order'].search([('client_order_ref', '=', ref)])[0]
-                        self.model = order._name
-                        self.res_id = order.id
-                    elif segment[0] == 'NAD':
-                        pass
-                    elif segment[0] == 'LIN':
-                        if line:
-                            lines.append(line)
-                        line = {
-                            'sequence': segment[1],
-                            'status': segment[2],
-                        }
-                    elif segment[0] == 'PIA' and line:
-                        pass
-                    elif segment[0] == 'QTY' and line:
-                        line['quantity'] = segment[1][1]
-                    elif segment[0] == 'UNS' and line:
-                        lines.append(line)
-                        line = None
-                except:
-                    errors.append(sys.exc_info())
-            res = 'status: ' + order_state
-            res += '\ndelivery date: ' + delivery_date
-            res += '\nmessage: ' + text
-            if lines:
-                res += '\n' 
-                for line in lines:
-                    res += '\nline %s:\n\tproduct: %s\n\tquantity: %s\n\tstatus: %s\n' % (
-                        line.get('sequence', ''), line.get('product', 'not found'),
-                        line.get('quantity', ''),
-                        'Not accepted' if line.get('status', '') == '7' else line.get('status', 'Unknown'))
-            res += '\n\noriginal message:\n' + self._gs1_decode_msg(base64.b64decode(self.body))
-            if errors:
-                errors.reverse()
-                self.route_id.log("%s error(s) when reading ORDRSP '%s'.\n%s" % (len(errors), self.name, res), errors)
-                self.state = 'canceled'
-            else:
-                self.env['mail.message'].create({
-                    'body': html_line_breaks(res),
-                    'subject': 'Order response received',
-                    'res_id': order.id,
-                    'model': order._name,
-                    'type': 'notification',
-                })
-            
+        state.update({
+            'order_state': '',
+            'delivery_date': '',
+            'text': '',
+            'order': None,
+            'lines': [],
+            'line': None,
+            # Errors of the segments are collected and logged at the end.
+            'errors': [],
+        })
+
+    @segment_handler(ORDRSP, 'BGM')
+    def _repord_ordrsp_bgm(self, segment, state):
+        if len(segment) > 3:
+            state['order_state'] = segment[3]
+
+    @segment_handler(ORDRSP, 'DTM')
+    def _repord_ordrsp_dtm(self, segment, state):
+        if segment[1] == '2':
+            state['delivery_date'] = segment[2]
+
+    @segment_handler(ORDRSP, 'FTX')
+    def _repord_ordrsp_ftx(self, segment, state):
+        ftx = segment[4]
+        #qualifier = ZZZ, function = 1, ref = 001
+        #Build human readable message from FTX field
+        header = ['Felmeddelande: ', 'Order skapad: ',
+            'Framflyttad leveransdag: ', 'Felkod: ', 'Kundens butiksnummer: ']
+        for i in range(len(ftx)):
+            if i < len(header):
+                state['text'] += header[i]
+            state['text'] += ftx[i] + '\n'
+
+    @segment_handler(ORDRSP, 'RFF')
+    def _repord_ordrsp_rff(self, segment, state):
+        if segment[1][0] == 'CR':
+            ref = segment[1][1]
+            if len(ref) < 3:
+                ref = '0' + ref
+            order = state['order'] = self.env['rep.order'].search([('client_order_ref', '=', ref)])[0]
+            self.model = order._name
+            self.res_id = order.id
+
+    @segment_handler(ORDRSP, 'LIN')
+    def _repord_ordrsp_lin(self, segment, state):
+        if state['line']:
+            state['lines'].append(state['line'])
+        state['line'] = {
+            'sequence': segment[1],
+            'status': segment[2],
+        }
+
+    @segment_handler(ORDRSP, 'QTY')
+    def _repord_ordrsp_qty(self, segment, state):
+        if state['line']:
+            state['line']['quantity'] = segment[1][1]
+
+    @segment_handler(ORDRSP, 'UNS')
+    def _repord_ordrsp_uns(self, segment, state):
+        if state['line']:
+            state['lines'].append(state['line'])
+            state['line'] = None
+
+    @segment_handler(ORDRSP, 'end')
+    def _repord_ordrsp_end(self, segment, state):
+        res = 'status: ' + state['order_state']
+        res += '\ndelivery date: ' + state['delivery_date']
+        res += '\nmessage: ' + state['text']
+        if state['lines']:
+            res += '\n' 
+            for line in state['lines']:
+                res += '\nline %s:\n\tproduct: %s\n\tquantity: %s\n\tstatus: %s\n' % (
+                    line.get('sequence', ''), line.get('product', 'not found'),
+                    line.get('quantity', ''),
+                    'Not accepted' if line.get('status', '') == '7' else line.get('status', 'Unknown'))
+        res += '\n\noriginal message:\n' + self._gs1_decode_msg(self.read_body())
+        errors = state['errors']
+        if errors:
+            errors.reverse()
+            self.route_id.log("%s error(s) when reading ORDRSP '%s'.\n%s" % (len(errors), self.name, res), errors)
+            self.state = 'canceled'
         else:
-            super(edi_message, self)._unpack()
+            order = state['order']
+            self.env['mail.message'].create({
+                'body': html_line_breaks(res),
+                'subject': 'Order response received',
+                'res_id': order.id,
+                'model': order._name,
+                'type': 'notification',
+            })
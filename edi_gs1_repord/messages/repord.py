@@ -37,7 +37,8 @@ class edi_message(models.Model):
                 raise ValueError("REPORD: Attached record is not a rep.order! {model}".format(model=self.model_record._name),self.model_record._name)
             order = self.model_record
             order.client_order_ref = self.name_to_number(order.name)
-            msg = self.UNH('ORDERS', ass_code='EDIT30', release='93A')
+            msg = self._gs1_writer()
+            msg += self.UNH('ORDERS', ass_code='EDIT30', release='93A')
             msg += self.BGM('22E', order.client_order_ref)
             msg += self.DTM(137)
             msg += self.DTM(2, order.date_order)
@@ -53,12 +54,12 @@ class edi_message(models.Model):
                     #~ msg += self.LIN()
                     #~ msg += self.PIA(line.product_id, 'SA')
                 #~ else:
-                msg += self.LIN()
+                msg += self.LIN(msg)
                 msg += self.PIA(line.product_id, 'BP', self.model_record.partner_id)
                 msg += self.QTY(line)
             msg += self.UNS()
             if cnt_lines > 0:
                 msg += self.CNT(1, cnt_amount)
                 msg += self.CNT(2, cnt_lines)
-            msg += self.UNT()
-            self.body = base64.b64encode(self._gs1_encode_msg(msg))
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
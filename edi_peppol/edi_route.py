@@ -40,9 +40,9 @@ class edi_envelope(models.Model):
             time = ''
             UNA = "UNA:+.? '"
             UNB = "UNB+UNOC:3+%s:14+%s:14+%s:%s+%s++ICARSP4'" % (route.partner_id.company_id.partner_id.gs1_gln, route.partner_id.gs1_gln, date, time, interchange_control_ref)
-            body = ''.join([base64.b64decode(m.body) for m in envelope.message_ids])
+            body = ''.join([m.read_body() for m in envelope.message_ids])
             UNZ = "UNZ+%s+627'" % (len(envelope.message_ids),len(body))
-            envelope.body = base64.b64encode(UNA + UNB + body + UNZ)
+            envelope.write_body(UNA + UNB + body + UNZ)
         return envelope
 
     def _create_UNB_segment(self,sender, recipient):
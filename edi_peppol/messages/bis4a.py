@@ -65,7 +65,7 @@ Lines
     @api.one
     def unpack(self):
         if self.edi_type.id == self.env.ref('edi_peppol.edi_message_type_bis4a').id:
-            msgd = xmltodict.parse(base64.b64decode(self.body))
+            msgd = xmltodict.parse(self.read_body())
             invd = msgd.get('Invoice')
             if not invd:
                 raise Warning('No Invoice in message!')
@@ -169,7 +169,8 @@ Lines
             )
 
             raise Warning('Not implemented yet')
-            msg = self.UNH(self.edi_type.name)
+            msg = self._gs1_writer()
+            msg += self.UNH(self.edi_type.name)
             #280 = 	Commercial invoice - Document/message claiming payment for goods or services supplied under conditions agreed between seller and buyer.
             #9 = Original - Initial transmission related to a given transaction.
             _logger.warn(invoice.name)
@@ -195,7 +196,7 @@ Lines
             msg += self.RFF(self.consignor_id.vat, 'VA')
             _logger.warn('consignor: %s' % self.consignee_id.company_registry)
             msg += self.RFF(self.consignor_id.company_registry, 'GN')
-            msg += self.NAD_BY()
+            msg += self.NAD_BY(invoice.partner_id)
             msg += self.RFF(self.consignee_id.vat, 'VA')
             msg += self.NAD_CN()
             #CUX Currency
@@ -207,9 +208,10 @@ Lines
             #   MOA Ammount
             #   TAX
             
+            tot_qty = 0
             for line in invoice.invoice_line:
-                self._edi_lines_tot_qty += line.quantity
-                msg += self.LIN(line)
+                tot_qty += line.quantity
+                msg += self.LIN(msg, line)
                 msg += self.PIA(line.product_id, 'SA')
                 #Invoice qty
                 msg += self.QTY(line)
@@ -225,8 +227,8 @@ Lines
                 #Justification for tax exemption
                 #TAX
             msg += self.UNS()
-            msg += self.CNT(1, self._edi_lines_tot_qty)
-            msg += self.CNT(2, self._lin_count)
+            msg += self.CNT(1, tot_qty)
+            msg += self.CNT(2, msg.lin_count)
             #Amount due
             msg += self.MOA(invoice.amount_total, 9)
             #Small change roundoff
@@ -246,6 +248,6 @@ Lines
             #Tax subtotals
             msg += self.TAX('%.2f' % (invoice.amount_tax / invoice.amount_total))
             msg += self.MOA(invoice.amount_tax, 150)
-            msg += self.UNT()
-            self.body = base64.b64encode(msg.encode('utf-8'))
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
 
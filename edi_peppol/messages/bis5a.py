@@ -29,7 +29,6 @@ _logger = logging.getLogger(__name__)
 
 class edi_message(models.Model):
     _inherit='edi.message'
-    _edi_lines_tot_qty = 0
     
     @api.one
     def pack(self):
@@ -38,7 +37,8 @@ class edi_message(models.Model):
             if self.model_record._name != 'account.invoice':
                 raise Warning("INVOIC: Attached record is not an account.invoice! {model}".format(model=self.model_record._name))
             invoice = self.model_record
-            msg = self.UNH(self.edi_type.name)
+            msg = self._gs1_writer()
+            msg += self.UNH(self.edi_type.name)
             #280 = 	Commercial invoice - Document/message claiming payment for goods or services supplied under conditions agreed between seller and buyer.
             #9 = Original - Initial transmission related to a given transaction.
             _logger.warn(invoice.name)
@@ -64,7 +64,7 @@ class edi_message(models.Model):
             msg += self.RFF(self.consignor_id.vat, 'VA')
             _logger.warn('consignor: %s' % self.consignee_id.company_registry)
             msg += self.RFF(self.consignor_id.company_registry, 'GN')
-            msg += self.NAD_BY()
+            msg += self.NAD_BY(invoice.partner_id)
             msg += self.RFF(self.consignee_id.vat, 'VA')
             msg += self.NAD_CN()
             #CUX Currency
@@ -76,9 +76,10 @@ class edi_message(models.Model):
             #   MOA Ammount
             #   TAX
             
+            tot_qty = 0
             for line in invoice.invoice_line:
-                self._edi_lines_tot_qty += line.quantity
-                msg += self.LIN(line)
+                tot_qty += line.quantity
+                msg += self.LIN(msg, line)
                 msg += self.PIA(line.product_id, 'SA')
                 #Invoice qty
                 msg += self.QTY(line)
@@ -94,8 +95,8 @@ class edi_message(models.Model):
                 #Justification for tax exemption
                 #TAX
             msg += self.UNS()
-            msg += self.CNT(1, self._edi_lines_tot_qty)
-            msg += self.CNT(2, self._lin_count)
+            msg += self.CNT(1, tot_qty)
+            msg += self.CNT(2, msg.lin_count)
             #Amount due
             msg += self.MOA(invoice.amount_total, 9)
             #Small change roundoff
@@ -115,6 +116,6 @@ class edi_message(models.Model):
             #Tax subtotals
             msg += self.TAX('%.2f' % (invoice.amount_tax / invoice.amount_total))
             msg += self.MOA(invoice.amount_tax, 150)
-            msg += self.UNT()
-            self.body = base64.b64encode(msg.encode('utf-8'))
+            msg += self.UNT(msg)
+            self.write_body(msg.getvalue())
 
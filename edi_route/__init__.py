@@ -1,2 +1,4 @@
 import edi_route
+import edi_action_queue
+import edi_run_log
 import res_partner
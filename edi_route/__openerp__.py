@@ -21,7 +21,7 @@
 
 {
     'name': 'EDI Routes',
-    'version': '0.1',
+    'version': '0.2',
     'category': 'edi',
     'summary': 'Routes for EDI',
     'licence': 'AGPL-3',
@@ -125,6 +125,8 @@ How to connect a context (edi.route.caller) to a message
     'data': [
         'edi_route_data.xml',
         'edi_route_view.xml',
+        'edi_action_queue_view.xml',
+        'edi_run_log_view.xml',
         'res_partner_view.xml',
         'security/edi_security.xml',
         'security/ir.model.access.csv',
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp import models, fields, api, _
+from openerp.addons.edi_route.edi_route import savepoint, _action_calls, _action_source
+from datetime import timedelta
+import json
+import traceback
+
+import logging
+_logger = logging.getLogger(__name__)
+
+def _dump(value):
+    """Make action keyword arguments JSON serializable, records become {'__records__': model, 'ids': ids}."""
+    if isinstance(value, models.BaseModel):
+        return {'__records__': value._name, 'ids': value.ids}
+    if isinstance(value, (list, tuple)):
+        return [_dump(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _dump(v)) for k, v in value.items())
+    return value
+
+
+def _load(env, value):
+    if isinstance(value, dict):
+        if '__records__' in value:
+            return env[value['__records__']].browse(value['ids']).exists()
+        return dict((k, _load(env, v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_load(env, v) for v in value]
+    return value
+
+
+class edi_action_queue(models.Model):
+    """Outbox of edi_action calls of routes with Deferred Actions. Workflow hooks
+    only add a row here; the dispatcher cron runs the actions after the user's
+    transaction is committed. Actions of the same source record run in the order
+    they were queued, a failing action is retried and holds back the ones after it
+    until it has failed _max_attempts times. It is then failed, which is posted on
+    the route and the source record, and the actions after it go on."""
+    _name = 'edi.action.queue'
+    _description = 'EDI Action Queue'
+    _order = 'id'
+
+    route_id = fields.Many2one(comodel_name='edi.route', string='Route', required=True, ondelete='cascade')
+    caller_name = fields.Char(string='Caller ID', required=True)
+    model = fields.Char(string='Model', index=True)
+    res_id = fields.Integer(string='Record ID', index=True)
+    values = fields.Text(string='Arguments')
+    state = fields.Selection([('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed'), ('cancel', 'Cancelled')], default='pending', index=True)
+    attempts = fields.Integer(default=0)
+    next_attempt = fields.Datetime(string='Next Attempt', default=fields.Datetime.now)
+    error = fields.Text(string='Last Error')
+
+    _max_attempts = 5
+    _keep_days = 7
+    _dispatch_limit = 200   # actions run per cron call, the next call goes on from the oldest again
+
+    @api.model
+    def enqueue(self, route, caller_name, kwargs):
+        """Queue route.edi_action(caller_name, **kwargs), one row per record if a keyword holds several records."""
+        for vals in _action_calls(caller_name, kwargs):
+            vals.pop('records', None)
+            source = _action_source(vals)
+            self.create({
+                'route_id': route.id,
+                'caller_name': caller_name,
+                'model': source and source._name,
+                'res_id': source and source.id,
+                'values': json.dumps(_dump(vals), default=repr),
+            })
+
+    @api.model
+    def dispatch(self):
+        """Cron job: run up to _dispatch_limit due actions in queue order and clean up
+        old done ones. The queue is read _dispatch_limit rows at a time, so rows that
+        are not due yet do not keep the due ones after them waiting."""
+        now = fields.Datetime.now()
+        blocked = set()
+        run = 0
+        last_id = 0
+        while run < self._dispatch_limit:
+            entries = self.search([('state', '=', 'pending'), ('id', '>', last_id)], order='id', limit=self._dispatch_limit)
+            if not entries:
+                break
+            for entry in entries:
+                last_id = entry.id
+                source = entry.model and (entry.model, entry.res_id)
+                if source in blocked:
+                    continue
+                if entry.state == 'pending' and entry.next_attempt <= now:
+                    entry._run()
+                    self._cr.commit()
+                    run += 1
+                if source and entry.state == 'pending':
+                    blocked.add(source)
+                if run >= self._dispatch_limit:
+                    break
+        limit = fields.Datetime.to_string(fields.Datetime.from_string(now) - timedelta(days=self._keep_days))
+        self.search([('state', 'in', ('done', 'cancel')), ('write_date', '<', limit)]).unlink()
+
+    @api.one
+    def _run(self):
+        try:
+            with savepoint(self.env):
+                kwargs = _load(self.env, json.loads(self.values or '{}'))
+                self.route_id.with_context(edi_action_now=True).edi_action(self.caller_name, **kwargs)
+        except Exception as e:
+            _logger.exception('EDI action %s of route %s failed' % (self.caller_name, self.route_id.name))
+            attempts = self.attempts + 1
+            self.write({
+                'attempts': attempts,
+                'error': traceback.format_exc(),
+                'state': 'failed' if attempts >= self._max_attempts else 'pending',
+                'next_attempt': fields.Datetime.to_string(fields.Datetime.from_string(fields.Datetime.now()) + timedelta(minutes=attempts ** 2)),
+            })
+            if self.state == 'failed':
+                self.route_id.log('EDI action %s for %s,%s failed %s times and is given up, later actions of that record go on.\n%s' % (
+                    self.caller_name, self.model, self.res_id, attempts, self.error))
+                source = self.model in self.env.registry and self.env[self.model].browse(self.res_id).exists()
+                if source and hasattr(source, 'message_post'):
+                    source.message_post(
+                        body=_('EDI action %s of route %s failed %s times and is given up, see the EDI Action Queue.') % (
+                            self.caller_name, self.route_id.name, attempts),
+                        subject=_('EDI action failed'))
+        else:
+            self.write({'attempts': self.attempts + 1, 'state': 'done', 'error': False})
+
+    @api.multi
+    def action_retry(self):
+        self.write({'state': 'pending', 'attempts': 0, 'next_attempt': fields.Datetime.now()})
+
+    @api.multi
+    def action_cancel(self):
+        self.write({'state': 'cancel'})
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -27,19 +27,291 @@ import time
 import dateutil
 from time import strptime, mktime, strftime
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT, DEFAULT_SERVER_DATETIME_FORMAT
-from openerp.tools.safe_eval import safe_eval as eval
+from openerp.tools.safe_eval import safe_eval as eval, test_expr, _SAFE_OPCODES, _BUILTINS
+from openerp import tools
 import sys
 import traceback
+import threading
+import Queue
+import os
+import hashlib
+import tempfile
+import shutil
+import weakref
+from cStringIO import StringIO
+from contextlib import contextmanager
+from openerp.addons.edi_route.edi_run_log import run_log_batch
 
 import logging
 _logger = logging.getLogger(__name__)
 
+# First key of the session advisory lock held while a route runs from cron, the second key is the route id.
+ROUTE_LOCK_KEY = 0x45444952
+
+# {cursor: {'files': [store_fname, ...], 'depth': n}}, filestore files _filestore_write created in the open savepoints.
+_savepoint_files = weakref.WeakKeyDictionary()
+# {cursor: n}, while n > 0 ir.attachment leaves the files of removed attachments to edi.body.gc_body_files.
+_keep_files = weakref.WeakKeyDictionary()
+
+# Keyword arguments of edi_action that name the source record of an action, most specific first.
+SOURCE_KEYS = ('picking', 'move', 'invoice', 'order', 'purchase', 'envelope')
+
 def html_line_breaks(msg):
     return msg.replace('\n', '<BR/>')
 
+def _action_source(kwargs):
+    """The record an action is about: the first single record of SOURCE_KEYS, then of the other keywords by name."""
+    for key in SOURCE_KEYS + tuple(sorted(kwargs)):
+        value = kwargs.get(key)
+        if key != 'records' and isinstance(value, models.BaseModel) and len(value) == 1:
+            return value
+    return None
+
+def _action_calls(caller_name, kwargs):
+    """Split the keyword arguments of edi_action into one call per record. One
+    keyword may hold several records, each call binds it to one of them and
+    records to all of them. Otherwise records is the one the caller passed or
+    _action_source (None if there is no single record)."""
+    several = sorted(k for k, v in kwargs.items() if k != 'records' and isinstance(v, models.BaseModel) and len(v) > 1)
+    if len(several) > 1:
+        raise ValueError("EDI action %s: only one keyword argument can hold several records, not %s" % (caller_name, ', '.join(several)))
+    if several:
+        name = several[0]
+        return [dict(kwargs, records=kwargs[name], **{name: record}) for record in kwargs[name]]
+    if 'records' in kwargs:
+        return [dict(kwargs)]
+    return [dict(kwargs, records=_action_source(kwargs))]
+
+@contextmanager
+def savepoint(env):
+    """cr.savepoint() that also drops the record cache when it rolls back, and
+    the filestore files _filestore_write created in it that no attachment uses."""
+    state = _savepoint_files.setdefault(env.cr, {'files': [], 'depth': 0})
+    mark = len(state['files'])
+    state['depth'] += 1
+    try:
+        with env.cr.savepoint():
+            yield
+    except Exception:
+        env.invalidate_all()
+        _discard_files(env, state['files'][mark:])
+        del state['files'][mark:]
+        raise
+    finally:
+        state['depth'] -= 1
+        if not state['depth']:
+            del state['files'][:]
+
+def _discard_files(env, fnames):
+    """Delete the filestore files fnames that no attachment uses."""
+    if not fnames:
+        return
+    env.cr.execute("SELECT store_fname FROM ir_attachment WHERE store_fname IN %s", (tuple(fnames),))
+    used = set(row[0] for row in env.cr.fetchall())
+    attachment = env['ir.attachment']
+    for fname in set(fnames) - used:
+        try:
+            os.unlink(attachment._full_path(fname))
+        except OSError:
+            _logger.warn('Could not remove %s from the filestore' % fname, exc_info=True)
+
+@contextmanager
+def _keeping_files(cr):
+    """ir.attachment unlinks in the block remove the rows only and mark the files
+    for edi.body.gc_body_files, so that a rollback gets whole attachments back."""
+    _keep_files[cr] = _keep_files.get(cr, 0) + 1
+    try:
+        yield
+    finally:
+        _keep_files[cr] -= 1
+
+def _mark_for_gc(checklist, fname):
+    """Leave fname to edi.body.gc_body_files (the checklist of Odoo 9's ir.attachment._file_gc)."""
+    full_path = os.path.join(checklist, fname)
+    if not os.path.exists(full_path):
+        dirname = os.path.dirname(full_path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass    # made by a concurrent mark
+        open(full_path, 'ab').close()
+
+def _filestore_write(attachment_obj, source, chunk_size=65536):
+    """Copy a file object into the filestore, same layout as ir.attachment._get_path. Returns (store_fname, size)."""
+    filestore = attachment_obj._filestore()
+    if not os.path.isdir(filestore):
+        os.makedirs(filestore)
+    sha = hashlib.sha1()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(dir=filestore, prefix='.edi', delete=False)
+    try:
+        for chunk in iter(lambda: source.read(chunk_size), ''):
+            sha.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+        tmp.close()
+        sha = sha.hexdigest()
+        fname = sha[:3] + '/' + sha
+        if not os.path.isfile(attachment_obj._full_path(fname)):
+            fname = sha[:2] + '/' + sha
+            full_path = attachment_obj._full_path(fname)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            if not os.path.isfile(full_path):
+                os.rename(tmp.name, full_path)
+                state = _savepoint_files.get(attachment_obj.env.cr)
+                if state and state['depth']:
+                    state['files'].append(fname)
+    finally:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+    return fname, size
+
+class ir_attachment(models.Model):
+    _inherit = 'ir.attachment'
+
+    def _file_delete(self, cr, uid, fname):
+        if _keep_files.get(cr):
+            return _mark_for_gc(self._full_path(cr, uid, 'checklist'), fname)
+        return super(ir_attachment, self)._file_delete(cr, uid, fname)
+
+class edi_body(models.AbstractModel):
+    """Keeps the body of envelopes and messages in an ir.attachment (the filestore) instead of a base64 column.
+
+    body is still there for views and old code (base64, as before). New code
+    should use read_body/open_body/write_body, which handle raw bytes."""
+    _name = 'edi.body'
+    _description = 'EDI Body Storage'
+
+    _spool_size = 1024 * 1024   # bytes kept in memory by write_body_parts before spilling to disk
+
+    body_attachment_id = fields.Many2one(comodel_name='ir.attachment', string='Body Attachment', readonly=True, copy=False, ondelete='set null')
+    body = fields.Binary(compute='_get_body', inverse='_set_body', search='_search_body', copy=True)
+
+    @api.one
+    def _get_body(self):
+        self.body = self.body_attachment_id.datas
+
+    @api.one
+    def _set_body(self):
+        self.write_body(self.body and base64.b64decode(self.body))
+
+    def _search_body(self, operator, value):
+        return [('body_attachment_id', operator, value)]
+
+    @api.multi
+    def open_body(self):
+        """Return the raw body as a file object (empty if there is no body)."""
+        self.ensure_one()
+        attachment = self.body_attachment_id.with_context(bin_size=False)
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), 'rb')
+        return StringIO(base64.b64decode(attachment.db_datas or ''))
+
+    @api.multi
+    def read_body(self):
+        """Return the raw body as a string."""
+        f = self.open_body()
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    @api.multi
+    def write_body(self, data):
+        """Replace the body with data, a string or a file object with the raw bytes. False removes the body."""
+        self.ensure_one()
+        old = self.body_attachment_id
+        attachment = self.env['ir.attachment']
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if isinstance(data, basestring):
+            data = data and StringIO(data)
+        if data:
+            values = {
+                'name': self.name,
+                'datas_fname': self.name,
+                'type': 'binary',
+                'res_model': self._name,
+                'res_id': self.id,
+            }
+            if attachment._storage() == 'file':
+                values['store_fname'], values['file_size'] = _filestore_write(attachment, data)
+            else:
+                values['datas'] = base64.b64encode(data.read())
+            attachment = attachment.create(values)
+        self.body_attachment_id = attachment
+        if old:
+            # Bodies are rewritten in savepoints, the file goes when the row is gone for good.
+            with _keeping_files(self.env.cr):
+                old.unlink()
+
+    @api.multi
+    def write_body_parts(self, parts):
+        """Replace the body with parts (strings or file objects, which are closed) written one after the other.
+        Nothing is joined in memory, file objects are copied a chunk at a time."""
+        spool = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+        try:
+            for part in parts:
+                if isinstance(part, basestring):
+                    spool.write(part)
+                else:
+                    try:
+                        shutil.copyfileobj(part, spool)
+                    finally:
+                        part.close()
+            spool.seek(0)
+            self.write_body(spool)
+        finally:
+            spool.close()
+
+    @api.multi
+    def unlink(self):
+        attachments = self.mapped('body_attachment_id')
+        res = super(edi_body, self).unlink()
+        with _keeping_files(self.env.cr):
+            attachments.unlink()
+        return res
+
+    @api.model
+    def gc_body_files(self):
+        """Delete the filestore files of replaced and removed bodies that no attachment
+        uses any more (cron). Commits, and keeps ir_attachment locked against writes
+        while it collects, so that no transaction brings a reference back meanwhile."""
+        attachment = self.env['ir.attachment']
+        if attachment._storage() != 'file':
+            return
+        cr = self.env.cr
+        cr.commit()
+        cr.execute("LOCK ir_attachment IN SHARE MODE")
+        checklist = {}
+        for dirpath, dirnames, filenames in os.walk(attachment._full_path('checklist')):
+            dirname = os.path.basename(dirpath)
+            for filename in filenames:
+                checklist['%s/%s' % (dirname, filename)] = os.path.join(dirpath, filename)
+        used = set()
+        for names in cr.split_for_in_conditions(checklist.keys()):
+            cr.execute("SELECT store_fname FROM ir_attachment WHERE store_fname IN %s", (names,))
+            used.update(row[0] for row in cr.fetchall())
+        removed = 0
+        for fname, mark in checklist.iteritems():
+            if fname not in used:
+                try:
+                    os.unlink(attachment._full_path(fname))
+                    removed += 1
+                except OSError:
+                    _logger.warn('Could not remove %s from the filestore' % fname, exc_info=True)
+            try:
+                os.unlink(mark)
+            except OSError:
+                pass
+        cr.commit()
+        _logger.info('gc_body_files: %s files checked, %s removed' % (len(checklist), removed))
+
 class edi_envelope(models.Model):
     _name = 'edi.envelope'
-    _inherit = ['mail.thread']
+    _inherit = ['mail.thread', 'edi.body']
     _description = 'EDI Envelope'
 
     name = fields.Char(string="Name",required=True)
@@ -55,7 +327,6 @@ class edi_envelope(models.Model):
             return self.env['edi.route'].search([])[0]
     route_id = fields.Many2one(comodel_name='edi.route',required=True,default=_route_default)
     date = fields.Datetime(string='Date',default=fields.Datetime.now())
-    body = fields.Binary()
     edi_message_ids = fields.One2many(comodel_name='edi.message',inverse_name='envelope_id')
     state = fields.Selection([('progress', 'Progress'), ('sent','Sent'), ('received','Received'), ('canceled','Canceled')], default='progress')
     ref = fields.Char('Reference')
@@ -80,11 +351,14 @@ class edi_envelope(models.Model):
 
     @api.one
     def split(self):
+        start = self.env['edi.run.log'].start()
         try:
             if not self.state == "progress" or len(self.edi_message_ids)>0:
                 raise TypeError('Cant split an already splited envelope')
-            res = self._split()
+            with savepoint(self.env):
+                res = self._split()
         except ValueError as e:
+            self.env['edi.run.log'].add('split', e, start, route=self.route_id, envelope=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id and self.route_id.name,self.route_type,e)),
                     'subject': "ValueError",
@@ -96,6 +370,7 @@ class edi_envelope(models.Model):
             self.state = "canceled"
             #raise Warning('EDI ValueError in split %s (%s) %s' % (e,id,d))
         except TypeError as e:
+            self.env['edi.run.log'].add('split', e, start, route=self.route_id, envelope=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id and self.route_id.name,self.route_type,e)),
                     'subject': "TypeError",
@@ -107,6 +382,7 @@ class edi_envelope(models.Model):
             _logger.error('edi.envelope.split(): EDI TypeError Route %s type %s Error %s ' % (self.route_id and self.route_id.name,self.route_type,e))
             #raise Warning('EDI TypeError in split %s' % e)
         except IOError as e:
+            self.env['edi.run.log'].add('split', e, start, route=self.route_id, envelope=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id and self.route_id.name,self.route_type,e)),
                     'subject': "IOError",
@@ -118,7 +394,7 @@ class edi_envelope(models.Model):
             _logger.error('edi.envelope.split(): EDI IOError Route %s type %s Error %s ' % (self.route_id and self.route_id.name,self.route_type,e))
             #raise Warning('EDI IOError in split %s' % e)
         except Exception as e:
-            self.env.cr.rollback()
+            self.env['edi.run.log'].add('split', e, start, route=self.route_id, envelope=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id and self.route_id.name or 'None', self.route_type or 'None', e)),
                     'subject': "Exception",
@@ -130,14 +406,7 @@ class edi_envelope(models.Model):
             _logger.error('edi.envelope.split(): Exception %s type %s Error %s ' % (self.route_id and self.route_id.name or 'None', self.route_type, e))
         else:
             if self.state == 'progress':
-                self.env['mail.message'].create({
-                    'body': _("Route %s type %s %s messages created\n" % (self.route_id and self.route_id.name, ','.join(['%s(%s)' % (m.name, m.edi_type.name) for m in self.edi_message_ids]),'ok')),
-                    'subject': "Success",
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': self.id,
-                    'model': self._name,
-                    'type': 'notification',
-                })
+                self.env['edi.run.log'].add('split', '%s messages created' % len(self.edi_message_ids), start, route=self.route_id, envelope=self, size=self.body_attachment_id.file_size)
                 self.state = "received"
 
     @api.one
@@ -146,30 +415,32 @@ class edi_envelope(models.Model):
             msg = self.env['edi.message'].create({
                 'name': 'plain',
                 'envelope_id': self.id,
-                'body': self.body,
                 'route_type': self.route_type,
                 'sender': self.sender,
                 'recipient': self.recipient,
                 #~ 'consignor_id': sender.id,
                 #~ 'consignee_id': recipient.id,
             })
+            msg.write_body(self.read_body())
             msg.unpack()
         self.envelope_opened()
 
     @api.one
     def envelope_opened(self):
         """Run when an envelope has been received and opened. Override to create control messages."""
-        self.route_id.edi_action('edi.envelope.envelope_opened', envelope=self)
+        self.route_id.with_context(edi_action_now=True).edi_action('edi.envelope.envelope_opened', envelope=self)
 
     @api.one
     def fold(self):
+        start = self.env['edi.run.log'].start()
         #for m in self.env['edi.message'].search([('envelope_id','=',None),('route_id','=',route.id)]):
         #    m.envelope_id = self.id
         try:
-            if not self.state == "progress" or self.body:
+            if not self.state == "progress" or self.body_attachment_id:
                 raise TypeError('Cant fold an already folded envelope')
             res = self._fold(self.route_id)
         except ValueError as e:
+            self.env['edi.run.log'].add('fold', e, start, route=self.route_id, envelope=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "ValueError",
@@ -181,6 +452,7 @@ class edi_envelope(models.Model):
             _logger.error('edi.envelope.fold(): EDI ValueError Route %s type %s #%s Error %s ' % (self.route_id.name,self.route_type,self.route_id.run_sequence,e))
             #raise Warning('EDI ValueError in split %s (%s) %s' % (e,id,d))
         except TypeError as e:
+            self.env['edi.run.log'].add('fold', e, start, route=self.route_id, envelope=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s #%s Error %s\n" % (self.route_id.name,self.route_type,self.route_id.run_sequence,e)),
                     'subject': "TypeError",
@@ -191,6 +463,7 @@ class edi_envelope(models.Model):
             self.state = "canceled"
             _logger.error('edi.envelope.fold(): EDI TypeError Route %s type %s #%s Error %s ' % (self.route_id.name,self.route_type,self.route_id.run_sequence,e))
         except IOError as e:
+            self.env['edi.run.log'].add('fold', e, start, route=self.route_id, envelope=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error #%s %s\n" % (self.route_id.name,self.route_type,self.route_id.run_sequence,e)),
                     'subject': "IOError",
@@ -202,23 +475,17 @@ class edi_envelope(models.Model):
             _logger.error('edi.envelope.fold(): EDI IOError Route %s type %s Error %s ' % (self.route_id.name,self.route_type,e))
             #raise Warning('EDI IOError in split %s' % e)
         else:
-            self.env['mail.message'].create({
-                    'body': _("Route %s type %s #%s %s messages created\n" % (self.route_id.name,self.route_type,self.route_id.run_sequence,'ok')),
-                    'subject': "Success",
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': self.id,
-                    'model': self._name,
-                    'type': 'notification',})
+            self.env['edi.run.log'].add('fold', '%s messages folded' % len(self.edi_message_ids), start, route=self.route_id, envelope=self, size=self.body_attachment_id.file_size)
 
     @api.multi
     def _fold(self,route): # Folds messages in an envelope
         if route.route_type == 'plain':
-            self.body = base64.b64encode(''.join([base64.b64decode(m.body) for m in self.edi_message_ids]))
+            self.write_body_parts(m.open_body() for m in self.edi_message_ids)
         return self
 
 class edi_message(models.Model):
     _name = 'edi.message'
-    _inherit = ['mail.thread']
+    _inherit = ['mail.thread', 'edi.body']
     _description = 'EDI Message'
 
     name = fields.Char(string="Name",required=True)
@@ -229,7 +496,6 @@ class edi_message(models.Model):
     recipient = fields.Many2one(comodel_name='res.partner', string='Interchange Recipient')
     forwarder_id = fields.Many2one(comodel_name='res.partner', string="Forwarder", help="Forwarder - the party planning the transport on behalf of the consignor or consignee.")
     carrier_id = fields.Many2one(comodel_name='res.partner', string="Carrier", help="Carrier - the party transporting the goods between two points.")
-    body = fields.Binary()
     model = fields.Char(string="Model")
     res_id = fields.Integer()
     to_import = fields.Boolean(default=False)
@@ -238,6 +504,7 @@ class edi_message(models.Model):
     route_type = fields.Selection(selection=[('plain','Plain')], default='plain')
     edi_type = fields.Many2one(comodel_name='edi.message.type', string="Edi Type")
     state = fields.Selection([('progress', 'Progress'), ('sent','Sent'), ('received','Received'), ('canceled','Canceled')], default='progress')
+    packed_version = fields.Datetime(string='Packed Version', readonly=True, copy=False, help="Last update of the source record when the body was packed. Fold only packs again if the source record has changed since.")
     
     def log(self, message, error_info=None, subject = ''):
         #TODO: Mail errors and implement this on envelope and message as well.
@@ -262,9 +529,12 @@ class edi_message(models.Model):
 
     @api.one
     def unpack(self):
+        start = self.env['edi.run.log'].start()
         try:
-            res = self._unpack()
+            with savepoint(self.env):
+                res = self._unpack()
         except ValueError as e:
+            self.env['edi.run.log'].add('unpack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "ValueError",
@@ -276,6 +546,7 @@ class edi_message(models.Model):
             #raise Warning('EDI ValueError in split %s (%s) %s' % (e,id,d))
             self.state = 'canceled'
         except TypeError as e:
+            self.env['edi.run.log'].add('unpack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "TypeError",
@@ -287,6 +558,7 @@ class edi_message(models.Model):
             #raise Warning('EDI TypeError in split %s' % e)
             self.state = 'canceled'
         except IOError as e:
+            self.env['edi.run.log'].add('unpack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "IOError",
@@ -298,16 +570,11 @@ class edi_message(models.Model):
             #raise Warning('EDI IOError in split %s' % e)
             self.state = 'canceled'
         except Warning as e:
+            self.env['edi.run.log'].add('unpack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             _logger.error('edi.message.unpack(): EDI Warning Route %s type %s Error %s ' % (self.route_id.name,self.route_type,e))
             self.state = 'canceled'
         else:
-            self.env['mail.message'].create({
-                    'body': _("Route %s type %s %s messages unpacked\n" % (self.route_id.name,self.route_type,self.edi_type.name)),
-                    'subject': "Success",
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': self.id,
-                    'model': self._name,
-                    'type': 'notification',})
+            self.env['edi.run.log'].add('unpack', self.edi_type.name or '', start, route=self.route_id, envelope=self.envelope_id, message=self, size=self.body_attachment_id.file_size)
             self.state = 'received'
 
     @api.one
@@ -316,9 +583,12 @@ class edi_message(models.Model):
 
     @api.one
     def pack(self):
+        start = self.env['edi.run.log'].start()
         try:
-            res = self._pack()
+            with savepoint(self.env):
+                res = self._pack()
         except ValueError as e:
+            self.env['edi.run.log'].add('pack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Value Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "ValueError",
@@ -329,6 +599,7 @@ class edi_message(models.Model):
             _logger.error('edi.message.pack(): EDI ValueError Route %s type %s Error %s ' % (self.route_id.name,self.route_type,e))
             #raise Warning('EDI ValueError in split %s (%s) %s' % (e,id,d))
         except TypeError as e:
+            self.env['edi.run.log'].add('pack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Type Error %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "TypeError",
@@ -340,6 +611,7 @@ class edi_message(models.Model):
             raise
             raise Warning('EDI TypeError in split %s' % e)
         except IOError as e:
+            self.env['edi.run.log'].add('pack', e, start, route=self.route_id, envelope=self.envelope_id, message=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s IOError %s\n" % (self.route_id.name,self.route_type,e)),
                     'subject': "IOError",
@@ -350,18 +622,34 @@ class edi_message(models.Model):
             _logger.error('edi.message.pack(): EDI IOError Route %s type %s Error %s ' % (self.route_id.name,self.route_type,e))
             #raise Warning('EDI IOError in split %s' % e)
         else:
-            self.env['mail.message'].create({
-                    'body': _("Route %s type %s %s messages packed\n" % (self.route_id.name, self.route_type, self.edi_type.name)),
-                    'subject': "Success",
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': self.id,
-                    'model': self._name,
-                    'type': 'notification',})
+            self.packed_version = self._source_versions().get(self.id) or fields.Datetime.now()
+            self.env['edi.run.log'].add('pack', self.edi_type.name or '', start, route=self.route_id, envelope=self.envelope_id, message=self, size=self.body_attachment_id.file_size)
 
     @api.one
     def _pack(self):
         pass
 
+    @api.multi
+    def _source_versions(self):
+        """Return {message id: write_date of the source record (model, res_id)}, one query per model."""
+        res_ids = {}
+        for msg in self:
+            if msg.model and msg.res_id and msg.model in self.env.registry:
+                res_ids.setdefault(msg.model, {}).setdefault(msg.res_id, []).append(msg.id)
+        versions = {}
+        for model, ids in res_ids.items():
+            for record in self.env[model].search_read([('id', 'in', ids.keys())], ['write_date']):
+                for msg_id in ids[record['id']]:
+                    versions[msg_id] = record['write_date']
+        return versions
+
+    @api.multi
+    def _pack_outdated(self):
+        """Return the messages whose body is missing or older than their source record."""
+        versions = self._source_versions()
+        return self.filtered(lambda msg: not msg.body_attachment_id or not msg.packed_version
+            or (msg.id in versions and versions[msg.id] != msg.packed_version))
+
     def _edi_message_create(self, edi_type=None, obj=None, sender=None, recipient=None, consignee=None, consignor=None, route=None, check_double=True):
         if consignee and obj and edi_type:
             #do not create message if edi type is not listed in consignee
@@ -383,20 +671,7 @@ class edi_message(models.Model):
                     'consignee_id': consignee.id,
             })
             message.pack()
-            self.env['mail.message'].create({
-                    'body': _("{type} <a href='/web#model={model}&id={id}'>{message}</a> created\n").format(type=self.env.ref(edi_type).name,model=message._name,id=message.id,message=message.name),
-                    'subject': self.env.ref(edi_type).name,
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': obj.id,
-                    'model': obj._name,
-                    'type': 'notification',})
-            self.env['mail.message'].create({
-                    'body': _("{type} <a href='/web#model={model}&id={id}'>{message}</a> created\n").format(type=self.env.ref(edi_type).name,model=obj._name,id=obj.id,message=obj.name),
-                    'subject': self.env.ref(edi_type).name,
-                    'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                    'res_id': message.id,
-                    'model': message._name,
-                    'type': 'notification',})
+            self.env['edi.run.log'].add('create', '%s for %s,%s' % (self.env.ref(edi_type).name, obj._name, obj.id), route=message.route_id, message=message)
 
     @api.one
     def _model_record(self):
@@ -433,7 +708,9 @@ class edi_route(models.Model):
     run_sequence = fields.Char(string="Last run id")
     route_type = fields.Selection(selection=[('plain','Plain')],default='plain')
     test_mode = fields.Boolean('Test Mode') #TODO: Implement in BGM?
+    commit_interval = fields.Integer(string='Commit Interval', default=10, help="Commit after this many envelopes have been split in a run. Every envelope and message is processed in its own savepoint, 0 commits only when the run is done.")
     route_line_ids = fields.One2many('edi.route.line', 'route_id', 'Python Acctions',copy=True)
+    defer_actions = fields.Boolean(string='Deferred Actions', help="Queue the python actions of workflow hooks and run them from a cron job after the transaction is committed, instead of while the user waits.")
 
     @api.one
     def _envelope_count(self):
@@ -459,48 +736,72 @@ class edi_route(models.Model):
         for route in self:
             messages = self.env['edi.message'].search([('envelope_id', '=', None), ('route_id', '=', route.id), ('body', '!=', None)])
             if len(messages) > 0:
-                _logger.error('EDI Fold Route %s Messages %s ' % (route.name, messages))
-                for recipient in set(messages.mapped(lambda msg: msg.recipient)):
-                    _logger.error('EDI Fold Route %s type %s Recipient %s ' % (route.name, route.route_type, recipient))
-                    #Sort by application
-                    no_app_msg_ids = []
-                    for app in recipient.edi_application_lines:
-                        msg_ids = []
-                        for msg in messages.filtered(lambda msg: msg.edi_type == app.edi_type and msg.recipient == recipient):
-                            try:
+                plan = route._fold_plan(messages)
+                # Pack everything first, then create the envelopes. Messages
+                # whose source record is unchanged keep the body they have.
+                outdated = messages._pack_outdated()
+                _logger.info('EDI Fold Route %s: packing %s of %s messages' % (route.name, len(outdated), len(messages)))
+                groups = []
+                for recipient, application, msgs in plan:
+                    packed = self.env['edi.message']
+                    for msg in msgs:
+                        try:
+                            if msg in outdated:
                                 msg.pack()
-                                if app.name:
-                                    msg_ids.append(msg.id)
-                                else:
-                                    no_app_msg_ids.append(msg.id)
-                            except Exception as e:
-                                msg.state = 'canceled'
-                        if app.name and msg_ids:
-                            envelope = self.env['edi.envelope'].create({
-                                'name': self.env['ir.sequence'].next_by_id(self.env.ref('edi_route.sequence_edi_envelope').id),
-                                'route_id': route.id,
-                                'route_type': route.route_type,
-                                'recipient': recipient.id,
-                                'sender': self.env.ref('base.main_partner').id,
-                                'application': app.name,
-                                'edi_message_ids': [(6, 0, msg_ids)]
-                            })
-                            envelope.fold()
-                            envelopes.append(envelope)
-                    #Handle all messages not covered by named applications
-                    if no_app_msg_ids:
-                        envelope = self.env['edi.envelope'].create({
-                            'name': self.env['ir.sequence'].next_by_id(self.env.ref('edi_route.sequence_edi_envelope').id),
-                            'route_id': route.id,
-                            'route_type': route.route_type,
-                            'recipient': recipient.id,
-                            'sender': self.env.ref('base.main_partner').id,
-                            'edi_message_ids': [(6, 0, no_app_msg_ids)]
-                        })
-                        envelope.fold()
-                        envelopes.append(envelope)
+                            packed |= msg
+                        except Exception as e:
+                            msg.state = 'canceled'
+                    if packed:
+                        groups.append((recipient, application, packed))
+                envelope_obj = self.env['edi.envelope'].with_context(mail_create_nolog=True, mail_create_nosubscribe=True)
+                sequence = self.env.ref('edi_route.sequence_edi_envelope')
+                sender = self.env.ref('base.main_partner')
+                for recipient, application, packed in groups:
+                    envelope = envelope_obj.create({
+                        'name': self.env['ir.sequence'].next_by_id(sequence.id),
+                        'route_id': route.id,
+                        'route_type': route.route_type,
+                        'recipient': recipient.id,
+                        'sender': sender.id,
+                        'application': application,
+                        'edi_message_ids': [(6, 0, packed.ids)]
+                    })
+                    envelope.fold()
+                    envelopes.append(envelope)
         return envelopes
 
+    @api.multi
+    def _fold_plan(self, messages):
+        """Group messages to fold in one pass. Returns [(recipient, application, messages)].
+
+        Messages go by (recipient, edi type) to the recipient's application lines
+        of that type, the first line wins. Lines without an application name share
+        one envelope per recipient. Messages with no matching line are left out."""
+        self.ensure_one()
+        by_type = {}
+        for msg in messages:
+            by_type.setdefault((msg.recipient, msg.edi_type), []).append(msg.id)
+        plan = []
+        message_obj = self.env['edi.message']
+        for recipient in set(r for r, t in by_type):
+            no_app = message_obj
+            for app in recipient.edi_application_lines:
+                msg_ids = by_type.pop((recipient, app.edi_type), None)
+                if not msg_ids:
+                    continue
+                if app.name:
+                    plan.append((recipient, app.name, message_obj.browse(msg_ids)))
+                else:
+                    no_app |= message_obj.browse(msg_ids)
+            #Handle all messages not covered by named applications
+            if no_app:
+                plan.append((recipient, False, no_app))
+        _logger.info('EDI Fold Route %s: %s messages in %s envelopes (%s), %s messages without application line' % (
+            self.name, sum(len(m) for r, a, m in plan), len(plan),
+            ', '.join(['%s/%s: %s' % (r.name, a or '-', len(m)) for r, a, m in plan]),
+            sum(len(ids) for ids in by_type.values())))
+        return plan
+
     @api.multi
     def _run_out(self, envelopes):
         pass
@@ -511,18 +812,40 @@ class edi_route(models.Model):
 
     @api.one
     def run(self):
+        """Run the route. Run log rows are written in batches and get the id of this run,
+        which is only taken from the sequence when the run logs or performs anything."""
+        sequence = []
+
+        def run_sequence():
+            if not sequence:
+                sequence.append(self.env['ir.sequence'].next_by_id(self.env.ref('edi_route.sequence_edi_run').id))
+            return sequence[0]
+        with run_log_batch(self.env, run_sequence):
+            if self._run()[0]:
+                self.run_sequence = run_sequence()
+
+    @api.one
+    def _run(self):
+        """Returns True if anything was sent or received."""
         # out
         run_performed = False
+        run_log = self.env['edi.run.log']
         try:
             # create outgoing envelopes
+            start = run_log.start()
             envelopes = self.fold()
+            if envelopes:
+                run_log.add('run.fold', '%s envelopes' % len(envelopes), start, route=self, size=self._body_size(envelopes))
             for e in self.env['edi.envelope'].search([('state', '=', 'progress'), ('route_id', '=', self.id)]):
                 if e not in envelopes:
                     envelopes.append(e)
+            start = run_log.start()
             self._run_out(envelopes)
             if envelopes:
+                run_log.add('run.out', '%s envelopes' % len(envelopes), start, route=self, size=self._body_size(envelopes))
                 run_performed = True
         except ValueError as e:
+            self.env['edi.run.log'].add('run.out', e, route=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Value Error %s\n" % (self.name, self.route_type, e)),
                     'subject': "ValueError",
@@ -532,6 +855,7 @@ class edi_route(models.Model):
                     'type': 'notification',})
             _logger.error('edi.route.run() (out): EDI ValueError Route %s type %s Error %s ' % (self.name, self.route_type, e))
         except TypeError as e:
+            self.env['edi.run.log'].add('run.out', e, route=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Type Error %s\n" % (self.name, self.route_type, e)),
                     'subject': "TypeError",
@@ -542,6 +866,7 @@ class edi_route(models.Model):
             _logger.error('edi.route.run() (out): EDI TypeError Route %s type %s Error %s ' % (self.name, self.route_type, e))
             raise Warning('EDI TypeError in run(out) %s' % e)
         except IOError as e:
+            self.env['edi.run.log'].add('run.out', e, route=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s IOError %s\n" % (self.name, self.route_type, e)),
                     'subject': "IOError",
@@ -561,9 +886,14 @@ class edi_route(models.Model):
             pass
 
         # in
+        envelopes = []
         try:
+            start = run_log.start()
             envelopes = self._run_in()
+            if envelopes:
+                run_log.add('run.in', '%s envelopes' % len(envelopes), start, route=self, size=self._body_size(envelopes))
         except ValueError as e:
+            self.env['edi.run.log'].add('run.in', e, route=self)
             id = self.env['mail.message'].create({
                     'body': _("Route %s type %s Value Error %s\n" % (self.name, self.route_type, e)),
                     'subject': "ValueError",
@@ -573,6 +903,7 @@ class edi_route(models.Model):
                     'type': 'notification',})
             _logger.error('edi.route.run() (in): EDI ValueError Route %s type %s Error %s ' % (self.name, self.route_type, e))
         except TypeError as e:
+            self.env['edi.run.log'].add('run.in', e, route=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s Type Error %s\n" % (self.name, self.route_type, e)),
                     'subject': "TypeError",
@@ -583,6 +914,7 @@ class edi_route(models.Model):
             _logger.error('edi.route.run() (in): EDI TypeError Route %s type %s Error %s ' % (self.name, self.route_type, e))
             raise Warning('EDI TypeError in split %s' % e)
         except IOError as e:
+            self.env['edi.run.log'].add('run.in', e, route=self)
             self.env['mail.message'].create({
                     'body': _("Route %s type %s IOError %s\n" % (self.name, self.route_type, e)),
                     'subject': "IOError",
@@ -603,18 +935,30 @@ class edi_route(models.Model):
         finally:
             if envelopes:
                 run_performed = True
+                # Received files are already removed from the server, keep the envelopes
+                self.env['edi.run.log'].flush()
+                self._cr.commit()
+                split_count = 0
+                start = run_log.start()
                 for envelope in envelopes:
                     if envelope.state == 'progress':
                         try:
-                            self._cr.commit()
-                            envelope.split()
+                            with savepoint(self.env):
+                                envelope.split()
                         except Exception as e:
-                            self._cr.rollback()
                             envelope.state = 'canceled'
                             #TODO: Handle Warning
                             self.log('Error when processing envelope %s\n%s' % (envelope.name, e))
-        if run_performed:
-            self.run_sequence = self.env['ir.sequence'].next_by_id(self.env.ref('edi_route.sequence_edi_run').id)
+                        split_count += 1
+                        if self.commit_interval and split_count % self.commit_interval == 0:
+                            self.env['edi.run.log'].flush()
+                            self._cr.commit()
+                run_log.add('run.split', '%s envelopes' % split_count, start, route=self, size=self._body_size(envelopes))
+        return run_performed
+
+    @api.model
+    def _body_size(self, envelopes):
+        return sum(e.body_attachment_id.file_size or 0 for e in envelopes)
     
     def log(self, message, error_info=None):
         #TODO: Mail errors and implement this on envelope and message as well.
@@ -635,23 +979,95 @@ class edi_route(models.Model):
     
     @api.v7
     def cron_job(self, cr, uid, context=None):
+        """Run all routes that are due, each in its own thread, cursor and environment.
+        The number of threads is set by the system parameter edi_route.cron_workers."""
+        now = fields.Datetime.now()
+        route_ids = []
         for route in self.pool.get('edi.route').browse(cr, uid, self.pool.get('edi.route').search(cr, uid, [('active','=',True)])):
             if not route.next_run:
-                route.next_run = fields.Datetime.now()
-            if (route.next_run < fields.Datetime.now()):
+                route.next_run = now
+            elif route.next_run < now:
+                route_ids.append(route.id)
+        # Release the rows written above before the route cursors update them.
+        cr.commit()
+        if not route_ids:
+            return
+        workers = int(self.pool.get('ir.config_parameter').get_param(cr, uid, 'edi_route.cron_workers', '4') or 1)
+        queue = Queue.Queue()
+        for route_id in route_ids:
+            queue.put(route_id)
+        threads = []
+        for i in range(max(1, min(workers, len(route_ids)))):
+            thread = threading.Thread(target=self._cron_worker, args=(cr.dbname, uid, queue, context), name='edi.route.cron.%s' % i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _cron_worker(self, dbname, uid, queue, context=None):
+        threading.current_thread().dbname = dbname
+        while True:
+            try:
+                route_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+            with api.Environment.manage():
+                self._cron_run_route(uid, route_id, context)
+
+    @api.one
+    def _cron_schedule(self):
+        """Set the next run of the cron job one interval from now."""
+        self.next_run = fields.Datetime.from_string(fields.Datetime.now()) + timedelta(minutes=self.frequency_quant * int(self.frequency_uom))
+
+    def _cron_run_route(self, uid, route_id, context=None):
+        """Run one route in a new cursor, unless another cursor holds its advisory lock."""
+        cr = self.pool.cursor()
+        try:
+            cr.execute('SELECT pg_try_advisory_lock(%s, %s)', (ROUTE_LOCK_KEY, route_id))
+            if not cr.fetchone()[0]:
+                _logger.info('Cron job for route %s skipped, it is already running' % route_id)
+                return
+            route = api.Environment(cr, uid, context or {})['edi.route'].browse(route_id)
+            try:
                 route.run()
-                route.next_run = fields.Datetime.from_string(fields.Datetime.now()) + timedelta(minutes=route.frequency_quant * int(route.frequency_uom))
+                route._cron_schedule()
+                cr.commit()
                 _logger.info('Cron job for %s done' % route.name)
+            except Exception:
+                cr.rollback()
+                _logger.exception('Cron job for route %s failed' % route_id)
+                # Try again after one interval, not at every cron call.
+                try:
+                    route.env.invalidate_all()
+                    route._cron_schedule()
+                    cr.commit()
+                except Exception:
+                    cr.rollback()
+                    _logger.exception('Cron job for route %s could not set the next run' % route_id)
+            finally:
+                cr.execute('SELECT pg_advisory_unlock(%s, %s)', (ROUTE_LOCK_KEY, route_id))
+                cr.commit()
+        finally:
+            cr.close()
 
     @api.one
     def edi_action(self, caller_name, **kwargs):
+        """Run the route lines of caller_name. A keyword argument may hold several
+        records (e.g. order=orders); the lines then run once per record with that
+        name bound to the single record and records bound to all of them. With
+        single records only, records is the source record (see SOURCE_KEYS).
+        Several keywords with several records each raise ValueError."""
         _logger.debug("Caller ID: %s kwargs %s" % (caller_name, kwargs))
-        caller = self.env['edi.route.caller'].search([('name', '=', caller_name)], limit=1)
-        if caller:
-            _logger.debug("Caller: %s; %s" % (caller.name, self.route_line_ids.filtered(lambda a: a.caller_id.id == caller.id)))
-            for action in self.route_line_ids.filtered(lambda a: a.caller_id.id == caller.id):
-                _logger.debug("Caller ID: %s; line %s kwargs %s" % (caller_name, action.name,kwargs))
-                action.run_action_code(kwargs)
+        if self.defer_actions and not self._context.get('edi_action_now'):
+            self.env['edi.action.queue'].enqueue(self, caller_name, kwargs)
+            return
+        actions = self.env['edi.route.line']._get_actions(self.id, caller_name)
+        if actions is not None:
+            for vals in _action_calls(caller_name, kwargs):
+                for line_id, code in actions:
+                    action = self.env['edi.route.line'].browse(line_id)
+                    _logger.debug("Caller ID: %s; line %s kwargs %s" % (caller_name, action.name, vals))
+                    action.run_action_code(dict(vals), code)
         else:
             #raise Warning(caller_name,kwargs)
             self.env['mail.message'].create({
@@ -662,16 +1078,28 @@ class edi_route(models.Model):
                     'model': self._name,
                     'type': 'notification',})
             obj = kwargs.get('order') or kwargs.get('picking') or kwargs.get('invoice')
-            if obj:
+            for o in obj or []:
                 self.env['mail.message'].create({
                         'body': _("Caller ID not found: %s; kwargs %s" % (caller_name, kwargs)),
                         'subject': "EDI Error %s" % caller_name,
                         'author_id': self.env['res.users'].browse(self.env.uid).partner_id.id,
-                        'res_id': obj.id,
-                        'model': obj._name,
+                        'res_id': o.id,
+                        'model': o._name,
                         'type': 'notification',})
             _logger.error("Caller ID not found: %s; kwargs %s" % (caller_name, kwargs))
 
+    @api.model
+    def edi_action_records(self, caller_name, name, records, get_routes, **kwargs):
+        """Call edi_action once per route for all records that use it.
+        get_routes(record) returns the route(s) of a record (a record, recordset, list or None)."""
+        by_route = {}
+        for record in records:
+            for route in get_routes(record) or []:
+                by_route[route] = by_route.get(route, records.browse()) | record
+        for route, recs in by_route.items():
+            kwargs[name] = recs
+            route.edi_action(caller_name, **kwargs)
+
 class edi_route_lines(models.Model):
     _name = 'edi.route.line'
 
@@ -686,11 +1114,56 @@ class edi_route_lines(models.Model):
     )
     route_id = fields.Many2one('edi.route', 'EDI Route', required=True)
 
+    @tools.ormcache(skiparg=3)
+    def _get_actions(self, cr, uid, route_id, caller_name):
+        """Return [(line id, compiled code)] of the route for caller_name, or None if there is no such caller.
+        Cached until a route line or caller changes; code that does not compile is None."""
+        caller_ids = self.pool['edi.route.caller'].search(cr, uid, [('name', '=', caller_name)], limit=1)
+        if not caller_ids:
+            return None
+        actions = []
+        line_ids = self.search(cr, uid, [('route_id', '=', route_id), ('caller_id', '=', caller_ids[0])])
+        for line in self.browse(cr, uid, line_ids):
+            try:
+                code = test_expr(line.code.strip(), _SAFE_OPCODES, mode='exec')
+            except (SyntaxError, ValueError):
+                _logger.error('code %s route line %s does not compile' % (line.code.strip(), line.id))
+                code = None
+            actions.append((line.id, code))
+        return actions
+
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        self.clear_caches()
+        return super(edi_route_lines, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(edi_route_lines, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(edi_route_lines, self).unlink()
+
     @api.one
-    def run_action_code(self, values):
+    def run_action_code(self, values, code=False):
+        """Run the line with values. code is the compiled code from _get_actions, else the code is compiled here."""
         try:
             eval_context = self._get_eval_context(values)
-            eval(self.code.strip(), eval_context, mode="exec", nocopy=True)  # nocopy allows to return 'result'
+            if code is False:
+                eval(self.code.strip(), eval_context, mode="exec", nocopy=True)  # nocopy allows to return 'result'
+            elif code:
+                # Same globals and error handling as safe_eval, without compiling again.
+                eval_context['__builtins__'] = _BUILTINS
+                try:
+                    exec code in eval_context
+                except (except_orm, Warning, RedirectWarning):
+                    raise
+                except Exception as e:
+                    raise ValueError('"%s" while evaluating\n%r' % (e, self.code.strip())), None, sys.exc_info()[2]
             if 'result' in eval_context:
                 return eval_context['result']
         except SyntaxError:
@@ -701,7 +1174,6 @@ class edi_route_lines(models.Model):
         """ Prepare the context used when evaluating python code.
 
         :returns: dict -- evaluation context given to (safe_)eval """
-        import openerp
         values.update({
             # python libs
             'time': time,
@@ -713,7 +1185,7 @@ class edi_route_lines(models.Model):
             # orm
             'env': self.env,
             # Exceptions
-            'Warning': openerp.exceptions.Warning,
+            'Warning': Warning,
         })
         return values
 
@@ -723,6 +1195,22 @@ class edi_route_caller(models.Model):
 
     name = fields.Char('name')
 
+    @api.model
+    @api.returns('self', lambda value: value.id)
+    def create(self, vals):
+        self.env['edi.route.line'].clear_caches()
+        return super(edi_route_caller, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.env['edi.route.line'].clear_caches()
+        return super(edi_route_caller, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['edi.route.line'].clear_caches()
+        return super(edi_route_caller, self).unlink()
+
     _sql_constraints = [
         ('name_uniq', 'unique(name)', 'Caller ID must be unique!'),
     ]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp import models, fields, api, http, tools, _
+from openerp.exceptions import Warning
+from openerp.http import request
+from openerp.tools import ustr
+from contextlib import contextmanager
+from datetime import timedelta
+import hmac
+import time
+import weakref
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# {cursor: {'rows': [...], 'depth': n, 'run_sequence': str}}, rows not yet written.
+_buffers = weakref.WeakKeyDictionary()
+
+_COLUMNS = ('date', 'run_sequence', 'route_id', 'envelope_id', 'message_id', 'level', 'code', 'name', 'duration_ms', 'queries', 'size')
+
+
+def _buffer(cr):
+    return _buffers.setdefault(cr, {'rows': [], 'depth': 0, 'run_sequence': None})
+
+
+@contextmanager
+def run_log_batch(env, run_sequence=None):
+    """Keep edi.run.log rows in memory and write them in one insert when the block ends
+    (or every _batch_size rows). Rows added in the block get run_sequence, which
+    may be a function that returns it, called when the first row is added."""
+    buf = _buffer(env.cr)
+    previous = buf['run_sequence']
+    buf['depth'] += 1
+    if run_sequence:
+        buf['run_sequence'] = run_sequence
+    try:
+        yield
+    finally:
+        buf['depth'] -= 1
+        try:
+            env['edi.run.log'].flush()
+        finally:
+            buf['run_sequence'] = previous
+
+
+class edi_run_log(models.Model):
+    """Append-only log of what routes, envelopes and messages did. Successes are
+    only logged here, errors are also posted in the chatter of the record."""
+    _name = 'edi.run.log'
+    _description = 'EDI Run Log'
+    _order = 'id desc'
+    _log_access = False
+
+    date = fields.Datetime(string='Date', default=fields.Datetime.now, index=True, readonly=True)
+    run_sequence = fields.Char(string='Run', index=True, readonly=True)
+    route_id = fields.Many2one(comodel_name='edi.route', string='Route', ondelete='cascade', index=True, readonly=True)
+    envelope_id = fields.Many2one(comodel_name='edi.envelope', string='Envelope', ondelete='set null', readonly=True)
+    message_id = fields.Many2one(comodel_name='edi.message', string='Message', ondelete='set null', readonly=True)
+    level = fields.Selection([('info', 'Info'), ('warning', 'Warning'), ('error', 'Error')], string='Level', readonly=True)
+    code = fields.Char(string='Code', help="Stage and outcome, eg split.ok or unpack.ValueError", readonly=True)
+    name = fields.Char(string='Text', readonly=True)
+    duration_ms = fields.Integer(string='Duration (ms)', readonly=True)
+    queries = fields.Integer(string='SQL Queries', readonly=True)
+    size = fields.Integer(string='Bytes', help="Size of the body sent, received, folded, split, packed or unpacked", readonly=True)
+
+    _batch_size = 200
+
+    @api.model
+    def start(self):
+        """Return the start of a stage for add(): (time, SQL queries run by the cursor so far)."""
+        return (time.time(), getattr(self.env.cr, 'sql_log_count', 0))
+
+    @api.model
+    def add(self, stage, result='', start=None, route=None, envelope=None, message=None, size=None):
+        """Log the outcome of stage. An exception as result is logged as an error
+        (a Warning as a warning) with its class name in the code. start is what
+        start() returned when the stage began."""
+        if isinstance(result, Warning):
+            level, code = 'warning', '%s.Warning' % stage
+        elif isinstance(result, Exception):
+            level, code = 'error', '%s.%s' % (stage, type(result).__name__)
+        else:
+            level, code = 'info', '%s.ok' % stage
+        buf = _buffer(self.env.cr)
+        run_sequence = buf['run_sequence']
+        if callable(run_sequence):
+            run_sequence = buf['run_sequence'] = run_sequence()
+        buf['rows'].append((
+            fields.Datetime.now(), run_sequence,
+            route and route.id or None, envelope and envelope.id or None, message and message.id or None,
+            level, code, ustr(result)[:256] or None,
+            int((time.time() - start[0]) * 1000) if start else None,
+            getattr(self.env.cr, 'sql_log_count', 0) - start[1] if start else None,
+            size))
+        if not buf['depth'] or len(buf['rows']) >= self._batch_size:
+            self.flush()
+
+    @api.model
+    def flush(self):
+        """Write the buffered rows with one insert. References to records that no
+        longer exist (rolled back savepoints) are dropped."""
+        buf = _buffer(self.env.cr)
+        rows, buf['rows'] = buf['rows'], []
+        if not rows:
+            return
+        cr = self.env.cr
+        values = ','.join(cr.mogrify('(' + ','.join(['%s'] * len(_COLUMNS)) + ')', row) for row in rows)
+        cr.execute("""INSERT INTO edi_run_log (%s)
+            SELECT v.date::timestamp, v.run_sequence, r.id, e.id, m.id, v.level, v.code, v.name,
+                v.duration_ms::integer, v.queries::integer, v.size::integer
+            FROM (VALUES %s) AS v(%s)
+            LEFT JOIN edi_route r ON r.id = v.route_id::integer
+            LEFT JOIN edi_envelope e ON e.id = v.envelope_id::integer
+            LEFT JOIN edi_message m ON m.id = v.message_id::integer""" % (', '.join(_COLUMNS), values, ', '.join(_COLUMNS)))
+
+    @api.model
+    def rollup(self):
+        """Cron job: sum up log rows older than edi_route.run_log_days (30) days per day, route, level and code in edi.run.log.summary and delete them."""
+        days = int(self.env['ir.config_parameter'].get_param('edi_route.run_log_days', '30'))
+        limit = fields.Date.to_string(fields.Date.from_string(fields.Date.today()) - timedelta(days=days))
+        self.flush()
+        self.env.cr.execute("""INSERT INTO edi_run_log_summary (day, route_id, level, code, count, duration_ms, queries, size)
+            SELECT date::date, route_id, level, code, count(*), sum(duration_ms), sum(queries), sum(size)
+            FROM edi_run_log WHERE date < %s
+            GROUP BY date::date, route_id, level, code""", (limit,))
+        self.env.cr.execute("DELETE FROM edi_run_log WHERE date < %s", (limit,))
+        _logger.info('EDI run log: %s rows older than %s rolled up' % (self.env.cr.rowcount, limit))
+
+
+class edi_run_log_summary(models.Model):
+    _name = 'edi.run.log.summary'
+    _description = 'EDI Run Log Summary'
+    _order = 'day desc'
+    _log_access = False
+
+    day = fields.Date(string='Day', index=True, readonly=True)
+    route_id = fields.Many2one(comodel_name='edi.route', string='Route', ondelete='cascade', readonly=True)
+    level = fields.Selection([('info', 'Info'), ('warning', 'Warning'), ('error', 'Error')], string='Level', readonly=True)
+    code = fields.Char(string='Code', readonly=True)
+    count = fields.Integer(string='Count', readonly=True)
+    duration_ms = fields.Integer(string='Duration (ms)', readonly=True)
+    queries = fields.Integer(string='SQL Queries', readonly=True)
+    size = fields.Integer(string='Bytes', readonly=True)
+
+
+class edi_run_stats(models.Model):
+    """Time, SQL queries and bytes per run, envelope and stage, summed up from edi.run.log.
+
+    Stages are fold, out (transport out), in (transport in), split, unpack and
+    pack. Rows without envelope belong to the whole run; run.fold, run.out,
+    run.in and run.split are the totals of a route run."""
+    _name = 'edi.run.stats'
+    _description = 'EDI Run Statistics'
+    _auto = False
+    _order = 'run_sequence desc, envelope_id, stage'
+
+    run_sequence = fields.Char(string='Run', readonly=True)
+    route_id = fields.Many2one(comodel_name='edi.route', string='Route', readonly=True)
+    envelope_id = fields.Many2one(comodel_name='edi.envelope', string='Envelope', readonly=True)
+    stage = fields.Char(string='Stage', readonly=True)
+    count = fields.Integer(string='Count', readonly=True)
+    errors = fields.Integer(string='Errors', readonly=True)
+    duration_ms = fields.Integer(string='Duration (ms)', readonly=True)
+    queries = fields.Integer(string='SQL Queries', readonly=True)
+    size = fields.Integer(string='Bytes', readonly=True)
+
+    def init(self, cr):
+        tools.drop_view_if_exists(cr, 'edi_run_stats')
+        cr.execute("""CREATE OR REPLACE VIEW edi_run_stats AS (
+            SELECT min(id) AS id, run_sequence, route_id, envelope_id,
+                regexp_replace(code, '\\.[^.]*$', '') AS stage,
+                count(*) AS count,
+                count(CASE WHEN level = 'error' THEN 1 END) AS errors,
+                sum(duration_ms) AS duration_ms,
+                sum(queries) AS queries,
+                sum(size) AS size
+            FROM edi_run_log
+            WHERE run_sequence IS NOT NULL
+            GROUP BY run_sequence, route_id, envelope_id, regexp_replace(code, '\\.[^.]*$', '')
+        )""")
+
+    @api.model
+    def prometheus_text(self):
+        """The stages of the last run of every route in the Prometheus text format."""
+        self.env.cr.execute("""SELECT r.name, s.stage, sum(s.count), sum(s.errors), sum(s.duration_ms), sum(s.queries), sum(s.size)
+            FROM edi_run_stats s JOIN edi_route r ON r.id = s.route_id AND r.run_sequence = s.run_sequence
+            GROUP BY r.name, s.stage ORDER BY r.name, s.stage""")
+        rows = self.env.cr.fetchall()
+        metrics = [
+            ('edi_route_stage_count', 'Times the stage ran in the last run of the route.', 2, 1),
+            ('edi_route_stage_errors', 'Errors of the stage in the last run of the route.', 3, 1),
+            ('edi_route_stage_seconds', 'Wall time of the stage in the last run of the route.', 4, 1000.0),
+            ('edi_route_stage_queries', 'SQL queries of the stage in the last run of the route.', 5, 1),
+            ('edi_route_stage_bytes', 'Bytes handled by the stage in the last run of the route.', 6, 1),
+        ]
+        label = lambda v: (v or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = []
+        for name, help, col, div in metrics:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for row in rows:
+                lines.append('%s{route="%s",stage="%s"} %s' % (name, label(row[0]), label(row[1]), (row[col] or 0) / div))
+        return '\n'.join(lines) + '\n'
+
+
+class edi_run_stats_controller(http.Controller):
+
+    @http.route(['/edi/metrics'], type='http', auth="public")
+    def metrics(self, token=None, **post):
+        """Prometheus endpoint, off unless the system parameter edi_route.metrics_token is set (?token=...)."""
+        secret = request.env['ir.config_parameter'].sudo().get_param('edi_route.metrics_token')
+        if not secret or not hmac.compare_digest(str(secret), str(token or '')):
+            return request.not_found()
+        return request.make_response(request.env['edi.run.stats'].sudo().prometheus_text(),
+            headers=[('Content-Type', 'text/plain; version=0.0.4')])
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
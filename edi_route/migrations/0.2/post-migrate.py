@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from openerp import api, SUPERUSER_ID
+import base64
+
+import logging
+_logger = logging.getLogger(__name__)
+
+BATCH = 500
+
+
+def migrate(cr, version):
+    """Move the body columns of envelopes and messages to attachments (edi.body) and drop them."""
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    for model, table in (('edi.envelope', 'edi_envelope'), ('edi.message', 'edi_message')):
+        cr.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'body'", (table,))
+        if not cr.fetchone():
+            continue
+        cr.execute('SELECT id FROM %s WHERE body IS NOT NULL AND body_attachment_id IS NULL ORDER BY id' % table)
+        ids = [row[0] for row in cr.fetchall()]
+        _logger.info('Moving %s bodies of %s to attachments' % (len(ids), model))
+        for pos in range(0, len(ids), BATCH):
+            cr.execute('SELECT id, body FROM %s WHERE id IN %%s' % table, (tuple(ids[pos:pos + BATCH]),))
+            for res_id, body in cr.fetchall():
+                env[model].browse(res_id).write_body(base64.b64decode(str(body)))
+            env.invalidate_all()
+        cr.execute('ALTER TABLE %s DROP COLUMN body' % table)
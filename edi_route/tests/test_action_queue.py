@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+"""The edi.action.queue dispatcher: order per record, retries and batches."""
+from datetime import timedelta
+
+from openerp import fields
+from openerp.tests import common
+
+CALLER = 'edi_route.test_action_queue'
+CODE = """if fail:
+    raise Warning('action %s failed' % tag)
+partner.write({'comment': (partner.comment or '') + tag})
+"""
+PAST = '2000-01-01 00:00:00'
+FUTURE = '2999-01-01 00:00:00'
+
+
+class TestActionQueue(common.TransactionCase):
+
+    def setUp(self):
+        super(TestActionQueue, self).setUp()
+        # dispatch commits after every action, the test transaction is rolled back instead.
+        self.cr.commit = lambda: None
+        self.queue = self.env['edi.action.queue']
+        self.queue.search([('state', '=', 'pending')]).write({'state': 'cancel'})
+        caller = self.env['edi.route.caller'].create({'name': CALLER})
+        self.route = self.env['edi.route'].create({'name': 'Action queue test', 'defer_actions': True})
+        self.env['edi.route.line'].create({'name': 'Append tag', 'caller_id': caller.id, 'route_id': self.route.id, 'code': CODE})
+        self.partners = [self.env['res.partner'].create({'name': 'Action queue %s' % i}) for i in range(6)]
+
+    def enqueue(self, partner, tag, fail=False):
+        self.route.edi_action(CALLER, partner=partner, tag=tag, fail=fail)
+        return self.queue.search([('route_id', '=', self.route.id)], order='id desc', limit=1)
+
+    def set_dispatch_limit(self, limit):
+        cls = type(self.queue)
+        self.addCleanup(setattr, cls, '_dispatch_limit', cls._dispatch_limit)
+        cls._dispatch_limit = limit
+
+    def test_order(self):
+        first, second = self.partners[:2]
+        entries = self.enqueue(first, '1') + self.enqueue(first, '2') + self.enqueue(second, 'x') + self.enqueue(first, '3')
+        self.assertEqual(entries.mapped('state'), ['pending'] * 4)
+        self.assertEqual(first.comment, False)
+        self.queue.dispatch()
+        self.assertEqual(entries.mapped('state'), ['done'] * 4)
+        self.assertEqual(first.comment, '123')
+        self.assertEqual(second.comment, 'x')
+
+    def test_backoff(self):
+        partner = self.partners[0]
+        failing = self.enqueue(partner, '1', fail=True)
+        later = self.enqueue(partner, '2')
+        for attempts in range(1, self.queue._max_attempts):
+            self.queue.dispatch()
+            self.assertEqual((failing.state, failing.attempts), ('pending', attempts))
+            self.assertEqual(later.state, 'pending')
+            delay = fields.Datetime.from_string(failing.next_attempt) - fields.Datetime.from_string(fields.Datetime.now())
+            self.assertTrue(timedelta(minutes=attempts ** 2, seconds=-10) <= delay <= timedelta(minutes=attempts ** 2))
+            # Not due yet, and it holds back the action after it.
+            self.queue.dispatch()
+            self.assertEqual(failing.attempts, attempts)
+            self.assertEqual(later.state, 'pending')
+            failing.next_attempt = PAST
+        self.queue.dispatch()
+        self.assertEqual((failing.state, failing.attempts), ('failed', self.queue._max_attempts))
+        self.assertIn('action 1 failed', failing.error)
+        # A failed action is given up and no longer holds back the ones after it.
+        self.assertEqual(later.state, 'done')
+        self.assertEqual(partner.comment, '2')
+        self.assertTrue(self.env['mail.message'].search([
+            ('model', '=', 'res.partner'), ('res_id', '=', partner.id), ('subject', '=', 'EDI action failed')]))
+
+    def test_dispatch_limit(self):
+        self.set_dispatch_limit(2)
+        not_due = self.queue.browse()
+        for partner in self.partners[:3]:
+            not_due += self.enqueue(partner, 'n')
+        not_due.write({'next_attempt': FUTURE})
+        due = self.queue.browse()
+        for partner in self.partners[3:]:
+            due += self.enqueue(partner, 'd')
+        # The first page holds only actions that are not due, the due ones after it run anyway.
+        self.queue.dispatch()
+        self.assertEqual(due.mapped('state'), ['done', 'done', 'pending'])
+        self.queue.dispatch()
+        self.assertEqual(due.mapped('state'), ['done'] * 3)
+        self.assertEqual(not_due.mapped('state'), ['pending'] * 3)
+        self.assertEqual([p.comment for p in self.partners], [False] * 3 + ['d'] * 3)
@@ -29,6 +29,11 @@
 Add routes for EDI using FTP and SFTP.
 
 Requires python libraries paramiko and pycrypto. http://www.paramiko.org/installing.html
+
+FTP routes use passive mode unless Active Mode is set, and explicit TLS when TLS is set.
+Outgoing files are stored under a temporary name and renamed when complete.
+To try a route locally: pip install pyftpdlib; python -m pyftpdlib -w -p 2121
+The tests run the ftp session against pyftpdlib (and pyOpenSSL for FTPS), they are skipped without them.
 """,
     'author': 'Vertel AB',
     'website': 'http://www.vertel.se',
@@ -33,6 +33,9 @@ import fnmatch
 import zipfile
 import ftplib
 import base64
+import tempfile
+import threading
+import Queue
 from cStringIO import StringIO
 
 import logging
@@ -81,151 +84,131 @@ class _comsession(object):
         return convertdict.get(codec_in,codec_in)
 
 class ftp(_comsession):
+    ''' FTP and FTPS (explicit TLS). Files are streamed through temporary files.
+    '''
+    tls = False
+    active = False
+    spool_size = 1024 * 1024    # bytes kept in memory before a transfer spills to disk
+    listing = None  # names in cwd, see snapshot()
+
     def connect(self):
-        self.session = ftplib.FTP()
+        self.session = ftplib.FTP_TLS() if self.tls else ftplib.FTP()
         self.session.set_debuglevel(2 if self.debug else 0)   #set debug level (0=no, 1=medium, 2=full debug)
-        self.session.set_pasv(not self.ftpactive) #active or passive ftp
-        self.session.connect(host=self.host,port=self.port or 21)
-        self.session.login(user=self.username,passwd=self.password,acct=self.ftpaccount)
-        self.set_cwd()
+        self.session.connect(host=self.host, port=self.port or 21)
+        self.session.login(user=self.username or '', passwd=self.password or '')
+        if self.tls:
+            self.session.prot_p()
+        self.session.set_pasv(not self.active) #active or passive ftp
+        self.set_cwd('.')
 
-    def set_cwd(self,path):
-        self.session.chdir('.') # getcwd does not work without this chdir first!
+    def set_cwd(self, path):
+        self.listing = None
         wd = self.session.pwd()
         if path:
-            wd = posixpath.normpath(posixpath.join(wd,path))
+            wd = posixpath.normpath(posixpath.join(wd, path))
             try:
                 self.session.cwd(wd)
-            except:
+            except ftplib.error_perm:
                 self.session.mkd(wd)
                 self.session.cwd(wd)
         return wd
 
+    def _mlsd(self):
+        lines = []
+        self.session.retrlines('MLSD', lines.append)
+        names = []
+        for line in lines:
+            facts, name = line.split(' ', 1)
+            if 'type=file;' in facts.lower() + ';':
+                names.append(name)
+        return names
 
-    def incommunicate(self):
-        ''' do ftp: receive files. To be used via receive-dispatcher.
-            each to be imported file is transaction.
-            each imported file is transaction.
-        '''
-        startdatetime = datetime.datetime.now()
-        files = []
-        try:            #some ftp servers give errors when directory is empty; catch these errors here
-            files = self.session.nlst()
-        except (ftplib.error_perm,ftplib.error_temp) as msg:
-            if unicode(msg)[:3] not in [u'550',u'450']:
+    def list_files(self, path='.', pattern='*'):
+        ''' Names of the files in cwd, by MLSD when the server has it, otherwise NLST. '''
+        try:
+            files = self._mlsd()
+        except ftplib.error_perm as msg:
+            # 500/502 command not understood/implemented
+            if unicode(msg)[:3] not in [u'500', u'501', u'502']:
                 raise
+            try:            #some ftp servers give errors when directory is empty; catch these errors here
+                files = self.session.nlst()
+            except (ftplib.error_perm, ftplib.error_temp) as msg:
+                if unicode(msg)[:3] not in [u'550', u'450']:
+                    raise
+                files = []
+        return fnmatch.filter(files, pattern)
+
+    def get_fileobj(self, filename):
+        ''' RETR filename into a temporary file, returned positioned at the start. '''
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            self.session.retrbinary('RETR ' + filename, f.write)
+        except:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    def get_file(self, filename):
+        f = self.get_fileobj(filename)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def snapshot(self):
+        ''' List cwd once; exists() and put_file() then use and update this listing instead of asking the server. '''
+        self.listing = set(self.list_files())
+        return self.listing
 
-        lijst = fnmatch.filter(files,self.channeldict['filename'])
-        remove_ta = False
-        for fromfilename in lijst:  #fetch messages from ftp-server.
+    def exists(self, name, probe=False):
+        if probe:
             try:
-                ta_from = botslib.NewTransaction(filename='ftp:/'+posixpath.join(self.dirpath,fromfilename),
-                                                    status=EXTERNIN,
-                                                    fromchannel=self.channeldict['idchannel'],
-                                                    idroute=self.idroute)
-                ta_to =   ta_from.copyta(status=FILEIN)
-                remove_ta = True
-                tofilename = unicode(ta_to.idta)
-                tofile = botslib.opendata(tofilename, 'wb')
-                try:
-                    if self.channeldict['ftpbinary']:
-                        self.session.retrbinary("RETR " + fromfilename, tofile.write)
-                    else:
-                        self.session.retrlines("RETR " + fromfilename, lambda s, w=tofile.write: w(s+"\n"))
-                except ftplib.error_perm as msg:
-                    if unicode(msg)[:3] in [u'550',]:     #we are trying to download a directory...
-                        raise botslib.BotsError(u'To be catched')
-                    else:
-                        raise
-                tofile.close()
-                filesize = os.path.getsize(botslib.abspathdata(tofilename))
-                if not filesize:
-                    raise botslib.BotsError(u'To be catched; directory (or empty file)')
-            except botslib.BotsError:   #directory or empty file; handle exception but generate no error.
-                if remove_ta:
-                    try:
-                        ta_from.delete()
-                        ta_to.delete()
-                    except:
-                        pass
-            except:
-                txt = botslib.txtexc()
-                botslib.ErrorProcess(functionname='ftp-incommunicate',errortext=txt,channeldict=self.channeldict)
-                if remove_ta:
-                    try:
-                        ta_from.delete()
-                        ta_to.delete()
-                    except:
-                        pass
-            else:
-                ta_to.update(filename=tofilename,statust=OK,filesize=filesize)
-                ta_from.update(statust=DONE)
-                if self.channeldict['remove']:
-                    self.session.delete(fromfilename)
-            finally:
-                remove_ta = False
-                if (datetime.datetime.now()-startdatetime).seconds >= self.maxsecondsperchannel:
-                    break
+                self.session.voidcmd('TYPE I')
+                self.session.size(name)
+                return True
+            except ftplib.error_perm:
+                return False
+        if self.listing is None:
+            return name in self.list_files()
+        return name in self.listing
 
- 
-    def outcommunicate(self):
-        ''' do ftp: send files. To be used via receive-dispatcher.
-            each to be send file is transaction.
-            each send file is transaction.
-            NB: ftp command APPE should be supported by server
-        '''
-        #get right filename_mask & determine if fixed name (append) or files with unique names
-        filename_mask = self.channeldict['filename'] if self.channeldict['filename'] else '*'
-        if '{overwrite}' in filename_mask:
-            filename_mask = filename_mask.replace('{overwrite}','')
-            mode = 'STOR '
-        else:
-            mode = 'APPE '
-        for row in botslib.query('''SELECT idta,filename,numberofresends
-                                    FROM ta
-                                    WHERE idta>%(rootidta)s
-                                      AND status=%(status)s
-                                      AND statust=%(statust)s
-                                      AND tochannel=%(tochannel)s
-                                        ''',
-                                    {'tochannel':self.channeldict['idchannel'],'rootidta':self.rootidta,
-                                    'status':FILEOUT,'statust':OK}):
+    def put_file(self, file_obj, name, force = False, probe = False):
+        ''' STOR under a temporary name and rename when complete, so the receiver never reads a partial file. '''
+        if force or not self.exists(name, probe):
+            partname = '.%s.part' % name
+            self.session.storbinary('STOR ' + partname, file_obj)
             try:
-                ta_from = botslib.OldTransaction(row['idta'])
-                ta_to = ta_from.copyta(status=EXTERNOUT)
-                tofilename = self.filename_formatter(filename_mask,ta_from)
-                if self.channeldict['ftpbinary']:
-                    fromfile = botslib.opendata(row['filename'], 'rb')
-                    self.session.storbinary(mode + tofilename, fromfile)
-                else:
-                    fromfile = botslib.opendata(row['filename'], 'r')
-                    self.session.storlines(mode + tofilename, fromfile)
-                fromfile.close()
-                #Rename filename after writing file.
-                #Function: safe file writing: do not want another process to read the file while it is being written.
-                if self.channeldict['mdnchannel']:
-                    tofilename_old = tofilename
-                    tofilename = botslib.rreplace(tofilename_old,self.channeldict['mdnchannel'])
-                    self.session.rename(tofilename_old,tofilename)
+                if force and self.exists(name, probe):
+                    self.session.delete(name)
+                self.session.rename(partname, name)
             except:
-                txt = botslib.txtexc()
-                ta_to.update(statust=ERROR,errortext=txt,filename='ftp:/'+posixpath.join(self.dirpath,tofilename),numberofresends=row['numberofresends']+1)
-            else:
-                ta_to.update(statust=DONE,filename='ftp:/'+posixpath.join(self.dirpath,tofilename),numberofresends=row['numberofresends']+1)
-            finally:
-                ta_from.update(statust=DONE)
+                self.session.delete(partname)
+                raise
+            if self.listing is not None:
+                self.listing.add(name)
+            return True
+        return False
+
+    def rm(self, filename):
+        self.session.delete(filename)
+        if self.listing is not None:
+            self.listing.discard(filename)
 
     def disconnect(self):
         try:
             self.session.quit()
         except:
             self.session.close()
-        
 
 
 class sftp(_comsession):
     ''' SFTP: SSH File Transfer Protocol (SFTP is not FTP run over SSH, SFTP is not Simple File Transfer Protocol)
     '''
+    keepalive = 30
+    listing = None  # names in cwd, see snapshot()
+
     def connect(self):
         # check dependencies
         try:
@@ -245,12 +228,26 @@ class sftp(_comsession):
         # now, connect and use paramiko Transport to negotiate SSH2 across the connection
         self.transport = paramiko.Transport((self.host, self.port or 22))
         self.transport.connect(username=self.username, password=self.password, hostkey=hostkey, pkey=pkey)
+        self.transport.set_keepalive(self.keepalive)
         self.session = paramiko.SFTPClient.from_transport(self.transport)
         #channel = self.session.get_channel()
         #channel.settimeout(10)
         self.set_cwd('.')
+        self.connected_at = self.last_used = time.time()
+
+    def is_alive(self, probe=True):
+        ''' Check that the transport is up. probe also does a round-trip on the SFTP channel. '''
+        try:
+            if not (self.transport and self.transport.is_active()):
+                return False
+            if probe:
+                self.session.normalize('.')
+            return True
+        except Exception:
+            return False
 
     def set_cwd(self, path):
+        self.listing = None
         self.session.chdir('.') # getcwd does not work without this chdir first!
         wd = self.session.getcwd()
         if path:
@@ -263,8 +260,10 @@ class sftp(_comsession):
         return wd
         
     def disconnect(self):
-        self.session.close()
-        self.transport.close()
+        try:
+            self.session.close()
+        finally:
+            self.transport.close()
 
   
     def list_files(self, path='.', pattern='*'):
@@ -272,38 +271,237 @@ class sftp(_comsession):
         
     def get_file(self, filename):
         f = self.session.open(filename, 'r')    # SSH treats all files as binary
-        content = f.read()
-        f.close()
-        return content
+        try:
+            f.prefetch()    # request all blocks up front instead of one round-trip per read
+            return f.read()
+        finally:
+            f.close()
     
-    def put_file(self, file_obj, name, force = False):
-        if force or name not in self.list_files():
+    def snapshot(self):
+        ''' List cwd once; exists() and put_file() then use and update this listing instead of asking the server. '''
+        self.listing = set(self.session.listdir('.'))
+        return self.listing
+
+    def exists(self, name, probe=False):
+        if probe:
+            try:
+                self.session.stat(name)
+                return True
+            except IOError:
+                return False
+        if self.listing is None:
+            return name in self.list_files()
+        return name in self.listing
+
+    def put_file(self, file_obj, name, force = False, probe = False):
+        if force or not self.exists(name, probe):
             self.session.putfo(file_obj, name, confirm=False) #Delivered messages do not show up on Strålfors' server, so confirm will generate an error even on success. 
+            if self.listing is not None:
+                self.listing.add(name)
             return True
         return False
     
     def rm(self, filename):
         self.session.remove(filename)
+        if self.listing is not None:
+            self.listing.discard(filename)
+
+
+class _sftp_pool(object):
+    ''' Process wide pool of connected sftp sessions, keyed by (host, port, username).
+        Sessions are checked before reuse and closed when they have been idle
+        longer than max_idle or connected longer than max_age seconds.
+    '''
+    max_idle = 300
+    max_age = 3600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def _expired(self, server, now):
+        return now - server.last_used > self.max_idle or now - server.connected_at > self.max_age
+
+    def _evict(self, now):
+        for key, servers in self.sessions.items():
+            for server in [s for s in servers if self._expired(s, now)]:
+                servers.remove(server)
+                server.disconnect()
+            if not servers:
+                del self.sessions[key]
+
+    def acquire(self, host, username, password, port=None, debug=False):
+        ''' Return a connected sftp session with cwd reset, reusing an idle one if possible. '''
+        key = (host, port or 22, username)
+        while True:
+            with self.lock:
+                self._evict(time.time())
+                servers = self.sessions.get(key)
+                server = servers and servers.pop()
+            if not server:
+                break
+            if server.password == password:
+                server.session.chdir(None)
+                if server.is_alive():
+                    server.debug = debug
+                    server.set_cwd('.')
+                    return server
+            server.disconnect()
+        server = sftp(host=host, username=username, password=password, port=port, debug=debug)
+        server.connect()
+        return server
+
+    def release(self, server, broken=False):
+        ''' Give a session back to the pool, or close it if it is broken or too old. '''
+        now = time.time()
+        if broken or not server.is_alive(probe=False) or now - server.connected_at > self.max_age:
+            server.disconnect()
+            return
+        server.last_used = now
+        with self.lock:
+            self.sessions.setdefault((server.host, server.port or 22, server.username), []).append(server)
+
+_sftp_sessions = _sftp_pool()
+
+
+def _sftp_download(host, username, password, port, debug, directory, filenames, concurrency):
+    ''' Download filenames from directory over up to concurrency sftp sessions.
+        Yields (filename, content, error_info) as files arrive; at most
+        concurrency downloaded files wait to be consumed. A worker whose session
+        fails reports the error and stops, its remaining files are left to the others.
+    '''
+    concurrency = max(1, min(concurrency or 1, len(filenames)))
+    todo = Queue.Queue()
+    for f in filenames:
+        todo.put(f)
+    done = Queue.Queue(concurrency)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                done.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        server = None
+        try:
+            server = _sftp_sessions.acquire(host=host, username=username, password=password, port=port, debug=debug)
+            server.set_cwd(directory)
+            while not stop.is_set():
+                try:
+                    f = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    content = server.get_file(f)
+                except Exception:
+                    put((f, None, sys.exc_info()))
+                    _sftp_sessions.release(server, True)
+                    server = None
+                    break
+                if not put((f, content, None)):
+                    break
+        except Exception:
+            put((None, None, sys.exc_info()))
+        finally:
+            if server:
+                _sftp_sessions.release(server)
+            put(None)
+
+    threads = [threading.Thread(target=worker, name='edi.route.sftp.%s' % i) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item = done.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+    finally:
+        # Also when the consumer stops early (close()): workers waiting to put
+        # a file get it taken off the queue, see stop and give their session back.
+        stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                try:
+                    done.get_nowait()
+                except Queue.Empty:
+                    thread.join(0.05)
+
 
 class edi_route(models.Model):
     _inherit = 'edi.route' 
     
     ftp_host = fields.Char(string="Host")
+    ftp_port = fields.Integer(string="Port", help="Leave empty for the default port of the protocol")
     ftp_user = fields.Char(string="User")
     ftp_password = fields.Char(string="Password")
     ftp_directory_in = fields.Char(string="Directory In",)
     ftp_directory_out = fields.Char(string="Directory Out",)
     ftp_pattern = fields.Char(string="Pattern", help="File pattern eg *.edi")
     ftp_debug = fields.Boolean(string="Debug")
+    ftp_tls = fields.Boolean(string="TLS", help="Use explicit FTPS (ftp)")
+    ftp_active = fields.Boolean(string="Active Mode", help="Use active instead of passive mode (ftp)")
+    ftp_stat_probe = fields.Boolean(string="Probe Before Upload", help="Check each outgoing file on the server instead of listing the directory once per run. Use when the directory holds many files.")
+    ftp_concurrency = fields.Integer(string="Parallel Downloads", default=4, help="Number of files fetched at the same time (sftp)")
     protocol = fields.Selection(selection_add=[('ftp', 'Ftp'), ('sftp', 'Sftp')])
     
+    @api.multi
+    def _ftp_session(self):
+        ''' Connected ftp or sftp session for this route. Give it back with _ftp_release. '''
+        if self.protocol == 'sftp':
+            return _sftp_sessions.acquire(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, port=self.ftp_port or None, debug=self.ftp_debug)
+        server = ftp(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, port=self.ftp_port or None, debug=self.ftp_debug)
+        server.tls = self.ftp_tls
+        server.active = self.ftp_active
+        server.connect()
+        return server
+
+    @api.multi
+    def _ftp_release(self, server, broken=False):
+        if self.protocol == 'sftp':
+            _sftp_sessions.release(server, broken)
+        else:
+            server.disconnect()
+
+    @api.multi
+    def _ftp_download(self, server, directory, f_list):
+        ''' Yield (filename, content, error_info) for the files in f_list. content is a string or a file object. '''
+        if self.protocol == 'sftp':
+            # Files are fetched in worker threads while the caller creates the envelopes.
+            downloads = _sftp_download(self.ftp_host, self.ftp_user, self.ftp_password, self.ftp_port or None, self.ftp_debug, directory, f_list, self.ftp_concurrency)
+            try:
+                for item in downloads:
+                    yield item
+            finally:
+                downloads.close()
+            return
+        for f in f_list:
+            try:
+                file_obj = server.get_fileobj(f)
+            except ftplib.error_perm:
+                yield f, None, sys.exc_info()
+                continue
+            try:
+                yield f, file_obj, None
+            finally:
+                file_obj.close()
+
     @api.one
     def check_connection(self):
         _logger.info('Check connection [%s:%s]' % (self.name, self.protocol))
         if self.protocol == 'ftp':
-            pass
+            server = self._ftp_session()
+            server.disconnect()
         elif self.protocol == 'sftp':
-            server =  sftp(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, debug=self.ftp_debug)
+            server =  sftp(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, port=self.ftp_port or None, debug=self.ftp_debug)
             server.connect()
             server.disconnect()
         else:
@@ -311,38 +509,53 @@ class edi_route(models.Model):
     
     @api.multi
     def _run_in(self):
-        if self.protocol == 'ftp':
-            return []
-        elif self.protocol == 'sftp':
+        if self.protocol in ('ftp', 'sftp'):
             envelopes = []
+            run_log = self.env['edi.run.log']
             if self.ftp_debug:
-                _logger.debug('sftp host=%s  username=%s password=%s' % (self.ftp_host, self.ftp_user, self.ftp_password))
+                _logger.debug('%s host=%s  username=%s password=%s' % (self.protocol, self.ftp_host, self.ftp_user, self.ftp_password))
             try:
-                server =  sftp(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, debug=self.ftp_debug)
-                server.connect()
+                server = self._ftp_session()
             except Exception as e:
-                self.log('error in sftp', sys.exc_info())                   
-                _logger.error('error in sftp')
+                self.log('error in %s' % self.protocol, sys.exc_info())                   
+                _logger.error('error in %s' % self.protocol)
             else:
+                broken = False
                 try:
-                    server.set_cwd(self.ftp_directory_in or '.')
+                    directory = server.set_cwd(self.ftp_directory_in or '.')
                     f_list = server.list_files(pattern=self.ftp_pattern or '*')
                     if self.ftp_debug:
                         _logger.info('info list %s' % f_list)
-                    for f in f_list:
-                        envelopes.append(self.env['edi.envelope'].create({
-                            'name': f,
-                            'body': base64.encodestring(server.get_file(f)),
-                            'route_id': self.id,
-                            'route_type': self.route_type
-                        }))
-                        server.rm(f)
+                    # Downloads overlap, each file is timed from the one before it.
+                    start = run_log.start()
+                    downloads = self._ftp_download(server, directory, f_list)
+                    try:
+                        for f, content, error in downloads:
+                            if error:
+                                self.log('error in %s when reading %s' % (self.protocol, f or directory), error)
+                                _logger.error('error in %s READ %s' % (self.protocol, f))
+                                run_log.add('in', error[1], start, route=self)
+                                start = run_log.start()
+                                continue
+                            envelope = self.env['edi.envelope'].create({
+                                'name': f,
+                                'route_id': self.id,
+                                'route_type': self.route_type
+                            })
+                            envelope.write_body(content)
+                            envelopes.append(envelope)
+                            server.rm(f)
+                            run_log.add('in', f, start, route=self, envelope=envelope, size=envelope.body_attachment_id.file_size)
+                            start = run_log.start()
+                    finally:
+                        downloads.close()
                 except Exception as e:
-                    self.log('error in sftp', sys.exc_info())    
-                    _logger.error('error in sftp READ')
+                    broken = True
+                    self.log('error in %s' % self.protocol, sys.exc_info())    
+                    _logger.error('error in %s READ' % self.protocol)
                 finally:
-                    server.disconnect()
-            log = 'sftp host=%s  username=%s password=%s\nNbr envelopes %s\n%s' % (self.ftp_host, self.ftp_user, self.ftp_password, len(envelopes), ','.join([e.name for e in envelopes]))
+                    self._ftp_release(server, broken)
+            log = '%s host=%s  username=%s password=%s\nNbr envelopes %s\n%s' % (self.protocol, self.ftp_host, self.ftp_user, self.ftp_password, len(envelopes), ','.join([e.name for e in envelopes]))
             _logger.info(log)
             if self.ftp_debug:
                 self.log(log)
@@ -352,32 +565,38 @@ class edi_route(models.Model):
     
     @api.multi
     def _run_out(self, envelopes):
-        _logger.debug('edi_route._run_out (sftp): %s' % envelopes)
-        if self.protocol == 'ftp':
-            pass
-        elif self.protocol == 'sftp':
+        _logger.debug('edi_route._run_out (%s): %s' % (self.protocol, envelopes))
+        if self.protocol in ('ftp', 'sftp'):
+            run_log = self.env['edi.run.log']
             if self.ftp_debug:
-                _logger.debug('sftp host=%s  username=%s password=%s' % (self.ftp_host, self.ftp_user, self.ftp_password))
+                _logger.debug('%s host=%s  username=%s password=%s' % (self.protocol, self.ftp_host, self.ftp_user, self.ftp_password))
             try:
-                server =  sftp(host=self.ftp_host, username=self.ftp_user, password=self.ftp_password, debug=self.ftp_debug)
-                server.connect()
+                server = self._ftp_session()
             except Exception as e:
                 if self.ftp_debug:
-                    self.log('error in sftp', sys.exc_info())                   
-                _logger.error('error in sftp')
+                    self.log('error in %s' % self.protocol, sys.exc_info())                   
+                _logger.error('error in %s' % self.protocol)
             else:
+                broken = False
                 try:
                     server.set_cwd(self.ftp_directory_out or '.')
-                    f_list = server.list_files(pattern=self.ftp_pattern or '*')
-                    if self.ftp_debug:
-                        _logger.info('info list %s' % f_list)
+                    if not self.ftp_stat_probe:
+                        f_list = server.snapshot()
+                        if self.ftp_debug:
+                            _logger.info('info list %s' % fnmatch.filter(f_list, self.ftp_pattern or '*'))
                     for envelope in envelopes:
+                        start = run_log.start()
                         try:
-                            file_obj = StringIO(base64.b64decode(envelope.body))
-                            if server.put_file(file_obj, envelope.name):
+                            file_obj = envelope.open_body()
+                            try:
+                                sent = server.put_file(file_obj, envelope.name, probe=self.ftp_stat_probe)
+                            finally:
+                                file_obj.close()
+                            if sent:
                                 envelope.state = 'sent'
                                 for msg in envelope.edi_message_ids:
                                     msg.state = 'sent'
+                                run_log.add('out', envelope.name, start, route=self, envelope=envelope, size=envelope.body_attachment_id.file_size)
                             else:
                                 envelope.state = 'canceled'
                                 for msg in envelope.edi_message_ids:
@@ -385,15 +604,17 @@ class edi_route(models.Model):
                                 self.log('Error! Envelope %s already exists on server.' % envelope.name, sys.exc_info())
                         except Exception as e:
                             self.log('error when sending envelope %s' % envelope.name, sys.exc_info())    
+                            run_log.add('out', e, start, route=self, envelope=envelope)
                             envelope.state = 'canceled'
                             for msg in envelope.edi_message_ids:
                                 msg.state = 'canceled'
                 except Exception as e:
-                    self.log('error in sftp with envelope %s' % envelope.name, sys.exc_info())
-                    _logger.error('error in sftp READ')
+                    broken = True
+                    self.log('error in %s with envelope %s' % (self.protocol, envelope.name), sys.exc_info())
+                    _logger.error('error in %s READ' % self.protocol)
                 finally:
-                    server.disconnect()
-            log = 'sftp host=%s  username=%s password=%s\nNbr envelopes %s\n%s' % (self.ftp_host, self.ftp_user, self.ftp_password, len(envelopes), ','.join([e.name for e in envelopes]))
+                    self._ftp_release(server, broken)
+            log = '%s host=%s  username=%s password=%s\nNbr envelopes %s\n%s' % (self.protocol, self.ftp_host, self.ftp_user, self.ftp_password, len(envelopes), ','.join([e.name for e in envelopes]))
             _logger.info(log)
             if self.ftp_debug:
                 self.log(log)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2016 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+"""The ftp session class and the ftp parts of edi.route against a pyftpdlib
+server run in a thread. Skipped without pyftpdlib (and pyOpenSSL for FTPS):
+
+    pip install pyftpdlib pyopenssl
+"""
+import ftplib
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+from cStringIO import StringIO
+
+import unittest2
+
+from openerp.tests import common
+from openerp.addons.edi_route_ftp.edi_route import ftp
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, TLS_FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
+
+try:
+    from OpenSSL import crypto
+except ImportError:
+    crypto = None
+
+USER = 'edi'
+PASSWORD = 'secret'
+
+
+def _self_signed(path):
+    """Write a key and a self-signed certificate for localhost to path (PEM)."""
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    with open(path, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+
+class _FtpServer(object):
+    """pyftpdlib serving root on a free local port from a thread. commands are
+    the (command, argument) pairs the server received."""
+
+    def __init__(self, root, tls=False, mlsd=True):
+        self.commands = commands = []
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USER, PASSWORD, root, perm='elradfmwMT')
+        base = TLS_FTPHandler if tls else FTPHandler
+
+        class Handler(base):
+            def pre_process_command(self, line, cmd, arg):
+                commands.append((cmd, arg))
+                return base.pre_process_command(self, line, cmd, arg)
+        Handler.authorizer = authorizer
+        if tls:
+            Handler.certfile = os.path.join(root, '..', 'cert.pem')
+            _self_signed(Handler.certfile)
+        if not mlsd:
+            Handler.proto_cmds = dict((k, v) for k, v in base.proto_cmds.items() if k != 'MLSD')
+        self.server = FTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.address[1]
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._serve, name='edi.route.ftp.test')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while not self.stop.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False, handle_exit=False)
+        self.server.close_all()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def received(self, cmd):
+        return [arg for c, arg in self.commands if c == cmd]
+
+
+@unittest2.skipIf(FTPServer is None, 'pyftpdlib is not installed')
+class TestFtpSession(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        os.mkdir(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def serve(self, **kw):
+        server = _FtpServer(self.root, **kw)
+        self.addCleanup(server.close)
+        return server
+
+    def session(self, server, tls=False, active=False):
+        session = ftp(host='127.0.0.1', username=USER, password=PASSWORD, port=server.port)
+        session.tls = tls
+        session.active = active
+        session.connect()
+        self.addCleanup(session.disconnect)
+        return session
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def round_trip(self, server, session):
+        data = 'UNA:+.? \'UNB+UNOC:3+1:14+2:14\'' * 100
+        self.assertTrue(session.put_file(StringIO(data), 'ENV1.edi'))
+        self.assertEqual(session.list_files(pattern='*.edi'), ['ENV1.edi'])
+        self.assertEqual(session.get_file('ENV1.edi'), data)
+        session.rm('ENV1.edi')
+        self.assertEqual(session.list_files(), [])
+
+    def test_passive_round_trip(self):
+        server = self.serve()
+        session = self.session(server)
+        self.round_trip(server, session)
+        self.assertTrue(server.received('PASV') or server.received('EPSV'))
+        self.assertFalse(server.received('PORT') or server.received('EPRT'))
+
+    def test_active_round_trip(self):
+        server = self.serve()
+        session = self.session(server, active=True)
+        self.round_trip(server, session)
+        self.assertTrue(server.received('PORT') or server.received('EPRT'))
+        self.assertFalse(server.received('PASV') or server.received('EPSV'))
+
+    @unittest2.skipIf(crypto is None, 'pyOpenSSL is not installed')
+    def test_tls_round_trip(self):
+        server = self.serve(tls=True)
+        session = self.session(server, tls=True)
+        self.assertIsInstance(session.session.sock, ssl.SSLSocket)
+        self.round_trip(server, session)
+        self.assertEqual(server.received('AUTH'), ['TLS'])
+        self.assertEqual(server.received('PROT'), ['P'])
+
+    def test_upload_is_renamed_when_complete(self):
+        server = self.serve()
+        session = self.session(server)
+        self.assertTrue(session.put_file(StringIO('first'), 'ENV1.edi'))
+        self.assertEqual(server.received('STOR'), ['.ENV1.edi.part'])
+        self.assertEqual(server.received('RNFR'), ['.ENV1.edi.part'])
+        self.assertEqual(server.received('RNTO'), ['ENV1.edi'])
+        self.assertEqual(sorted(os.listdir(self.root)), ['ENV1.edi'])
+        # An existing file is kept unless forced.
+        self.assertFalse(session.put_file(StringIO('second'), 'ENV1.edi'))
+        self.assertFalse(session.put_file(StringIO('second'), 'ENV1.edi', probe=True))
+        self.assertTrue(session.put_file(StringIO('second'), 'ENV1.edi', force=True))
+        self.assertEqual(sorted(os.listdir(self.root)), ['ENV1.edi'])
+        self.assertEqual(session.get_file('ENV1.edi'), 'second')
+
+    def test_snapshot(self):
+        self.write('a.edi', 'a')
+        server = self.serve()
+        session = self.session(server)
+        self.assertEqual(session.snapshot(), set(['a.edi']))
+        self.assertTrue(session.exists('a.edi'))
+        session.put_file(StringIO('b'), 'b.edi')
+        self.assertTrue(session.exists('b.edi'))
+        session.rm('a.edi')
+        self.assertFalse(session.exists('a.edi'))
+        self.assertEqual(len(server.received('MLSD')), 1)
+
+    def test_list_files_mlsd(self):
+        self.write('a.edi', 'a')
+        self.write('b.txt', 'b')
+        os.mkdir(os.path.join(self.root, 'sub.edi'))
+        server = self.serve()
+        session = self.session(server)
+        self.assertEqual(session.list_files(pattern='*.edi'), ['a.edi'])
+        self.assertTrue(server.received('MLSD'))
+        self.assertFalse(server.received('NLST'))
+
+    def test_list_files_nlst_fallback(self):
+        server = self.serve(mlsd=False)
+        session = self.session(server)
+        self.assertEqual(session.list_files(), [])
+        self.write('a.edi', 'a')
+        self.write('b.txt', 'b')
+        self.assertEqual(session.list_files(pattern='*.edi'), ['a.edi'])
+        self.assertTrue(server.received('MLSD'))
+        self.assertTrue(server.received('NLST'))
+
+    def test_get_fileobj_spools_to_disk(self):
+        data = os.urandom(5000)
+        self.write('big.edi', data)
+        server = self.serve()
+        session = self.session(server)
+        session.spool_size = 1024
+        f = session.get_fileobj('big.edi')
+        try:
+            self.assertTrue(f._rolled)
+            self.assertEqual(f.read(), data)
+        finally:
+            f.close()
+        session.spool_size = 1024 * 1024
+        f = session.get_fileobj('big.edi')
+        try:
+            self.assertFalse(f._rolled)
+            self.assertEqual(f.read(), data)
+        finally:
+            f.close()
+
+    def test_get_fileobj_missing(self):
+        server = self.serve()
+        session = self.session(server)
+        with self.assertRaises(ftplib.error_perm):
+            session.get_fileobj('missing.edi')
+
+    def test_set_cwd_creates_directory(self):
+        server = self.serve()
+        session = self.session(server)
+        self.assertEqual(session.set_cwd('in'), '/in')
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'in')))
+        session.put_file(StringIO('x'), 'x.edi')
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'in', 'x.edi')))
+
+
+@unittest2.skipIf(FTPServer is None, 'pyftpdlib is not installed')
+class TestFtpRoute(common.TransactionCase):
+
+    def setUp(self):
+        super(TestFtpRoute, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(self.root, 'in'))
+        self.server = _FtpServer(self.root)
+        self.addCleanup(self.server.close)
+        self.route = self.env['edi.route'].new({
+            'name': 'FTP test',
+            'protocol': 'ftp',
+            'ftp_host': '127.0.0.1',
+            'ftp_port': self.server.port,
+            'ftp_user': USER,
+            'ftp_password': PASSWORD,
+        })
+
+    def test_download(self):
+        with open(os.path.join(self.root, 'in', 'a.edi'), 'wb') as f:
+            f.write('UNB+UNOC:3\'')
+        session = self.route._ftp_session()
+        try:
+            directory = session.set_cwd('in')
+            items = []
+            for name, content, error in self.route._ftp_download(session, directory, ['a.edi', 'missing.edi']):
+                items.append((name, content and content.read(), error and error[0]))
+                if content:
+                    file_obj = content
+            self.assertTrue(file_obj.closed)
+        finally:
+            self.route._ftp_release(session)
+        self.assertEqual(items, [('a.edi', 'UNB+UNOC:3\'', None), ('missing.edi', None, ftplib.error_perm)])
+        self.assertTrue(self.server.received('PASV') or self.server.received('EPSV'))
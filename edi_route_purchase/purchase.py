@@ -71,51 +71,37 @@ class purchase_order(models.Model):
     @api.multi
     def wkf_bid_received(self):
         res =  super(purchase_order,self).wkf_bid_received()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.wkf_bid_received',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.wkf_bid_received', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def wkf_confirm_order(self):
         res =  super(purchase_order,self).wkf_confirm_order()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.wkf_confirm_order',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.wkf_confirm_order', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def wkf_action_cancel(self):
         res =  super(purchase_order,self).wkf_action_cancel()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.wkf_action_cancel',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.wkf_action_cancel', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def wkf_approve_order(self):
         res =  super(purchase_order,self).wkf_approve_order()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.wkf_approve_order',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.wkf_approve_order', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def action_invoice_create(self):
         res =  super(purchase_order,self).action_invoice_create()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.action_invoice_create',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.action_invoice_create', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def invoice_done(self):
         res =  super(purchase_order,self).invoice_done()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.invoice_done',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.invoice_done', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
     @api.multi
     def action_picking_create(self):
         res =  super(purchase_order,self).action_picking_create()
-        for purchase in self:
-            for r in purchase._get_route():
-                r.edi_action('purchase.order.action_picking_create',purchase=purchase,res=res)
+        self.env['edi.route'].edi_action_records('purchase.order.action_picking_create', 'purchase', self, lambda p: p._get_route(), res=res)
         return res
 
 class res_partner(models.Model):
@@ -67,35 +67,27 @@ class sale_order(models.Model):
     @api.multi
     def action_cancel(self):
         res =  super(sale_order,self).action_cancel()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_cancel',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_cancel', 'order', self, lambda o: o.route_id, res=res)
         return res
     
     @api.multi
     def action_button_confirm(self):
         res = super(sale_order,self).action_button_confirm()
         _logger.warn("\n\naction_button_confirm begin: %s, %s\n\n" % (res, self.picking_ids))
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_button_confirm',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_button_confirm', 'order', self, lambda o: o.route_id, res=res)
         _logger.warn("\n\naction_button_confirm done!\n\n")
         return res
     
     @api.multi
     def action_wait(self):
         res =  super(sale_order,self).action_wait()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_wait',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_wait', 'order', self, lambda o: o.route_id, res=res)
         return res
     
     @api.multi
     def action_done(self):
         res =  super(sale_order,self).action_done()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_done',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_done', 'order', self, lambda o: o.route_id, res=res)
         return res
     
     @api.multi
@@ -121,25 +113,19 @@ class sale_order(models.Model):
     @api.multi
     def action_invoice_cancel(self):
         res =  super(sale_order,self).action_invoice_cancel()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_invoice_cancel',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_invoice_cancel', 'order', self, lambda o: o.route_id, res=res)
         return res
     
     @api.multi
     def action_invoice_end(self):
         res =  super(sale_order,self).action_invoice_end()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_invoice_end',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_invoice_end', 'order', self, lambda o: o.route_id, res=res)
         return res
     
     @api.multi
     def action_ignore_delivery_exception(self):
         res =  super(sale_order,self).action_ignore_delivery_exception()
-        for order in self:
-            if order.route_id:
-                order.route_id.edi_action('sale.order.action_ignore_delivery_exception',order=order,res=res)
+        self.env['edi.route'].edi_action_records('sale.order.action_ignore_delivery_exception', 'order', self, lambda o: o.route_id, res=res)
         return res
 
     def _edi_message_create(self, edi_type, sender=None, recipient=None, check_double=False,):
@@ -199,44 +185,31 @@ class account_invoice(models.Model):
     @api.multi
     def action_cancel(self):
         res =  super(account_invoice, self).action_cancel()
-        for invoice in self:
-            if invoice._get_route():
-                invoice._get_route().edi_action('account.invoice.action_cancel', invoice=invoice, res=res)
+        self.env['edi.route'].edi_action_records('account.invoice.action_cancel', 'invoice', self, lambda i: i._get_route(), res=res)
         return res
 
     @api.multi
     def action_move_create(self):
         res =  super(account_invoice, self).action_move_create()
-        for invoice in self:
-            if invoice._get_route():
-                invoice._get_route().edi_action('account.invoice.action_move_create', invoice=invoice,res=res)
+        self.env['edi.route'].edi_action_records('account.invoice.action_move_create', 'invoice', self, lambda i: i._get_route(), res=res)
         return res
 
     @api.multi
     def action_draft(self):
         res =  super(account_invoice, self).action_draft()
-        for invoice in self:
-            _logger.info("action_draft Caller ID: %s; (account) %s %s" % ('account.invoice.action_draft', invoice, invoice._get_route()))
-            if invoice._get_route():
-                invoice._get_route().edi_action('account.invoice.action_draft', invoice=invoice, res=res)
+        self.env['edi.route'].edi_action_records('account.invoice.action_draft', 'invoice', self, lambda i: i._get_route(), res=res)
         return res
 
     @api.multi
     def action_create(self):
         res =  super(account_invoice, self).action_create()
-        for invoice in self:
-            _logger.info("action_create Caller ID: %s; (account) %s %s" % ('account.invoice.action_create', invoice, invoice._get_route()))
-            if invoice._get_route():
-                invoice._get_route().edi_action('account.invoice.action_create', invoice=invoice, res=res)
+        self.env['edi.route'].edi_action_records('account.invoice.action_create', 'invoice', self, lambda i: i._get_route(), res=res)
         return res
 
     @api.multi
     def invoice_validate(self):
         res =  super(account_invoice, self).invoice_validate()
-        for invoice in self:
-            _logger.info("invoice_validate Caller ID: %s; (account) %s %s" % ('account.invoice.invoice_validate', invoice, invoice._get_route()))
-            if invoice._get_route():
-                invoice._get_route().edi_action('account.invoice.invoice_validate', invoice=invoice)
+        self.env['edi.route'].edi_action_records('account.invoice.invoice_validate', 'invoice', self, lambda i: i._get_route())
         return res
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
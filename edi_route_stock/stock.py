@@ -70,37 +70,27 @@ class stock_picking(models.Model):
     @api.multi
     def action_cancel(self):
         res =  super(stock_picking,self).action_cancel()
-        for picking in self:
-            if picking.sale_id and picking.sale_id.route_id:
-                picking.sale_id.route_id.edi_action('stock.picking.action_cancel', picking=picking,res=res)
+        self.env['edi.route'].edi_action_records('stock.picking.action_cancel', 'picking', self, lambda p: p.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_confirm(self):
         res =  super(stock_picking,self).action_confirm()
-        for picking in self:
-            if picking.sale_id and picking.sale_id.route_id:
-                picking.sale_id.route_id.edi_action('stock.picking.action_confirm',picking=picking,res=res)
+        self.env['edi.route'].edi_action_records('stock.picking.action_confirm', 'picking', self, lambda p: p.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_assign(self):
         res =  super(stock_picking,self).action_assign()
-        for picking in self:
-            if picking.sale_id and picking.sale_id.route_id:
-                picking.sale_id.route_id.edi_action('stock.picking.action_assign',picking=picking,res=res)
+        self.env['edi.route'].edi_action_records('stock.picking.action_assign', 'picking', self, lambda p: p.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_done(self):
         res =  super(stock_picking,self).action_done()
-        for picking in self:
-            if picking.sale_id and picking.sale_id.route_id:
-                picking.sale_id.route_id.edi_action('stock.picking.action_done',picking=picking,res=res)
+        self.env['edi.route'].edi_action_records('stock.picking.action_done', 'picking', self, lambda p: p.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_pack(self):
         res =  super(stock_picking,self).action_pack()
-        for picking in self:
-            if picking.sale_id and picking.sale_id.route_id:
-                picking.sale_id.route_id.edi_action('stock.picking.action_pack',picking=picking,res=res)
+        self.env['edi.route'].edi_action_records('stock.picking.action_pack', 'picking', self, lambda p: p.sale_id.route_id, res=res)
         return res
 
 
@@ -116,23 +106,17 @@ class stock_move(models.Model):
     @api.multi
     def action_cancel(self):
         res =  super(stock_move,self).action_cancel()
-        for move in self:
-            if move.picking_id.sale_id and move.picking_id.sale_id.route_id:
-                move.picking_id.sale_id.route_id.edi_action('stock.move.action_cancel',move=move,res=res)
+        self.env['edi.route'].edi_action_records('stock.move.action_cancel', 'move', self, lambda m: m.picking_id.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_confirm(self):
         res =  super(stock_move,self).action_confirm()
-        for move in self:
-            if move.picking_id.sale_id and move.picking_id.sale_id.route_id:
-                move.picking_id.sale_id.route_id.edi_action('stock.move.action_confirm',move=move,res=res)
+        self.env['edi.route'].edi_action_records('stock.move.action_confirm', 'move', self, lambda m: m.picking_id.sale_id.route_id, res=res)
         return res
     @api.multi
     def action_done(self):
         res =  super(stock_move,self).action_done()
-        for move in self:
-            if move.picking_id.sale_id and move.picking_id.sale_id.route_id:
-                move.picking_id.sale_id.route_id.edi_action('stock.move.action_done',move=move,res=res)
+        self.env['edi.route'].edi_action_records('stock.move.action_done', 'move', self, lambda m: m.picking_id.sale_id.route_id, res=res)
         return res
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4: